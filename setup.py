@@ -20,6 +20,7 @@ setup(
     packages=['simplestreams', 'simplestreams.mirrors',
               'simplestreams.objectstores'],
     scripts=glob('bin/*'),
+    install_requires=['futures; python_version < "3.2"'],
     data_files=[
         ('lib/simplestreams', glob('tools/hook-*')),
         ('share/doc/simplestreams',
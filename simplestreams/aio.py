@@ -0,0 +1,572 @@
+#   Copyright (C) 2026 Canonical Ltd.
+#
+#   Simplestreams is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+#   Simplestreams is distributed in the hope that it will be useful, but
+#   WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#   or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public
+#   License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with Simplestreams.  If not, see <http://www.gnu.org/licenses/>.
+
+# asyncio counterparts of ContentSource, MirrorReader, ObjectStore and
+# ObjectStoreMirrorWriter.sync.  This module requires python3.
+#
+# Network transfers use the same pooled url readers as the sync code, so
+# proxies, redirects, timeouts and resuming work as they do there.  Their
+# blocking calls run in executor threads while the loop decides what to
+# fetch next.  Sync objects can be used from async code
+# (AsyncContentSourceAdapter, AsyncObjectStoreAdapter,
+# AsyncObjectStoreMirrorReader) and async sources from sync code
+# (SyncContentSource).
+
+import asyncio
+from concurrent import futures
+import errno
+import functools
+
+import simplestreams.contentsource as cs
+import simplestreams.mirrors as mirrors
+from simplestreams.mirrors import UrlMirrorReader as _UrlMirrorReader
+import simplestreams.objectstores as objectstores
+import simplestreams.util as util
+from simplestreams import checksum_util
+from simplestreams.log import LOG
+
+READ_BUFFER_SIZE = 1024 * 64
+DEFAULT_MAX_CONCURRENCY = 16
+# seconds to wait for a connection, or for the next data from one.
+DEFAULT_TIMEOUT = 60
+
+
+def _enoent(msg):
+    myerr = IOError(msg)
+    myerr.errno = errno.ENOENT
+    return myerr
+
+
+def _is_enoent(exc):
+    return isinstance(exc, IOError) and exc.errno == errno.ENOENT
+
+
+async def _blocking(func, *args, **kwargs):
+    # run func in the loop's default executor, so file I/O and other
+    # blocking calls do not hold up the loop.
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        None, functools.partial(func, *args, **kwargs))
+
+
+class AsyncContentSource(object):
+    url = None
+
+    async def open(self):
+        pass
+
+    async def read(self, size=-1):
+        # like ContentSource.read, a result shorter than size means EOF.
+        raise NotImplementedError()
+
+    def set_start_pos(self, offset):
+        raise NotImplementedError()
+
+    async def close(self):
+        raise NotImplementedError()
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, etype, value, trace):
+        await self.close()
+
+
+class AsyncMemoryContentSource(AsyncContentSource):
+    def __init__(self, url=None, content=b""):
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        if url is None:
+            url = "AsyncMemoryContentSource://undefined"
+        self.url = url
+        self.content = content
+        self.pos = 0
+
+    async def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self.content) - self.pos
+        buf = self.content[self.pos:self.pos + size]
+        self.pos += len(buf)
+        return buf
+
+    def set_start_pos(self, offset):
+        self.pos = offset
+
+    async def close(self):
+        pass
+
+
+class AsyncContentSourceAdapter(AsyncContentSource):
+    """Use a sync ContentSource from async code.
+
+    Blocking calls to the wrapped source run in the loop's default
+    executor."""
+
+    def __init__(self, csrc):
+        self.cs = csrc
+
+    @property
+    def url(self):
+        return self.cs.url
+
+    async def _call(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, func, *args)
+
+    async def open(self):
+        await self._call(self.cs.open)
+
+    async def read(self, size=-1):
+        return await self._call(self.cs.read, size)
+
+    def set_start_pos(self, offset):
+        self.cs.set_start_pos(offset)
+
+    async def close(self):
+        await self._call(self.cs.close)
+
+
+class SyncContentSource(cs.ContentSource):
+    """Use an AsyncContentSource from sync code running in another thread.
+
+    loop is the (running) event loop that the async source belongs to."""
+
+    def __init__(self, acsrc, loop):
+        self.acs = acsrc
+        self.loop = loop
+
+    @property
+    def url(self):
+        return self.acs.url
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def open(self):
+        return self._run(self.acs.open())
+
+    def read(self, size=-1):
+        return self._run(self.acs.read(size))
+
+    def set_start_pos(self, offset):
+        self.acs.set_start_pos(offset)
+
+    def close(self):
+        return self._run(self.acs.close())
+
+
+class AsyncChecksummingContentSource(AsyncContentSource):
+    # async version of contentsource.ChecksummingContentSource
+    def __init__(self, csrc, checksums, size=None):
+        self.cs = csrc
+        self.bytes_read = 0
+        self.size = size
+
+        try:
+            self.checksummer = checksum_util.SafeCheckSummer(checksums)
+        except ValueError as e:
+            raise checksum_util.invalid_checksum_for_reader(self, msg=str(e))
+
+        try:
+            self.size = int(size)
+        except TypeError:
+            raise checksum_util.invalid_checksum_for_reader(self)
+
+    @property
+    def algorithm(self):
+        return self.checksummer.algorithm
+
+    @property
+    def url(self):
+        return self.cs.url
+
+    def check(self):
+        return self.bytes_read == self.size and self.checksummer.check()
+
+    async def open(self):
+        await self.cs.open()
+
+    async def read(self, size=-1):
+        buf = await self.cs.read(size)
+        buflen = len(buf)
+        self.checksummer.update(buf)
+        self.bytes_read += buflen
+
+        if buflen != size and self.size != self.bytes_read:
+            raise checksum_util.invalid_checksum_for_reader(self)
+
+        if self.bytes_read == self.size and not self.check():
+            raise checksum_util.invalid_checksum_for_reader(self)
+        return buf
+
+    async def close(self):
+        await self.cs.close()
+
+
+class AsyncUrlContentSource(AsyncContentSourceAdapter):
+    """Async version of contentsource.UrlContentSource.
+
+    The reads are those of a UrlContentSource, through pool (a
+    urlpool.UrlSessionPool) if given."""
+
+    def __init__(self, url, mirrors=None, user_agent=None,
+                 timeout=DEFAULT_TIMEOUT, pool=None):
+        url_reader = None
+        if user_agent is not None:
+            url_reader = functools.partial(cs.URL_READER,
+                                           user_agent=user_agent)
+        super(AsyncUrlContentSource, self).__init__(cs.UrlContentSource(
+            url, mirrors=mirrors, url_reader=url_reader, pool=pool,
+            timeout=timeout))
+
+
+class AsyncMirrorReader(object):
+    def __init__(self, policy=util.policy_read_signed):
+        self.policy = policy
+
+    async def load_products(self, path):
+        _, content = await self.read_json(path)
+        return util.load_content(content)
+
+    async def read_json(self, path):
+        async with self.source(path) as source:
+            raw = (await source.read()).decode('utf-8')
+        # policy may call out to gpg, so keep it off the loop.
+        payload = await _blocking(self.policy, content=raw, path=path)
+        return raw, payload
+
+    def source(self, path):
+        raise NotImplementedError()
+
+
+class AsyncUrlMirrorReader(AsyncMirrorReader):
+    """Async version of mirrors.UrlMirrorReader.
+
+    Sources are those of a UrlMirrorReader, so all of them share its
+    pool of pool_maxsize keep-alive connections per host.  close() it
+    when done."""
+
+    def __init__(self, prefix, mirrors=None, policy=util.policy_read_signed,
+                 user_agent=mirrors.DEFAULT_USER_AGENT,
+                 timeout=DEFAULT_TIMEOUT,
+                 pool_maxsize=DEFAULT_MAX_CONCURRENCY):
+        super(AsyncUrlMirrorReader, self).__init__(policy=policy)
+        # unlike UrlMirrorReader, a missing trailing / is always added, so
+        # source() never has to probe for it from the loop.
+        if not prefix.endswith("/"):
+            prefix += "/"
+        self.reader = _UrlMirrorReader(
+            prefix, mirrors=mirrors, policy=policy, user_agent=user_agent,
+            timeout=timeout, pool_maxsize=pool_maxsize)
+
+    @property
+    def prefix(self):
+        return self.reader.prefix
+
+    def source(self, path):
+        return AsyncContentSourceAdapter(self.reader.source(path))
+
+    def close(self):
+        self.reader.close()
+
+
+class AsyncObjectStoreMirrorReader(AsyncMirrorReader):
+    def __init__(self, objectstore, policy=util.policy_read_signed):
+        super(AsyncObjectStoreMirrorReader, self).__init__(policy=policy)
+        self.objectstore = objectstore
+
+    def source(self, path):
+        src = self.objectstore.source(path)
+        if isinstance(src, AsyncContentSource):
+            return src
+        return AsyncContentSourceAdapter(src)
+
+
+class AsyncObjectStore(object):
+    read_size = READ_BUFFER_SIZE
+
+    async def insert(self, path, reader, checksums=None, mutable=True,
+                     size=None):
+        # store content from await reader.read() into path
+        raise NotImplementedError()
+
+    async def insert_content(self, path, content, checksums=None,
+                             mutable=True):
+        await self.insert(path=path,
+                          reader=AsyncMemoryContentSource(content=content),
+                          checksums=checksums, mutable=mutable)
+
+    async def remove(self, path):
+        raise NotImplementedError()
+
+    def source(self, path):
+        # return an AsyncContentSource for the provided path
+        raise NotImplementedError()
+
+    async def exists_with_checksum(self, path, checksums=None):
+        if checksums is None:
+            return False
+        try:
+            cksum = checksum_util.SafeCheckSummer(checksums)
+            async with self.source(path) as rfp:
+                while True:
+                    buf = await rfp.read(self.read_size)
+                    cksum.update(buf)
+                    if len(buf) != self.read_size:
+                        break
+            return cksum.check()
+        except Exception:
+            return False
+
+
+class AsyncObjectStoreAdapter(AsyncObjectStore):
+    """Use a sync ObjectStore from async code.
+
+    Each insert runs the store's blocking insert in a pool of max_workers
+    threads, reading from the async source through a SyncContentSource.
+    That pool is separate from the loop's default executor, which async
+    sources may themselves be waiting on."""
+
+    def __init__(self, objectstore, max_workers=DEFAULT_MAX_CONCURRENCY):
+        self.store = objectstore
+        self.executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+
+    async def _call(self, func, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(func, *args, **kwargs))
+
+    async def insert(self, path, reader, checksums=None, mutable=True,
+                     size=None):
+        loop = asyncio.get_event_loop()
+        await self._call(self.store.insert, path,
+                         _sync_source(reader, loop),
+                         checksums=checksums, mutable=mutable, size=size)
+
+    async def insert_content(self, path, content, checksums=None,
+                             mutable=True):
+        await self._call(self.store.insert_content, path, content,
+                         checksums=checksums, mutable=mutable)
+
+    async def remove(self, path):
+        await self._call(self.store.remove, path)
+
+    def source(self, path):
+        return AsyncContentSourceAdapter(self.store.source(path))
+
+    async def exists_with_checksum(self, path, checksums=None):
+        return await self._call(self.store.exists_with_checksum, path,
+                                checksums=checksums)
+
+
+class AsyncFileStore(AsyncObjectStoreAdapter):
+    # async version of objectstores.FileStore.  inserts are those of a
+    # FileStore, so a partial download is resumed and the size of an item
+    # is checked as it is there.
+
+    def __init__(self, prefix, max_workers=DEFAULT_MAX_CONCURRENCY):
+        super(AsyncFileStore, self).__init__(objectstores.FileStore(prefix),
+                                             max_workers=max_workers)
+        self.prefix = prefix
+
+
+def _sync_source(reader, loop):
+    # a sync ContentSource for the async reader.  adapted sync sources are
+    # unwrapped, so the store reads (and resumes) them directly instead of
+    # through the loop.
+    if isinstance(reader, AsyncContentSourceAdapter):
+        return reader.cs
+    if isinstance(reader, AsyncChecksummingContentSource):
+        inner = _sync_source(reader.cs, loop)
+        if not isinstance(inner, SyncContentSource):
+            cksummer = reader.checksummer
+            return cs.ChecksummingContentSource(
+                inner, checksums={cksummer.algorithm: cksummer.expected},
+                size=reader.size)
+    return SyncContentSource(reader, loop)
+
+
+class _DeferredSource(cs.ContentSource):
+    # placeholder handed to the planning writer for an item; the transfer
+    # itself is done later from the async reader.
+    def __init__(self, path):
+        self.path = path
+        self.url = path
+
+    def close(self):
+        pass
+
+
+class _PrefetchedReader(mirrors.MirrorReader):
+    def __init__(self, metadata):
+        super(_PrefetchedReader, self).__init__(policy=None)
+        self.metadata = metadata
+
+    def read_json(self, path):
+        return self.metadata[path]
+
+    def source(self, path):
+        if path in self.metadata:
+            return cs.MemoryContentSource(url=path,
+                                          content=self.metadata[path][0])
+        return _DeferredSource(path)
+
+
+class _PlanStore(objectstores.ObjectStore):
+    # records the operations ObjectStoreMirrorWriter would make.
+    # 'data' holds the prefetched metadata of the target.
+    def __init__(self, data):
+        self.data = data
+        self.ops = []
+
+    def insert(self, path, reader, checksums=None, mutable=True, size=None):
+        if isinstance(reader, cs.MemoryContentSource):
+            content = reader.read()
+            self.data[path] = content
+            self.ops.append(('insert_content', path, content))
+        else:
+            self.ops.append(('insert', path, reader, checksums, mutable,
+                             size))
+
+    def remove(self, path):
+        self.data.pop(path, None)
+        self.ops.append(('remove', path))
+
+    def source(self, path):
+        if path not in self.data:
+            raise _enoent("%s not found" % path)
+        return cs.MemoryContentSource(url=path, content=self.data[path])
+
+
+class _PlanningMirrorWriter(mirrors.ObjectFilterMirror):
+    # reference counts are written once before each products or index
+    # file, as by ObjectStoreMirrorWriter.  the plan is only carried out
+    # after it is complete, so the journal is only emptied, as it would
+    # be at that point.
+    def _journal_rc(self, op, path, id_):
+        self._rc_journaled = True
+
+
+class AsyncObjectStoreMirrorWriter(object):
+    """Async counterpart of ObjectFilterMirror(config, objectstore).sync.
+
+    objectstore is an AsyncObjectStore.  sync() fetches all metadata
+    concurrently, decides what to do with the usual (sync) writer logic and
+    then transfers up to max_concurrency items at the same time."""
+
+    def __init__(self, config, objectstore,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        if config is None:
+            config = {}
+        self.config = config
+        self.store = objectstore
+        self.max_concurrency = max_concurrency
+
+    async def _load_store_data(self, path, data):
+        try:
+            async with self.store.source(path) as source:
+                data[path] = await source.read()
+        except IOError as e:
+            if not _is_enoent(e):
+                raise
+
+    async def _prefetch(self, planner, reader, path, metadata, data):
+        (content, payload) = await reader.read_json(path)
+        metadata[path] = (content, payload)
+        tree = util.load_content(payload)
+        fmt = tree.get("format")
+        if fmt == "products:1.0":
+            await self._load_store_data(
+                planner.products_data_path(tree['content_id']), data)
+        elif fmt == "index:1.0":
+            fetches = []
+            for content_id, entry in tree.get('index', {}).items():
+                if not planner.filter_index_entry(entry, tree, (content_id,)):
+                    continue
+                if (entry.get('path') and
+                        entry.get('format') in ("index:1.0", "products:1.0")):
+                    fetches.append(self._prefetch(
+                        planner, reader, entry['path'], metadata, data))
+            await _gather(fetches)
+
+    async def _transfer(self, reader, op):
+        (_, path, source, checksums, mutable, size) = op
+        if isinstance(source, cs.ChecksummingContentSource):
+            cksummer = source.checksummer
+            asrc = AsyncChecksummingContentSource(
+                reader.source(source.cs.path), size=source.size,
+                checksums={cksummer.algorithm: cksummer.expected})
+        else:
+            asrc = reader.source(source.path)
+        LOG.debug("inserting %s to %s", asrc.url, path)
+        await self.store.insert(path, asrc, checksums=checksums,
+                                mutable=mutable, size=size)
+
+    async def _execute(self, reader, ops):
+        sem = asyncio.Semaphore(self.max_concurrency)
+
+        async def bounded(op):
+            async with sem:
+                await self._transfer(reader, op)
+
+        batch = {}
+        for op in ops + [None]:
+            if op is not None and op[0] == 'insert':
+                # several items may share a path; store it once.
+                batch.setdefault(op[1], op)
+                continue
+            await _gather([bounded(bop) for bop in batch.values()])
+            batch = {}
+            if op is None:
+                break
+            if op[0] == 'insert_content':
+                await self.store.insert_content(op[1], op[2])
+            elif op[0] == 'remove':
+                await self.store.remove(op[1])
+
+    async def sync(self, reader, path):
+        planner = _PlanningMirrorWriter(config=self.config,
+                                        objectstore=_PlanStore({}))
+        metadata = {}
+        data = planner.store.data
+        await _gather([
+            self._prefetch(planner, reader, path, metadata, data),
+            self._load_store_data(planner._reference_count_data_path(),
+                                  data),
+            self._load_store_data(planner._reference_journal_data_path(),
+                                  data)])
+
+        # planning is all sync code, with no I/O but a lot of work on large
+        # streams, so it is kept off the loop.
+        await _blocking(planner.sync, _PrefetchedReader(metadata), path)
+        await self._execute(reader, planner.store.ops)
+
+
+async def _gather(coros):
+    # like asyncio.gather, but on failure cancel and wait for the others
+    # before raising the first error.
+    tasks = [asyncio.ensure_future(c) for c in coros]
+    if not tasks:
+        return []
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+# vi: ts=4 expandtab
@@ -0,0 +1,352 @@
+#   Copyright (C) 2026 Canonical Ltd.
+#
+#   Simplestreams is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+#   Simplestreams is distributed in the hope that it will be useful, but
+#   WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#   or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public
+#   License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with Simplestreams.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import simplestreams.contentsource as cs
+from simplestreams import checksum_util
+from simplestreams import util
+from simplestreams.log import LOG
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024 * 10
+TMP_DIR = "tmp"
+# partial blobs this old were left by a process that went away.
+STALE_TMP_AGE = 60 * 60 * 24
+
+
+def _lock(fp, exclusive=False):
+    # flock fp, shared or exclusive.  returns False if an exclusive lock
+    # is held elsewhere.  without fcntl there is no locking.
+    if fcntl is None:
+        return True
+    if not exclusive:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_SH)
+        return True
+    try:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError) as e:
+        if e.errno in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK):
+            return False
+        raise
+    return True
+
+
+def _same_file(fp, path):
+    # True if fp is still the file at path.
+    try:
+        st = os.stat(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return False
+    fst = os.fstat(fp.fileno())
+    return (st.st_dev, st.st_ino) == (fst.st_dev, fst.st_ino)
+
+
+class CachedContentSource(cs.UrlContentSource):
+    # a blob of the cache, read as a local file.  until it is closed it
+    # holds a shared lock on the blob, which keeps it from being evicted.
+    # pin is the blob, open and locked already; without one the lock is
+    # taken on open().
+    def __init__(self, path, url=None, pin=None):
+        super(CachedContentSource, self).__init__(url=path)
+        self.blob = path
+        self.source_url = url
+        self._pin = pin
+
+    def open(self):
+        if self._pin is None:
+            self._pin = open(self.blob, "rb")
+            _lock(self._pin)
+        return super(CachedContentSource, self).open()
+
+    def close(self):
+        super(CachedContentSource, self).close()
+        if self._pin is not None:
+            self._pin.close()
+            self._pin = None
+
+
+class FillingContentSource(cs.ContentSource):
+    # pass the content of csrc through, keeping a copy.  once all of it
+    # has been read, and it matches checksums and size, the copy is
+    # added to cache.  a reader that is closed and reopened where it left
+    # off (as ChecksummingContentSource retries do) keeps the copy going;
+    # one that is just closed leaves it for a later evict to remove.
+    def __init__(self, cache, csrc, checksums, size=None):
+        self.cache = cache
+        self.cs = csrc
+        self.checksums = checksums
+        self.size = None if size is None else int(size)
+        self.cksum = checksum_util.checksummer(checksums)
+        self.written = 0
+        self._tmp = None
+        self._done = False
+        self._closed = False
+
+    @property
+    def url(self):
+        return self.cs.url
+
+    @property
+    def resumable(self):
+        return getattr(self.cs, 'resumable', False)
+
+    @property
+    def at_offset(self):
+        return getattr(self.cs, 'at_offset', True)
+
+    def open(self):
+        return self.cs.open()
+
+    def set_start_pos(self, offset):
+        # a retry carries on where the copy ends.  anywhere else, give up
+        # on the copy.
+        if offset != self.written:
+            self._abandon()
+        self._closed = False
+        self.cs.set_start_pos(offset)
+
+    def _keep(self, data):
+        if self._closed:
+            # reopened without saying where, so the copy may not line up.
+            self._abandon()
+        if self._done:
+            return
+        if self._tmp is None:
+            self._tmp = self.cache.tempfile()
+        self._tmp.write(data)
+        self.cksum.update(data)
+        self.written += len(data)
+
+    def _ended(self, count, wanted):
+        # True if the content is known to be complete.
+        if self.size is not None:
+            return self.written >= self.size
+        return wanted is None or wanted < 0 or count < wanted
+
+    def _finish(self, count, wanted):
+        if self._done or not self._ended(count, wanted):
+            return
+        tmp = self._tmp
+        self._tmp = None
+        self._done = True
+        if tmp is None:
+            tmp = self.cache.tempfile()
+        tmp.close()
+        if ((self.size is not None and self.written != self.size) or
+                not self.cksum.check()):
+            LOG.debug("not caching %s: content does not match", self.url)
+            util.rm_f_file(tmp.name)
+            return
+        self.cache.add(tmp.name, self.checksums)
+
+    def fill_from(self, fpath):
+        # the content was read around this source, into fpath, and
+        # verified there.  cache a copy of that instead.  a copy rather
+        # than a link, so using the blob does not touch fpath.
+        if self._done:
+            return
+        self._abandon()
+        tmp = self.cache.tempfile()
+        tmp.close()
+        try:
+            shutil.copyfile(fpath, tmp.name)
+        except Exception:
+            util.rm_f_file(tmp.name)
+            raise
+        self.cache.add(tmp.name, self.checksums)
+
+    def _abandon(self):
+        self._done = True
+        if self._tmp is not None:
+            self._tmp.close()
+            util.rm_f_file(self._tmp.name)
+            self._tmp = None
+
+    def read(self, size=-1):
+        buf = self.cs.read(size)
+        self._keep(buf)
+        self._finish(len(buf), size)
+        return buf
+
+    def readinto(self, buf):
+        view = memoryview(buf)
+        count = self.cs.readinto(view)
+        self._keep(view[:count])
+        self._finish(count, len(view))
+        return count
+
+    def close(self):
+        self._closed = True
+        return self.cs.close()
+
+
+class BlobCache(object):
+    """Verified item content in a local directory, by checksum.
+
+    Blobs are only added once all of their content has been read and
+    found to match its checksums, and hits are served as local files.
+    When the blobs take more than max_size bytes the least recently
+    used ones are removed, except for those open at the time.  Blobs are
+    added by rename and pinned with flock, so several processes on the
+    host can share one cache directory.
+
+    The cache directory is walked on the first add() and then only when
+    a running total of its size goes over max_size.  Blobs added by
+    other processes are counted at the next walk."""
+
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self._total = None
+        self._lock = threading.Lock()
+
+    def blob_path(self, checksums):
+        # where content with checksums is kept, or None if checksums has
+        # nothing to key it by.
+        if not checksums:
+            return None
+        try:
+            cksum = checksum_util.checksummer(checksums)
+        except TypeError:
+            return None
+        if not cksum.expected:
+            return None
+        expected = cksum.expected.lower()
+        return os.path.join(self.path, cksum.algorithm, expected[:2],
+                            expected)
+
+    def source(self, checksums, url=None):
+        # a CachedContentSource for the blob with checksums, or None.  the
+        # blob is pinned from here on, not only once the source is opened,
+        # so it cannot be evicted before it is read or copied.
+        blob = self.blob_path(checksums)
+        if blob is None:
+            return None
+        try:
+            pin = open(blob, "rb")
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        try:
+            _lock(pin)
+            # an evict may have removed it between the open and the lock.
+            if not _same_file(pin, blob):
+                pin.close()
+                return None
+            # the mtime of a blob is when it was last used.
+            os.utime(blob, None)
+        except Exception:
+            pin.close()
+            raise
+        LOG.debug("using cached %s for %s", blob, url)
+        return CachedContentSource(blob, url=url, pin=pin)
+
+    def filling(self, csrc, checksums, size=None):
+        # csrc, through a FillingContentSource if its content could be
+        # cached.
+        if self.blob_path(checksums) is None:
+            return csrc
+        return FillingContentSource(self, csrc, checksums, size=size)
+
+    def tempfile(self):
+        tmp_d = os.path.join(self.path, TMP_DIR)
+        util.mkdir_p(tmp_d)
+        return tempfile.NamedTemporaryFile(dir=tmp_d, suffix=".part",
+                                           delete=False)
+
+    def add(self, tpath, checksums):
+        # move the verified content in tpath into the cache.
+        blob = self.blob_path(checksums)
+        size = os.path.getsize(tpath)
+        util.mkdir_p(os.path.dirname(blob))
+        os.rename(tpath, blob)
+        with self._lock:
+            if self._total is not None:
+                self._total += size
+                if self._total <= self.max_size:
+                    return
+        self.evict()
+
+    def _blobs(self):
+        # [(mtime, size, path)] of the blobs, removing stale temp files.
+        blobs = []
+        now = time.time()
+        for root, dirs, files in os.walk(self.path):
+            in_tmp = os.path.basename(root) == TMP_DIR
+            for fname in files:
+                fpath = os.path.join(root, fname)
+                try:
+                    st = os.stat(fpath)
+                except OSError as e:
+                    if e.errno == errno.ENOENT:
+                        continue
+                    raise
+                if in_tmp:
+                    if now - st.st_mtime > STALE_TMP_AGE:
+                        util.rm_f_file(fpath)
+                    continue
+                blobs.append((st.st_mtime, st.st_size, fpath))
+        return blobs
+
+    def evict(self, max_size=None):
+        # remove least recently used blobs until they total at most
+        # max_size bytes.  returns the paths removed.
+        if max_size is None:
+            max_size = self.max_size
+        blobs = sorted(self._blobs())
+        total = sum(size for _mtime, size, _path in blobs)
+        removed = []
+        for _mtime, size, fpath in blobs:
+            if total <= max_size:
+                break
+            try:
+                with open(fpath, "rb") as fp:
+                    if not _lock(fp, exclusive=True):
+                        LOG.debug("not evicting %s, it is in use", fpath)
+                        continue
+                    os.unlink(fpath)
+            except (IOError, OSError) as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            total -= size
+            removed.append(fpath)
+        with self._lock:
+            self._total = total
+        return removed
+
+
+def filling_source(reader):
+    # the FillingContentSource that reader reads through, or None.
+    if isinstance(reader, cs.ChecksummingContentSource):
+        reader = reader.cs
+    if isinstance(reader, FillingContentSource):
+        return reader
+    return None
+
+# vi: ts=4 expandtab
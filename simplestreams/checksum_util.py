@@ -15,6 +15,12 @@
 #   You should have received a copy of the GNU Affero General Public License
 #   along with Simplestreams.  If not, see <http://www.gnu.org/licenses/>.
 import hashlib
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 # these are in order of increasing preference
 CHECKSUMS = ("md5", "sha256", "sha512")
@@ -58,11 +64,127 @@ class checksummer(object):
     def check(self):
         return (self.expected is None or self.expected == self.hexdigest())
 
+    def close(self):
+        pass
+
     def __str__(self):
         return ("checksummer (algorithm=%s expected=%s)" %
                 (self.algorithm, self.expected))
 
 
+class MultiHasher(checksummer):
+    """Compute several checksums of the same data in one pass.
+
+    Each algorithm in algorithms (default all of CHECKSUMS) is updated
+    with every block.  algorithm, expected, hexdigest() and check() are
+    those of the strongest algorithm in checksums, as for checksummer,
+    or of the strongest computed one if checksums is empty.
+    hexdigests() returns all of them.
+
+    If threaded is True the hashing runs on a worker thread, at most two
+    blocks behind update(), so that reads, hashing and writes overlap
+    (hashlib releases the GIL for large blocks).  Read-only blocks
+    (bytes, views of a read-only mmap) are hashed as they are; writable
+    ones, which the caller may reuse, are first copied into one of two
+    buffers.  An error on the worker is raised by the next update() or
+    hexdigest().  hexdigest() waits for the worker, and close() stops it
+    when the result is not wanted."""
+
+    def __init__(self, checksums=None, algorithms=None, threaded=False):
+        checksums = checksums or {}
+        if algorithms is None:
+            algorithms = CHECKSUMS
+        wanted = [meth for meth in CHECKSUMS
+                  if meth in checksums and meth in ALGORITHMS]
+        if checksums and not wanted:
+            raise TypeError("Unable to find suitable hash algorithm")
+
+        self._hashers = dict((meth, hashlib.new(meth)) for meth in CHECKSUMS
+                             if meth in algorithms and meth in ALGORITHMS)
+        if wanted:
+            self.algorithm = wanted[-1]
+            if self.algorithm not in self._hashers:
+                self._hashers[self.algorithm] = hashlib.new(self.algorithm)
+        elif self._hashers:
+            self.algorithm = max(self._hashers, key=CHECKSUMS.index)
+        else:
+            raise TypeError("Unable to find suitable hash algorithm")
+        self._hasher = self._hashers[self.algorithm]
+        self.expected = checksums.get(self.algorithm, None)
+
+        self.threaded = threaded
+        self._worker = None
+        self._error = None
+
+    def _hash(self, data):
+        for hasher in self._hashers.values():
+            hasher.update(data)
+
+    def _run(self, full, free):
+        while True:
+            block = full.get()
+            if block is None:
+                return
+            (buf, data) = block
+            del block
+            if self._error is None:
+                try:
+                    self._hash(data)
+                except Exception as e:
+                    self._error = e
+            # let go of data before the buffer is handed back.
+            del data
+            free.put(buf)
+
+    def update(self, data):
+        if self._error is not None:
+            raise self._error
+        count = len(data)
+        if not count:
+            return
+        if not self.threaded:
+            self._hash(data)
+            return
+        if self._worker is None:
+            self._free = queue.Queue()
+            self._full = queue.Queue()
+            for _ in range(2):
+                self._free.put(bytearray())
+            self._worker = threading.Thread(
+                target=self._run, args=(self._full, self._free))
+            self._worker.daemon = True
+            self._worker.start()
+        buf = self._free.get()
+        view = memoryview(data)
+        if not view.readonly:
+            if len(buf) < count:
+                buf = bytearray(count)
+            memoryview(buf)[:count] = view
+            view = memoryview(buf)[:count]
+        self._full.put((buf, view))
+
+    def close(self):
+        # wait for the worker to hash what was queued, and stop it.
+        if self._worker is not None:
+            self._full.put(None)
+            self._worker.join()
+            self._worker = None
+
+    def _finish(self):
+        self.close()
+        if self._error is not None:
+            raise self._error
+
+    def hexdigest(self):
+        self._finish()
+        return self._hasher.hexdigest()
+
+    def hexdigests(self):
+        self._finish()
+        return dict((meth, hasher.hexdigest())
+                    for meth, hasher in self._hashers.items())
+
+
 def item_checksums(item):
     return {k: item[k] for k in CHECKSUMS if k in item}
 
@@ -0,0 +1,206 @@
+#   Copyright (C) 2026 Canonical Ltd.
+#
+#   Simplestreams is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+#   Simplestreams is distributed in the hope that it will be useful, but
+#   WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#   or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public
+#   License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with Simplestreams.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import json
+import os
+import sqlite3
+import threading
+
+from simplestreams import checksum_util
+from simplestreams.log import LOG
+
+XATTR_NAME = "user.simplestreams.checksums"
+
+_UNSUPPORTED = set(getattr(errno, name) for name in
+                   ('ENOTSUP', 'EOPNOTSUPP', 'ENOSYS', 'EPERM')
+                   if hasattr(errno, name))
+
+
+def stat_key(st):
+    # the identity of a file's content as far as stat can tell.
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1000000000)
+    return (st.st_dev, st.st_ino, st.st_size, mtime_ns)
+
+
+def _expected(checksums):
+    # (algorithm, hexdigest) that a checksummer for checksums would check.
+    if not checksums:
+        return (None, None)
+    try:
+        cksum = checksum_util.checksummer(checksums)
+    except TypeError:
+        return (None, None)
+    return (cksum.algorithm, cksum.expected)
+
+
+class ChecksumCache(object):
+    """Remember verified checksums of files, keyed by stat_key.
+
+    A file whose device, inode, size and mtime are unchanged since its
+    checksum was recorded is taken to still have it, so checking it is
+    a stat instead of a read.  Failures to read or write the cache are
+    logged and otherwise ignored."""
+
+    def lookup(self, fpath, key):
+        # return a dict of algorithm to hexdigest recorded for key.
+        raise NotImplementedError()
+
+    def store(self, fpath, key, checksums):
+        raise NotImplementedError()
+
+    def forget(self, fpath, key):
+        pass
+
+    def _key(self, fpath):
+        return stat_key(os.stat(fpath))
+
+    def check(self, fpath, checksums):
+        # True if fpath is known to match the checksums that a
+        # checksummer would verify.
+        (algorithm, expected) = _expected(checksums)
+        if expected is None:
+            return False
+        try:
+            found = self.lookup(fpath, self._key(fpath))
+        except (EnvironmentError, ValueError, sqlite3.Error) as e:
+            LOG.debug("checksum cache lookup of %s failed: %s", fpath, e)
+            return False
+        return found.get(algorithm) == expected
+
+    def record(self, fpath, checksums):
+        # record that fpath was verified against checksums.
+        (algorithm, expected) = _expected(checksums)
+        if expected is None:
+            return
+        try:
+            self.store(fpath, self._key(fpath), {algorithm: expected})
+        except (EnvironmentError, ValueError, sqlite3.Error) as e:
+            LOG.debug("checksum cache update of %s failed: %s", fpath, e)
+
+    def remove(self, fpath):
+        try:
+            self.forget(fpath, self._key(fpath))
+        except (EnvironmentError, sqlite3.Error) as e:
+            if getattr(e, 'errno', None) != errno.ENOENT:
+                LOG.debug("checksum cache removal of %s failed: %s", fpath, e)
+
+
+class XattrChecksumCache(ChecksumCache):
+    """Keep the checksums in an extended attribute of each file.
+
+    The entry goes away with the inode, and a copy of the file does not
+    inherit it as its inode differs.  If the filesystem does not support
+    user extended attributes the cache turns itself off."""
+
+    def __init__(self, name=XATTR_NAME):
+        self.name = name
+        self.enabled = hasattr(os, 'setxattr')
+
+    def _disable(self, e):
+        if getattr(e, 'errno', None) in _UNSUPPORTED:
+            LOG.debug("extended attributes not supported, not caching "
+                      "checksums: %s", e)
+            self.enabled = False
+            return True
+        return False
+
+    def _read(self, fpath, key):
+        try:
+            entry = json.loads(os.getxattr(fpath, self.name).decode('utf-8'))
+        except (EnvironmentError, ValueError) as e:
+            if getattr(e, 'errno', None) == errno.ENODATA:
+                return {}
+            if isinstance(e, EnvironmentError) and self._disable(e):
+                return {}
+            raise
+        if tuple(entry.get('key', ())) != key:
+            return {}
+        return entry.get('checksums', {})
+
+    def lookup(self, fpath, key):
+        if not self.enabled:
+            return {}
+        return self._read(fpath, key)
+
+    def store(self, fpath, key, checksums):
+        if not self.enabled:
+            return
+        found = self._read(fpath, key)
+        found.update(checksums)
+        data = json.dumps({'key': key, 'checksums': found}, sort_keys=True)
+        try:
+            os.setxattr(fpath, self.name, data.encode('utf-8'))
+        except EnvironmentError as e:
+            if not self._disable(e):
+                raise
+
+
+class SqliteChecksumCache(ChecksumCache):
+    """Keep the checksums in a sqlite database at path.
+
+    Use this where extended attributes are not available, or where the
+    files should not be touched.  Writes are not synced; losing recent
+    entries only costs reading those files again."""
+
+    def __init__(self, path):
+        self.path = path
+        self._db = None
+        self._lock = threading.Lock()
+
+    def _conn(self):
+        if self._db is None:
+            db = sqlite3.connect(self.path, isolation_level=None,
+                                 check_same_thread=False)
+            db.execute("PRAGMA synchronous=OFF")
+            db.execute("CREATE TABLE IF NOT EXISTS checksums ("
+                       "dev INTEGER, ino INTEGER, size INTEGER, "
+                       "mtime_ns INTEGER, algorithm TEXT, hexdigest TEXT, "
+                       "PRIMARY KEY (dev, ino, algorithm))")
+            self._db = db
+        return self._db
+
+    def lookup(self, fpath, key):
+        with self._lock:
+            rows = self._conn().execute(
+                "SELECT algorithm, hexdigest FROM checksums WHERE dev=? AND "
+                "ino=? AND size=? AND mtime_ns=?", key).fetchall()
+        return dict(rows)
+
+    def store(self, fpath, key, checksums):
+        with self._lock:
+            db = self._conn()
+            # entries for an older version of the inode are stale.
+            db.execute("DELETE FROM checksums WHERE dev=? AND ino=? AND "
+                       "NOT (size=? AND mtime_ns=?)", key)
+            for algorithm, hexdigest in checksums.items():
+                db.execute("INSERT OR REPLACE INTO checksums VALUES "
+                           "(?, ?, ?, ?, ?, ?)",
+                           key + (algorithm, hexdigest))
+
+    def forget(self, fpath, key):
+        with self._lock:
+            self._conn().execute(
+                "DELETE FROM checksums WHERE dev=? AND ino=?", key[:2])
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+# vi: ts=4 expandtab
@@ -15,12 +15,18 @@
 #   You should have received a copy of the GNU Affero General Public License
 #   along with Simplestreams.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
 import errno
 import io
 import os
+import random
 import sys
+import time
+import zlib
 
 from . import checksum_util
+from . import mirrorselect
+from .log import LOG
 
 if sys.version_info > (3, 0):
     import urllib.parse as urlparse
@@ -32,6 +38,21 @@ else:
     urllib_error = urllib_request
 
 READ_BUFFER_SIZE = 1024 * 10
+DECOMPRESS_READ_SIZE = 1024 * 64
+# seconds before the first in-process retry of an interrupted read.  the
+# wait doubles with each attempt, up to RETRY_MAX_DELAY.
+RETRY_DELAY = 1
+RETRY_MAX_DELAY = 30
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+# suffixes of the compressed variants of a metadata file (foo.json.xz)
+# that can be read here, best first, and the magic they start with.
+COMPRESSED_SUFFIXES = ('.xz', '.gz') if lzma else ('.gz',)
+_COMPRESSED_MAGIC = {'.xz': b'\xfd7zXZ\x00', '.gz': b'\x1f\x8b'}
 
 try:
     # We try to use requests because we can do gzip encoding with it.
@@ -61,6 +82,15 @@ class ContentSource(object):
     def read(self, size=-1):
         raise NotImplementedError()
 
+    def readinto(self, buf):
+        # read len(buf) bytes into the writable buffer buf and return the
+        # number of bytes read.  As with read(), a short count means the
+        # end of the content.  Subclasses override this to avoid the copy.
+        return _readinto_read(self, buf)
+
+    # True in subclasses that implement set_start_pos, even after a read.
+    resumable = False
+
     def set_start_pos(self, offset):
         """ Implemented if the ContentSource supports seeking within content.
         Used to resume failed transfers. """
@@ -83,8 +113,23 @@ class ContentSource(object):
 
 class UrlContentSource(ContentSource):
     fd = None
-
-    def __init__(self, url, mirrors=None, url_reader=None):
+    resumable = True
+
+    def __init__(self, url, mirrors=None, url_reader=None, pool=None,
+                 selector=None, timeout=None, stripe=False, headers=None,
+                 limiter=None):
+        """ If selector (a mirrorselect.MirrorSelector) is given, url and
+        mirrors are tried best first rather than in order, and a transfer
+        that fails or stalls part way is resumed from the next mirror.
+        timeout is the socket timeout for network readers; it defaults to
+        the selector's.
+
+        stripe means url and mirrors serve identical content and their
+        order was picked to spread load: the selector only moves unhealthy
+        mirrors to the back, and clone(rotate=n) starts at another one.
+
+        headers are extra request headers for network readers.  limiter,
+        a ratelimit.BandwidthLimiter, is charged for every byte read. """
         if mirrors is None:
             mirrors = []
         self.mirrors = mirrors
@@ -92,10 +137,24 @@ class UrlContentSource(ContentSource):
         self.url = url
         self.offset = None
         self.fd = None
+        self.pool = pool
+        self.selector = selector
+        self.stripe = stripe
+        self.headers = headers
+        self.limiter = limiter
+        if timeout is None and selector is not None:
+            timeout = selector.timeout
+        self.timeout = timeout
         if url_reader is None:
             self.url_reader = URL_READER
         else:
             self.url_reader = url_reader
+        # bytes returned since open, and the mirror they are coming from.
+        self.pos = 0
+        self._current = None
+        self._tried = []
+        self._xfer_start = 0
+        self._xfer_time = 0.0
 
     def _urlinfo(self, url):
         parsed = urlparse.urlparse(url)
@@ -111,12 +170,27 @@ class UrlContentSource(ContentSource):
         else:
             return (url, self.url_reader, (url,))
 
+    def _opener_kwargs(self, opener, offset):
+        okwargs = {'offset': offset}
+        if opener is not FileReader:
+            if self.pool is not None:
+                okwargs['pool'] = self.pool
+            if self.timeout is not None:
+                okwargs['timeout'] = self.timeout
+            if self.headers:
+                okwargs['headers'] = self.headers
+        return okwargs
+
     def _open(self):
+        if self.selector is not None:
+            return self._open_selected([self.input_url] + self.mirrors,
+                                       self.offset)
         for url in [self.input_url] + self.mirrors:
             try:
                 (normurl, opener, oargs) = self._urlinfo(url)
                 self.url = normurl
-                return opener(*oargs, offset=self.offset)
+                return opener(*oargs, **self._opener_kwargs(opener,
+                                                            self.offset))
             except IOError as e:
                 if e.errno != errno.ENOENT:
                     raise
@@ -126,6 +200,64 @@ class UrlContentSource(ContentSource):
         myerr.errno = errno.ENOENT
         raise myerr
 
+    def _open_selected(self, urls, offset, resuming=False):
+        # open the best of urls through the selector.  when resuming, a
+        # mirror that ignores the Range request is no use.
+        def opener(url):
+            (_, opener, oargs) = self._urlinfo(url)
+            fd = opener(*oargs, **self._opener_kwargs(opener, offset))
+            if resuming and not getattr(fd, 'at_offset', True):
+                fd.close()
+                raise mirrorselect.ResumeNotSupported(
+                    "%s does not support resuming at %d" % (url, offset))
+            return fd
+
+        (url, fd) = self.selector.open(urls, opener, ordered=self.stripe)
+        self._current = url
+        self.url = self._urlinfo(url)[0]
+        self._xfer_start = self.pos
+        self._xfer_time = 0.0
+        return fd
+
+    def _record_transfer(self):
+        if self.selector is not None and self._current is not None:
+            self.selector.record_transfer(
+                self._current, self.pos - self._xfer_start, self._xfer_time)
+
+    def _failover(self, exc):
+        # the current mirror failed mid transfer.  continue from the next
+        # best one at the same offset, or re-raise exc if there is none.
+        self.selector.record_failure(self._current, exc)
+        self._tried.append(self._current)
+        remaining = [u for u in [self.input_url] + self.mirrors
+                     if u not in self._tried]
+        offset = (self.offset or 0) + self.pos
+        try:
+            self.fd.close()
+        except Exception as e:
+            LOG.debug("closing failed reader for %s: %s", self.url, e)
+        self.fd = None
+        if not remaining:
+            raise exc
+        LOG.warn("reading %s failed at offset %d (%s), resuming from "
+                 "another mirror", self.url, offset, exc)
+        self.fd = self._open_selected(remaining, offset,
+                                      resuming=bool(offset))
+
+    def _transfer(self, func):
+        # call func(self.fd), failing over to other mirrors on error.
+        while True:
+            start = time.time()
+            try:
+                ret = func(self.fd)
+            except Exception as e:
+                if not mirrorselect.is_mirror_failure(e):
+                    raise
+                self._failover(e)
+                continue
+            self._xfer_time += time.time() - start
+            return ret
+
     def open(self):
         if self.fd is None:
             self.fd = self._open()
@@ -133,15 +265,71 @@ class UrlContentSource(ContentSource):
     def read(self, size=-1):
         if self.fd is None:
             self.open()
-        return self.fd.read(size)
+        if self.selector is None:
+            buf = self.fd.read(size)
+        else:
+            buf = self._transfer(lambda fd: fd.read(size))
+            self.pos += len(buf)
+        if self.limiter is not None:
+            self.limiter.consume(len(buf))
+        return buf
+
+    def readinto(self, buf):
+        if self.fd is None:
+            self.open()
+
+        def readinto(fd):
+            if hasattr(fd, 'readinto'):
+                return fd.readinto(buf)
+            return _readinto_read(fd, buf)
+
+        if self.selector is None:
+            count = readinto(self.fd)
+        else:
+            count = self._transfer(readinto)
+            self.pos += count
+        if self.limiter is not None:
+            self.limiter.consume(count)
+        return count
 
     def set_start_pos(self, offset):
         if self.fd is not None:
             raise Exception("can't set start pos after open()")
         self.offset = offset
+        # start counting from the new offset, with every mirror available.
+        self.pos = 0
+        self._tried = []
+
+    @property
+    def at_offset(self):
+        # after open(), False if the server ignored the requested start pos
+        # and is sending the content from the beginning.
+        return getattr(self.fd, 'at_offset', True)
+
+    @property
+    def status(self):
+        # after open(), the response status if the reader has one.
+        return getattr(self.fd, 'status', None)
+
+    @property
+    def response_headers(self):
+        return getattr(self.fd, 'response_headers', {})
+
+    def clone(self, rotate=0):
+        # return a new, unopened, UrlContentSource for the same content.
+        # rotate moves that many urls from the front of the list to the end.
+        urls = [self.input_url] + self.mirrors
+        rotate %= len(urls)
+        urls = urls[rotate:] + urls[:rotate]
+        return self.__class__(urls[0], mirrors=urls[1:],
+                              url_reader=self.url_reader, pool=self.pool,
+                              selector=self.selector, timeout=self.timeout,
+                              stripe=self.stripe, headers=self.headers,
+                              limiter=self.limiter)
 
     def close(self):
         if self.fd:
+            self._record_transfer()
             self.fd.close()
             self.fd = None
 
@@ -154,17 +342,103 @@ class FdContentSource(ContentSource):
     def read(self, size=-1):
         return self.fd.read(size)
 
+    def readinto(self, buf):
+        if hasattr(self.fd, 'readinto'):
+            return _readinto_fd(self.fd, buf)
+        return _readinto_read(self.fd, buf)
+
     def close(self):
         self.fd.close()
 
 
+class ChunkBuffer(object):
+    """Buffer over an iterator of byte chunks.
+
+    Chunks are queued as they arrive and handed out through memoryview
+    slices, so reading n bytes copies each byte once regardless of how
+    the chunk boundaries fall."""
+
+    def __init__(self, r_iter):
+        self.r_iter = r_iter
+        self.chunks = collections.deque()
+        # bytes queued in chunks, and the read position in chunks[0]
+        self.buffered = 0
+        self.offset = 0
+        self.consumed = False
+
+    def _fill(self, size):
+        # queue chunks until size bytes are buffered (all if size < 0)
+        while not self.consumed and (size < 0 or self.buffered < size):
+            try:
+                chunk = next(self.r_iter)
+            except StopIteration:
+                self.consumed = True
+                break
+            if chunk:
+                self.chunks.append(chunk)
+                self.buffered += len(chunk)
+
+    def _take(self, size):
+        # remove up to size bytes from the front of the queue, returned
+        # as a list of memoryviews.
+        parts = []
+        while size > 0 and self.chunks:
+            chunk = self.chunks[0]
+            avail = len(chunk) - self.offset
+            if avail <= size:
+                parts.append(memoryview(chunk)[self.offset:])
+                self.chunks.popleft()
+                self.offset = 0
+                self.buffered -= avail
+                size -= avail
+            else:
+                end = self.offset + size
+                parts.append(memoryview(chunk)[self.offset:end])
+                self.offset += size
+                self.buffered -= size
+                size = 0
+        return parts
+
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+        self._fill(size)
+        if size < 0 or size > self.buffered:
+            size = self.buffered
+        if not size:
+            return bytes()
+
+        chunk = self.chunks[0]
+        if (self.offset == 0 and len(chunk) == size and
+                isinstance(chunk, bytes)):
+            # exactly one whole chunk, hand it out without a copy.
+            self.chunks.popleft()
+            self.buffered -= size
+            return chunk
+        parts = self._take(size)
+        if sys.version_info < (3, 0):
+            # python2 str.join does not take memoryviews
+            parts = [part.tobytes() for part in parts]
+        return bytes().join(parts)
+
+    def readinto(self, buf):
+        # fill buf from the queue, returning the number of bytes written.
+        # less than len(buf) is only returned at the end of the stream.
+        view = memoryview(buf)
+        self._fill(len(view))
+        pos = 0
+        for part in self._take(len(view)):
+            view[pos:pos + len(part)] = part
+            pos += len(part)
+        return pos
+
+
 class IteratorContentSource(ContentSource):
     def __init__(self, itgen, url=None):
         self.itgen = itgen
         self.url = url
         self.r_iter = None
-        self.leftover = bytes()
-        self.consumed = False
+        self.buffer = None
 
     def open(self):
         if self.r_iter:
@@ -178,49 +452,84 @@ class IteratorContentSource(ContentSource):
                 enoent.errno = errno.ENOENT
                 raise enoent
             raise exc
+        self.buffer = ChunkBuffer(iter(self.r_iter))
 
     def is_enoent(self, exc):
         return (isinstance(exc, IOError) and exc.errno == errno.ENOENT)
 
     def read(self, size=None):
         self.open()
+        return self.buffer.read(size)
 
-        if self.consumed:
-            return bytes()
+    def readinto(self, buf):
+        self.open()
+        return self.buffer.readinto(buf)
 
-        if (size is None or size < 0):
-            # read everything
-            ret = self.leftover
-            self.leftover = bytes()
-            for buf in self.r_iter:
-                ret += buf
-            self.consumed = True
-            return ret
+    def close(self):
+        pass
 
-        ret = bytes()
 
-        if self.leftover:
-            if len(self.leftover) > size:
-                ret = self.leftover[0:size]
-                self.leftover = self.leftover[size:]
-                return ret
-            ret = self.leftover
-            self.leftover = bytes()
+class DecompressingContentSource(ContentSource):
+    """Decompress the .gz or .xz content of csrc as it is read.
 
-        while True:
-            try:
-                ret += next(self.r_iter)
-                if len(ret) >= size:
-                    self.leftover = ret[size:]
-                    ret = ret[0:size]
-                    break
-            except StopIteration:
-                self.consumed = True
-                break
-        return ret
+    If the content does not start with the format's magic it is passed
+    through as is, as happens when a server sends foo.json.gz with a
+    gzip Content-Encoding that the url reader already decoded."""
+
+    def __init__(self, csrc, suffix):
+        if suffix not in COMPRESSED_SUFFIXES:
+            raise ValueError("unsupported compression '%s'" % suffix)
+        self.cs = csrc
+        self.suffix = suffix
+        self.buffer = None
+
+    def _decompressor(self):
+        if self.suffix == '.xz':
+            return lzma.LZMADecompressor()
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def _chunks(self):
+        data = self.cs.read(DECOMPRESS_READ_SIZE)
+        if not data.startswith(_COMPRESSED_MAGIC[self.suffix]):
+            while data:
+                yield data
+                data = self.cs.read(DECOMPRESS_READ_SIZE)
+            return
+        dobj = self._decompressor()
+        while data:
+            yield dobj.decompress(data)
+            data = self.cs.read(DECOMPRESS_READ_SIZE)
+        if hasattr(dobj, 'flush'):
+            yield dobj.flush()
+        if not getattr(dobj, 'eof', True):
+            raise IOError("%s: truncated %s content" % (self.url, self.suffix))
+
+    def open(self):
+        self.cs.open()
+        if self.buffer is None:
+            self.buffer = ChunkBuffer(self._chunks())
+
+    def read(self, size=-1):
+        self.open()
+        return self.buffer.read(size)
+
+    def readinto(self, buf):
+        self.open()
+        return self.buffer.readinto(buf)
 
     def close(self):
-        pass
+        return self.cs.close()
+
+    @property
+    def url(self):
+        return self.cs.url
+
+
+def decompressed(csrc, suffix):
+    # csrc, decompressed if suffix is one of COMPRESSED_SUFFIXES.
+    if not suffix:
+        return csrc
+    return DecompressingContentSource(csrc, suffix)
 
 
 class MemoryContentSource(FdContentSource):
@@ -234,18 +543,26 @@ class MemoryContentSource(FdContentSource):
 
 
 class ChecksummingContentSource(ContentSource):
-    def __init__(self, csrc, checksums, size=None):
+    def __init__(self, csrc, checksums, size=None, retries=0,
+                 retry_delay=RETRY_DELAY):
+        """ If reading csrc fails part way with a transient error (timeout,
+        connection reset, 5xx) or ends early, csrc is reopened at the
+        current offset with set_start_pos and reading goes on, up to
+        retries times in a row.  Retries wait retry_delay seconds, doubling
+        each time, with jitter.  The checksum keeps running throughout. """
         self.cs = csrc
         self.bytes_read = 0
         self.checksummer = None
         self.size = size
+        self.retries = retries
+        self.retry_delay = retry_delay
 
         try:
             csummer = checksum_util.SafeCheckSummer(checksums)
         except ValueError as e:
             raise checksum_util.invalid_checksum_for_reader(self, msg=str(e))
 
-        self._set_checksummer(csummer)
+        self.set_checksummer(csummer)
 
         try:
             self.size = int(size)
@@ -255,14 +572,14 @@ class ChecksummingContentSource(ContentSource):
 
     def resume(self, offset, checksummer):
         self.cs.set_start_pos(offset)
-        self._set_checksummer(checksummer)
+        self.set_checksummer(checksummer)
         self.bytes_read = offset
 
     @property
     def algorithm(self):
         return self.checksummer.algorithm
 
-    def _set_checksummer(self, checksummer):
+    def set_checksummer(self, checksummer):
         if checksummer.algorithm not in checksum_util.CHECKSUMS:
             raise ValueError("algorithm %s is not valid (%s)" %
                              (checksummer.algorithm, checksum_util.CHECKSUMS))
@@ -271,8 +588,55 @@ class ChecksummingContentSource(ContentSource):
     def check(self):
         return self.bytes_read == self.size and self.checksummer.check()
 
+    def _ended_early(self, size, count):
+        remaining = self.size - self.bytes_read
+        if size is not None and size >= 0:
+            remaining = min(size, remaining)
+        return count < remaining
+
+    def _reopen(self):
+        try:
+            self.cs.close()
+        except Exception as e:
+            LOG.debug("closing failed reader for %s: %s", self.url, e)
+        self.cs.set_start_pos(self.bytes_read)
+        self.cs.open()
+        if not getattr(self.cs, 'at_offset', True):
+            raise mirrorselect.ResumeNotSupported(
+                "%s does not support resuming at %d" %
+                (self.url, self.bytes_read))
+
+    def _transfer(self, func, size, count=len):
+        # return func(), which reads up to size bytes from self.cs.  on a
+        # transient error, or if the content ends early, self.cs is
+        # reopened at the current offset and func is called again.
+        # count(ret) is the number of bytes func read.
+        retries = self.retries if getattr(self.cs, 'resumable', False) else 0
+        attempt = 0
+        while True:
+            try:
+                if attempt:
+                    self._reopen()
+                ret = func()
+                got = count(ret)
+                if attempt < retries and self._ended_early(size, got):
+                    raise IOError("%s ended at %d of %d bytes" %
+                                  (self.url, self.bytes_read + got,
+                                   self.size))
+                return ret
+            except Exception as e:
+                if (attempt >= retries or
+                        not mirrorselect.is_mirror_failure(e)):
+                    raise
+                attempt += 1
+                delay = _backoff_delay(attempt, self.retry_delay)
+                LOG.warn("reading %s failed at offset %d (%s), retry %d of "
+                         "%d in %.1fs", self.url, self.bytes_read, e, attempt,
+                         retries, delay)
+                time.sleep(delay)
+
     def read(self, size=-1):
-        buf = self.cs.read(size)
+        buf = self._transfer(lambda: self.cs.read(size), size)
         buflen = len(buf)
         self.checksummer.update(buf)
         self.bytes_read += buflen
@@ -286,6 +650,21 @@ class ChecksummingContentSource(ContentSource):
             raise checksum_util.invalid_checksum_for_reader(self)
         return buf
 
+    def readinto(self, buf):
+        view = memoryview(buf)
+        # readinto returns the count itself, an int or (python2) a long.
+        count = self._transfer(lambda: self.cs.readinto(view), len(view),
+                               count=lambda ret: ret)
+        self.checksummer.update(view[:count])
+        self.bytes_read += count
+
+        if count != len(view) and self.size != self.bytes_read:
+            raise checksum_util.invalid_checksum_for_reader(self)
+
+        if self.bytes_read == self.size and not self.check():
+            raise checksum_util.invalid_checksum_for_reader(self)
+        return count
+
     def open(self):
         return self.cs.open()
 
@@ -298,9 +677,18 @@ class ChecksummingContentSource(ContentSource):
 
 
 class UrlReader(object):
+    # at_offset is False if an offset was requested but not honored.
+    at_offset = True
+    # the response status and headers, for readers that have them.
+    status = None
+    response_headers = {}
+
     def read(self, size=-1):
         raise NotImplementedError()
 
+    def readinto(self, buf):
+        return _readinto_read(self, buf)
+
     def close(self):
         raise NotImplementedError()
 
@@ -316,14 +704,33 @@ class FileReader(UrlReader):
     def read(self, size=-1):
         return _read_fd(self.fd, size)
 
+    def readinto(self, buf):
+        return _readinto_fd(self.fd, buf)
+
     def close(self):
         return self.fd.close()
 
 
 class Urllib2UrlReader(UrlReader):
-    def __init__(self, url, offset=None, user_agent=None):
+    def __init__(self, url, offset=None, user_agent=None, pool=None,
+                 timeout=None, headers=None):
         (url, username, password) = parse_url_auth(url)
         self.url = url
+
+        headers = dict(headers or {})
+        if user_agent is not None:
+            headers['User-Agent'] = user_agent
+        if offset is not None:
+            headers['Range'] = 'bytes=%d-' % offset
+
+        if pool is not None:
+            self.req = self._pool_open(pool, url, headers, username, password,
+                                       timeout)
+            self.status = self.req.status
+            self.response_headers = self.req.headers
+            self.at_offset = offset is None or self.status == 206
+            return
+
         if username is None:
             opener = urllib_request.urlopen
         else:
@@ -332,23 +739,51 @@ class Urllib2UrlReader(UrlReader):
             handler = urllib_request.HTTPBasicAuthHandler(mgr)
             opener = urllib_request.build_opener(handler).open
 
+        okwargs = {}
+        if timeout is not None:
+            okwargs['timeout'] = timeout
         try:
-            req = urllib_request.Request(url)
-            if user_agent is not None:
-                req.add_header('User-Agent', user_agent)
-            if offset is not None:
-                req.add_header('Range', 'bytes=%d-' % offset)
-            self.req = opener(req)
+            req = urllib_request.Request(url, headers=headers)
+            self.req = opener(req, **okwargs)
+            self.status = self.req.getcode()
+            self.response_headers = self.req.info()
+            self.at_offset = offset is None or self.status == 206
         except urllib_error.HTTPError as e:
+            if e.code == 304:
+                # a conditional request found nothing new.  urllib treats
+                # that as an error, but the error is the response.
+                self.req = e
+                self.status = e.code
+                self.response_headers = e.headers
+                return
             if e.code == 404:
                 myerr = IOError("Unable to open %s" % url)
                 myerr.errno = errno.ENOENT
                 raise myerr
             raise e
 
+    def _pool_open(self, pool, url, headers, username, password,
+                   timeout=None):
+        resp = pool.urlopen(url, headers=headers, username=username,
+                            password=password, timeout=timeout)
+        if resp.status < 400:
+            return resp
+        resp.close()
+        if resp.status == 404:
+            myerr = IOError("Unable to open %s" % url)
+            myerr.errno = errno.ENOENT
+            raise myerr
+        raise urllib_error.HTTPError(url, resp.status, resp.reason,
+                                     resp.headers, None)
+
     def read(self, size=-1):
         return _read_fd(self.req, size)
 
+    def readinto(self, buf):
+        if hasattr(self.req, 'readinto'):
+            return _readinto_fd(self.req, buf)
+        return _readinto_read(self.req, buf)
+
     def close(self):
         return self.req.close()
 
@@ -359,7 +794,8 @@ class RequestsUrlReader(UrlReader):
     # r = RequestsUrlReader(http://example.com)
     # r.read(10)
     # r.close()
-    def __init__(self, url, buflen=None, offset=None, user_agent=None):
+    def __init__(self, url, buflen=None, offset=None, user_agent=None,
+                 pool=None, timeout=None, headers=None):
         if requests is None:
             raise ImportError("Attempt to use RequestsUrlReader "
                               "without suitable requests library.")
@@ -370,7 +806,7 @@ class RequestsUrlReader(UrlReader):
         else:
             auth = (user, password)
 
-        headers = {}
+        headers = dict(headers or {})
         if user_agent is not None:
             headers['User-Agent'] = user_agent
         if offset is not None:
@@ -378,18 +814,28 @@ class RequestsUrlReader(UrlReader):
         if headers == {}:
             headers = None
 
-        self.req = requests.get(url, stream=True, auth=auth, headers=headers)
-        self.r_iter = None
+        if pool is None:
+            getter = requests.get
+        else:
+            getter = pool.requests_session.get
+        self.req = getter(url, stream=True, auth=auth, headers=headers,
+                          timeout=timeout)
+        self.buffer = None
         if buflen is None:
             buflen = READ_BUFFER_SIZE
         self.buflen = buflen
-        self.leftover = bytes()
-        self.consumed = False
 
         if (self.req.status_code == requests.codes.NOT_FOUND):
             myerr = IOError("Unable to open %s" % url)
             myerr.errno = errno.ENOENT
             raise myerr
+        if self.req.status_code >= 400:
+            self.req.close()
+            self.req.raise_for_status()
+        self.status = self.req.status_code
+        self.response_headers = self.req.headers
+        self.at_offset = (offset is None or
+                          self.req.status_code == requests.codes.PARTIAL)
 
         ce = self.req.headers.get('content-encoding', '').lower()
         if 'gzip' in ce or 'deflate' in ce:
@@ -401,42 +847,16 @@ class RequestsUrlReader(UrlReader):
         return self._read(size)
 
     def read_compressed(self, size=None):
-        if not self.r_iter:
-            self.r_iter = self.req.iter_content(self.buflen)
+        if not self.buffer:
+            self.buffer = ChunkBuffer(self.req.iter_content(self.buflen))
+        return self.buffer.read(size)
 
-        if self.consumed:
-            return bytes()
-
-        if (size is None or size < 0):
-            # read everything
-            ret = self.leftover
-            self.leftover = bytes()
-            for buf in self.r_iter:
-                ret += buf
-            self.consumed = True
-            return ret
-
-        ret = bytes()
-
-        if self.leftover:
-            if len(self.leftover) > size:
-                ret = self.leftover[0:size]
-                self.leftover = self.leftover[size:]
-                return ret
-            ret = self.leftover
-            self.leftover = bytes()
-
-        while True:
-            try:
-                ret += next(self.r_iter)
-                if len(ret) >= size:
-                    self.leftover = ret[size:]
-                    ret = ret[0:size]
-                    break
-            except StopIteration:
-                self.consumed = True
-                break
-        return ret
+    def readinto(self, buf):
+        if self._read == self.read_raw:
+            return _readinto_fd(self.req.raw, buf)
+        if not self.buffer:
+            self.buffer = ChunkBuffer(self.req.iter_content(self.buflen))
+        return self.buffer.readinto(buf)
 
     def read_raw(self, size=-1):
         return _read_fd(self.req.raw, size)
@@ -445,6 +865,13 @@ class RequestsUrlReader(UrlReader):
         self.req.close()
 
 
+def _backoff_delay(attempt, delay, max_delay=RETRY_MAX_DELAY):
+    # exponential backoff, half of it randomized so that transfers that
+    # failed together do not all retry together.
+    cap = min(max_delay, delay * 2 ** (attempt - 1))
+    return cap / 2.0 + random.uniform(0, cap / 2.0)
+
+
 def parse_url_auth(url):
     parsed = urlparse.urlparse(url)
     authtok = "%s:%s@" % (parsed.username, parsed.password)
@@ -462,6 +889,26 @@ def _read_fd(fd, size=-1):
     return fd.read(size)
 
 
+def _readinto_fd(fd, buf):
+    # fill buf from fd, which may return short reads before its end.
+    view = memoryview(buf)
+    pos = 0
+    while pos < len(view):
+        count = fd.readinto(view[pos:])
+        if not count:
+            break
+        pos += count
+    return pos
+
+
+def _readinto_read(reader, buf):
+    # readinto for readers that only provide read().
+    view = memoryview(buf)
+    data = reader.read(len(view))
+    view[:len(data)] = data
+    return len(data)
+
+
 if URL_READER_CLASSNAME == "RequestsUrlReader":
     URL_READER = RequestsUrlReader
 elif URL_READER_CLASSNAME == "Urllib2UrlReader":
@@ -81,7 +81,10 @@ def generate_index(trees, updated, namer):
     return index
 
 
-def write_streams(out_d, trees, updated, namer=None, condense=True):
+def write_streams(out_d, trees, updated, namer=None, condense=True,
+                  compress=()):
+    # compress is a list of suffixes ('.xz', '.gz') to also write each
+    # file compressed with; readers created with compressed=True use them.
     if namer is None:
         namer = FileNamer
     index = generate_index(trees, updated, namer)
@@ -98,13 +101,17 @@ def write_streams(out_d, trees, updated, namer=None, condense=True):
     for (outfile, data) in to_write:
         filef = os.path.join(out_d, outfile)
         util.mkdir_p(os.path.dirname(filef))
-        json_dump(data, filef)
-        out_filenames.append(filef)
+        out_filenames.extend(json_dump(data, filef, compress=compress))
     return out_filenames
 
 
-def json_dump(data, filename):
+def json_dump(data, filename, compress=()):
+    # write data to filename, and to filename + suffix for each suffix in
+    # compress.  returns the list of files written.
+    content = json.dumps(data, indent=2, sort_keys=True,
+                         separators=(',', ': ')) + "\n"
     with open(filename, "w") as fp:
         sys.stderr.write(u"writing %s\n" % filename)
-        fp.write(json.dumps(data, indent=2, sort_keys=True,
-                 separators=(',', ': ')) + "\n")
+        fp.write(content)
+    return [filename] + util.write_compressed(
+        filename, content.encode('utf-8'), compress)
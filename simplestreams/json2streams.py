@@ -7,6 +7,7 @@ import os
 import sys
 
 from simplestreams import util
+from simplestreams.contentsource import COMPRESSED_SUFFIXES
 
 from simplestreams.generate_simplestreams import (
     FileNamer,
@@ -47,7 +48,7 @@ def read_items_file(filename):
     return (dict_to_item(item) for item in item_list)
 
 
-def write_release_index(out_d):
+def write_release_index(out_d, compress=()):
     in_path = os.path.join(out_d, JujuFileNamer.get_index_path())
     with open(in_path) as in_file:
         full_index = json.load(in_file)
@@ -55,16 +56,19 @@ def write_release_index(out_d):
         (k, v) for k, v in list(full_index['index'].items())
         if k == 'com.ubuntu.juju:released:tools')
     out_path = os.path.join(out_d, FileNamer.get_index_path())
-    json_dump(full_index, out_path)
+    json_dump(full_index, out_path, compress=compress)
     return out_path
 
 
-def filenames_to_streams(filenames, updated, out_d, juju_format=False):
+def filenames_to_streams(filenames, updated, out_d, juju_format=False,
+                         compress=()):
     """Convert a list of filenames into simplestreams.
 
     File contents must be json simplestream stanzas.
     'updated' is the date to use for 'updated' in the streams.
     out_d is the directory to create streams in.
+    compress is a list of suffixes ('.xz', '.gz') to also write each
+    stream file compressed with.
     """
     items = []
     for items_file in filenames:
@@ -76,12 +80,15 @@ def filenames_to_streams(filenames, updated, out_d, juju_format=False):
         write = write_juju_streams
     else:
         write = write_streams
-    return write(out_d, trees, updated)
+    return write(out_d, trees, updated, compress=compress)
 
 
-def write_juju_streams(out_d, trees, updated):
-    out_filenames = write_streams(out_d, trees, updated, JujuFileNamer)
-    out_filenames.append(write_release_index(out_d))
+def write_juju_streams(out_d, trees, updated, compress=()):
+    out_filenames = write_streams(out_d, trees, updated, JujuFileNamer,
+                                  compress=compress)
+    release_index = write_release_index(out_d, compress=compress)
+    out_filenames.append(release_index)
+    out_filenames.extend(release_index + suffix for suffix in compress)
     return out_filenames
 
 
@@ -96,6 +103,11 @@ def parse_args(argv=None):
     parser.add_argument(
         '--juju-format', action='store_true',
         help='Write stream files in juju format.')
+    parser.add_argument(
+        '--compress', action='append', default=[],
+        choices=[s.lstrip('.') for s in COMPRESSED_SUFFIXES],
+        help='Also write each stream file compressed with this format. '
+             'May be given more than once.')
     return parser.parse_args(argv)
 
 
@@ -103,7 +115,8 @@ def main():
     args = parse_args()
     updated = util.timestamp()
     filenames_to_streams(args.items_file, updated, args.out_d,
-                         args.juju_format)
+                         args.juju_format,
+                         compress=['.' + c for c in args.compress])
 
 
 if __name__ == '__main__':
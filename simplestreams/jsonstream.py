@@ -0,0 +1,110 @@
+#   Copyright (C) 2026 Canonical Ltd.
+#
+#   Simplestreams is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+#   Simplestreams is distributed in the hope that it will be useful, but
+#   WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#   or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public
+#   License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with Simplestreams.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import re
+
+from json.decoder import scanstring
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_DECODER = json.JSONDecoder()
+# scans a value at C speed, throwing each object away as soon as it is
+# decoded instead of building the tree.
+_SKIPPER = json.JSONDecoder(object_pairs_hook=lambda pairs: None)
+
+
+def _skip_ws(text, pos):
+    return _WHITESPACE.match(text, pos).end()
+
+
+def _next_key(text, pos, first):
+    # pos is just after an object's '{' (first) or after one of its values.
+    # returns (key, position of its value), or (None, position after '}').
+    pos = _skip_ws(text, pos)
+    char = text[pos:pos + 1]
+    if char == '}':
+        return (None, pos + 1)
+    if not first:
+        if char != ',':
+            raise ValueError("Expecting ',' delimiter at char %d" % pos)
+        pos = _skip_ws(text, pos + 1)
+        char = text[pos:pos + 1]
+    if char != '"':
+        raise ValueError("Expecting property name at char %d" % pos)
+    (key, pos) = scanstring(text, pos + 1)
+    pos = _skip_ws(text, pos)
+    if text[pos:pos + 1] != ':':
+        raise ValueError("Expecting ':' delimiter at char %d" % pos)
+    return (key, _skip_ws(text, pos + 1))
+
+
+def _decode(text, pos):
+    return _DECODER.raw_decode(text, pos)
+
+
+def _skip_value(text, pos):
+    # return the position after the value at pos without keeping it.
+    return _SKIPPER.raw_decode(text, pos)[1]
+
+
+class ProductsStream(object):
+    """Decode a products:1.0 document one product at a time.
+
+    header is the document without its 'products', which is only scanned
+    up front.  Iterating yields (product_name, product) pairs, each
+    decoded as it is reached, so only one product's tree is built at a
+    time.  A document without 'products' (an index:1.0) is decoded
+    entirely into header."""
+
+    def __init__(self, text):
+        if isinstance(text, bytes):
+            text = text.decode('utf-8')
+        self.text = text
+        self.header = {}
+        self._products_pos = None
+
+        pos = _skip_ws(text, 0)
+        if text[pos:pos + 1] != '{':
+            raise ValueError("Expecting object at char %d" % pos)
+        pos += 1
+        first = True
+        while True:
+            (key, pos) = _next_key(text, pos, first)
+            first = False
+            if key is None:
+                break
+            if key == 'products' and text[pos:pos + 1] == '{':
+                self._products_pos = pos
+                pos = _skip_value(text, pos)
+            else:
+                (self.header[key], pos) = _decode(text, pos)
+        if _skip_ws(text, pos) != len(text):
+            raise ValueError("Extra data at char %d" % pos)
+
+    def __iter__(self):
+        if self._products_pos is None:
+            return
+        text = self.text
+        pos = self._products_pos + 1
+        first = True
+        while True:
+            (name, pos) = _next_key(text, pos, first)
+            first = False
+            if name is None:
+                return
+            (product, pos) = _decode(text, pos)
+            yield (name, product)
+
+# vi: ts=4 expandtab
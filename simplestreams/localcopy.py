@@ -0,0 +1,129 @@
+#   Copyright (C) 2026 Canonical Ltd.
+#
+#   Simplestreams is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+#   Simplestreams is distributed in the hope that it will be useful, but
+#   WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#   or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public
+#   License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with Simplestreams.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import os
+import shutil
+import sys
+
+import simplestreams.contentsource as cs
+from simplestreams import blobcache
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+if sys.version_info > (3, 0):
+    import urllib.parse as urlparse
+else:
+    import urlparse
+
+# linux ioctl to share the extents of one file with another (btrfs, xfs).
+FICLONE = 0x40049409
+COPY_SIZE = 1024 * 1024 * 8
+
+# errors that mean "this kernel or filesystem cannot do that", after which
+# the next, slower, method is tried.
+_UNSUPPORTED = set(getattr(errno, name) for name in
+                   ('EXDEV', 'ENOSYS', 'EINVAL', 'EOPNOTSUPP', 'ENOTSUP',
+                    'ENOTTY', 'EPERM', 'EMLINK', 'EBADF')
+                   if hasattr(errno, name))
+
+
+def source_path(reader):
+    # return the local file that reader would read from start to end, or
+    # None if it is not a plain file:// or path source.  a
+    # FillingContentSource is looked through, as a local file is not
+    # worth caching.
+    if isinstance(reader, cs.ChecksummingContentSource):
+        reader = reader.cs
+    if isinstance(reader, blobcache.FillingContentSource):
+        reader = reader.cs
+    if not isinstance(reader, cs.UrlContentSource):
+        return None
+    if reader.fd is not None or reader.offset:
+        return None
+    url = reader.input_url
+    parsed = urlparse.urlparse(url)
+    if parsed.scheme == "file":
+        path = parsed.path
+    elif not parsed.scheme:
+        path = url
+    else:
+        return None
+    if not os.path.isfile(path):
+        return None
+    return path
+
+
+def _reflink(rfp, wfp):
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(wfp.fileno(), FICLONE, rfp.fileno())
+    except (IOError, OSError) as e:
+        if e.errno in _UNSUPPORTED:
+            return False
+        raise
+    return True
+
+
+def _copy_file_range(rfp, wfp):
+    if not hasattr(os, 'copy_file_range'):
+        return False
+    remaining = os.fstat(rfp.fileno()).st_size
+    try:
+        while remaining > 0:
+            count = os.copy_file_range(rfp.fileno(), wfp.fileno(),
+                                       min(remaining, 1 << 30))
+            if count == 0:
+                break
+            remaining -= count
+    except OSError as e:
+        if e.errno not in _UNSUPPORTED:
+            raise
+        rfp.seek(0)
+        wfp.seek(0)
+        wfp.truncate()
+        return False
+    return True
+
+
+def copy_file(src, dst, hardlink=False):
+    """Make dst a copy of src, as cheaply as the filesystem allows.
+
+    If hardlink is True dst may be a hardlink to src, which then share
+    their content: later changes to src show up in dst.  Otherwise a
+    reflink clone is tried, then copy_file_range, then a plain copy.
+    Returns the method that was used."""
+    if hardlink:
+        try:
+            os.link(src, dst)
+            return "hardlink"
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+
+    with open(src, "rb") as rfp:
+        with open(dst, "wb") as wfp:
+            if _reflink(rfp, wfp):
+                return "reflink"
+            if _copy_file_range(rfp, wfp):
+                return "copy_file_range"
+            shutil.copyfileobj(rfp, wfp, COPY_SIZE)
+    return "copy"
+
+# vi: ts=4 expandtab
@@ -0,0 +1,106 @@
+#   Copyright (C) 2026 Canonical Ltd.
+#
+#   Simplestreams is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+#   Simplestreams is distributed in the hope that it will be useful, but
+#   WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#   or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public
+#   License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with Simplestreams.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import hashlib
+import json
+import os
+import tempfile
+
+from simplestreams import util
+from simplestreams.log import LOG
+
+NOT_MODIFIED = 304
+
+
+class MetadataCache(object):
+    """On-disk cache of index and products files for conditional GETs.
+
+    Each entry keeps the raw content of a url, the payload the reader's
+    policy returned for it (so signatures are not checked again) and the
+    ETag and Last-Modified validators the server sent.  namespace should
+    describe the policy (keyring, whether signatures were checked) so
+    that a payload accepted under one policy is not served to another."""
+
+    def __init__(self, path, namespace=""):
+        self.path = path
+        self.namespace = namespace
+
+    def _entry_path(self, url):
+        key = hashlib.sha256(
+            ("%s\n%s" % (self.namespace, url)).encode('utf-8')).hexdigest()
+        return os.path.join(self.path, key + ".json")
+
+    def get(self, url):
+        # return the cached entry for url, or None.
+        try:
+            with open(self._entry_path(url), "r") as fp:
+                entry = json.load(fp)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                LOG.warn("failed to read metadata cache for %s: %s", url, e)
+            return None
+        except ValueError as e:
+            LOG.warn("ignoring corrupt metadata cache for %s: %s", url, e)
+            return None
+        if entry.get('url') != url or entry.get('namespace') != self.namespace:
+            return None
+        return entry
+
+    def request_headers(self, entry):
+        # the conditional request headers to revalidate entry.
+        headers = {}
+        if entry is None:
+            return headers
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def put(self, url, content, payload, response_headers):
+        # store content and payload for url if the response can be
+        # revalidated later.
+        etag = response_headers.get('etag')
+        last_modified = response_headers.get('last-modified')
+        if not (etag or last_modified):
+            return
+        entry = {'url': url, 'namespace': self.namespace,
+                 'etag': etag, 'last_modified': last_modified,
+                 'content': content, 'payload': payload}
+        util.mkdir_p(self.path)
+        fpath = self._entry_path(url)
+        (tfd, tpath) = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(tfd, "wb") as fp:
+                fp.write(util.dump_data(entry))
+            os.rename(tpath, fpath)
+        except Exception:
+            util.rm_f_file(tpath)
+            raise
+
+    def remove(self, url):
+        util.rm_f_file(self._entry_path(url))
+
+
+def signed_policy_cache(path, keyring=None, checked=True):
+    # a MetadataCache in path for readers whose policy is util.read_signed
+    # with keyring and checked, or None if path is None.
+    if path is None:
+        return None
+    return MetadataCache(path, namespace="read_signed keyring=%s checked=%s"
+                         % (keyring, checked))
+
+# vi: ts=4 expandtab
@@ -17,34 +17,76 @@
 import errno
 import io
 import json
+import threading
+
+from concurrent import futures
 
 import simplestreams.filters as filters
 import simplestreams.util as util
 from simplestreams import checksum_util
 import simplestreams.contentsource as cs
+from simplestreams import jsonstream
+from simplestreams import metacache
+from simplestreams import mirrorselect
+from simplestreams import objectstores
+from simplestreams import urlpool
 from simplestreams.log import LOG
 
 DEFAULT_USER_AGENT = "python-simplestreams/0.1"
+# times an interrupted item download is resumed before giving up.
+DEFAULT_ITEM_RETRIES = 3
+# reference count changes written to the journal at a time on stores that
+# cannot append in place.
+JOURNAL_BATCH = 1000
 
 
 class MirrorReader(object):
-    def __init__(self, policy=util.policy_read_signed):
+    def __init__(self, policy=util.policy_read_signed, compressed=False):
         """ policy should be a function which returns the extracted payload or
-        raises an exception if the policy is violated. """
+        raises an exception if the policy is violated.
+
+        If compressed is True, read_json first looks for the .xz and .gz
+        variants of a file (foo.sjson.xz) and decompresses whichever one
+        exists, falling back to the file itself.  It may also be a list
+        of the suffixes to try. """
         self.policy = policy
+        self.compressed = compressed
 
     def load_products(self, path):
         _, content = self.read_json(path)
         return util.load_content(content)
 
     def read_json(self, path):
-        with self.source(path) as source:
-            raw = source.read().decode('utf-8')
+        def read(vpath, suffix):
+            with cs.decompressed(self.source(vpath), suffix) as source:
+                return source.read().decode('utf-8')
+        raw = self._read_variants(path, read)
         return raw, self.policy(content=raw, path=path)
 
+    def _read_variants(self, path, read):
+        # return read(vpath, suffix) for the first compressed variant of
+        # path that is available, or for path itself.
+        if self.compressed is True:
+            suffixes = cs.COMPRESSED_SUFFIXES
+        else:
+            suffixes = self.compressed or ()
+        for suffix in suffixes:
+            try:
+                return read(path + suffix, suffix)
+            except IOError as e:
+                # a broken mirror is not the same as a missing variant.
+                if mirrorselect.is_mirror_failure(e):
+                    raise
+                LOG.debug("no %s variant of %s: %s", suffix, path, e)
+        return read(path, None)
+
     def source(self, path):
         raise NotImplementedError()
 
+    def item_source(self, path, checksums=None, size=None):
+        # the source of an item whose content has checksums and size.
+        return self.source(path)
+
 
 class MirrorWriter(object):
     def load_products(self, path=None, content_id=None):
@@ -165,8 +207,36 @@ class MirrorWriter(object):
 
 class UrlMirrorReader(MirrorReader):
     def __init__(self, prefix, mirrors=None, policy=util.policy_read_signed,
-                 user_agent=DEFAULT_USER_AGENT):
-        super(UrlMirrorReader, self).__init__(policy=policy)
+                 user_agent=DEFAULT_USER_AGENT,
+                 pool_maxsize=urlpool.DEFAULT_POOL_MAXSIZE,
+                 timeout=None, select_mirrors=False, stripe=False,
+                 cache=None, limiter=None, compressed=False):
+        """ pool_maxsize is the number of keep-alive connections per host
+        shared by every source() of this reader.  0 or None disables
+        connection pooling.
+
+        timeout is the socket timeout in seconds for reads.  If
+        select_mirrors is True, prefix and mirrors are ranked by measured
+        latency and throughput instead of being tried in order, and a
+        transfer that stalls resumes from another mirror once the socket
+        times out (after mirrorselect.DEFAULT_TIMEOUT if timeout is None).
+
+        If stripe is True, prefix and mirrors must serve identical files.
+        Each source() then starts at the next healthy one in turn, so that
+        concurrent downloads (and the segments of a segmented download)
+        use all of them at once.  Metadata is still read from prefix
+        first.
+
+        cache, a metacache.MetadataCache, keeps index and products files
+        read by read_json and revalidates them with conditional requests,
+        so unchanged files are neither downloaded nor checked again.
+
+        limiter, a ratelimit.BandwidthLimiter, caps the combined rate of
+        all reads from sources of this reader.
+
+        compressed is passed to MirrorReader. """
+        super(UrlMirrorReader, self).__init__(policy=policy,
+                                              compressed=compressed)
         self._cs = cs.UrlContentSource
         if mirrors is None:
             mirrors = []
@@ -174,24 +244,85 @@ class UrlMirrorReader(MirrorReader):
         self.user_agent = user_agent
         self.prefix = prefix
         self._trailing_slash_checked = self.prefix.endswith("/")
-
-    def source(self, path):
-        mirrors = [m + path for m in self.mirrors]
-
-        if self.user_agent is not None:
-            # Create a custom UrlReader with the user_agent passed in,
-            # using the default cs.URL_READER.
-
-            def url_reader_factory(*args, **kwargs):
-                return cs.URL_READER(
-                    *args, user_agent=self.user_agent, **kwargs)
+        if pool_maxsize:
+            self.pool = urlpool.UrlSessionPool(maxsize=pool_maxsize)
+        else:
+            self.pool = None
+        self.stripe = stripe
+        self.cache = cache
+        self.limiter = limiter
+        self._stripe_next = 0
+        self._stripe_lock = threading.Lock()
+        if select_mirrors or stripe:
+            self.selector = mirrorselect.MirrorSelector(
+                [prefix] + list(mirrors), timeout=timeout)
+            # every read of this reader, not only those through the
+            # selector, gives up on a stalled connection.
+            timeout = self.selector.timeout
         else:
-            url_reader_factory = None
+            self.selector = None
+        self.timeout = timeout
 
-        if self._trailing_slash_checked:
-            return self._cs(self.prefix + path, mirrors=mirrors,
-                            url_reader=url_reader_factory)
+    def read_json(self, path):
+        if self.compressed and not self._trailing_slash_checked:
+            # only the uncompressed file is sure to exist.
+            self._check_trailing_slash(path, self._url_reader_factory())
+
+        def read(vpath, suffix):
+            return self._read_json(path, vpath, suffix)
+        return self._read_variants(path, read)
+
+    def _read_json(self, path, vpath, suffix):
+        url = self.prefix + vpath
+        entry = None
+        headers = None
+        if self.cache is not None:
+            entry = self.cache.get(url)
+            headers = self.cache.request_headers(entry)
+        with self._source(vpath, stripe=False, headers=headers) as source:
+            if entry is not None and source.status == metacache.NOT_MODIFIED:
+                LOG.debug("%s not modified, using cached copy", url)
+                return entry['content'], entry['payload']
+            raw = cs.decompressed(source, suffix).read().decode('utf-8')
+            if self.cache is not None:
+                response_headers = source.response_headers
+        payload = self.policy(content=raw, path=path)
+        if self.cache is not None:
+            self.cache.put(url, raw, payload, response_headers)
+        return raw, payload
+
+    def _stripe_order(self, urls):
+        # rotate the healthy urls so each call starts at the next one.
+        healthy = [u for u in urls if self.selector.is_healthy(u)]
+        unhealthy = [u for u in urls if u not in healthy]
+        if not healthy:
+            return urls
+        with self._stripe_lock:
+            start = self._stripe_next % len(healthy)
+            self._stripe_next += 1
+        return healthy[start:] + healthy[:start] + unhealthy
 
+    def source(self, path):
+        return self._source(path, stripe=self.stripe)
+
+    def _url_reader_factory(self):
+        if self.user_agent is None:
+            return None
+
+        # Create a custom UrlReader with the user_agent passed in,
+        # using the default cs.URL_READER.
+        def url_reader_factory(*args, **kwargs):
+            return cs.URL_READER(
+                *args, user_agent=self.user_agent, **kwargs)
+        return url_reader_factory
+
+    def _source(self, path, stripe=False, headers=None):
+        url_reader_factory = self._url_reader_factory()
+        if not self._trailing_slash_checked:
+            self._check_trailing_slash(path, url_reader_factory)
+        return self._mirrored_cs(path, url_reader_factory, stripe, headers)
+
+    def _check_trailing_slash(self, path, url_reader_factory):
         # A little hack to fix up the user's path. It's fairly common to
         # specify URLs without a trailing slash, so we try to do that here as
         # well. We open, then close and then get a new one (so the one we
@@ -199,7 +330,8 @@ class UrlMirrorReader(MirrorReader):
         self._trailing_slash_checked = True
         try:
             with self._cs(self.prefix + path, mirrors=None,
-                          url_reader=url_reader_factory) as csource:
+                          url_reader=url_reader_factory, pool=self.pool,
+                          timeout=self.timeout) as csource:
                 csource.read(1024)
         except Exception as e:
             if isinstance(e, IOError) and (e.errno == errno.ENOENT):
@@ -212,19 +344,63 @@ class UrlMirrorReader(MirrorReader):
                 LOG.debug("trailing / check on (%s, %s) resulted in %s",
                           self.prefix, path, e)
 
-        return self._cs(self.prefix + path, mirrors=mirrors,
-                        url_reader=url_reader_factory)
+    def _mirrored_cs(self, path, url_reader_factory, stripe, headers=None):
+        urls = [self.prefix + path] + [m + path for m in self.mirrors]
+        if stripe:
+            urls = self._stripe_order(urls)
+        return self._cs(urls[0], mirrors=urls[1:],
+                        url_reader=url_reader_factory, pool=self.pool,
+                        selector=self.selector, timeout=self.timeout,
+                        stripe=stripe, headers=headers,
+                        limiter=self.limiter)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+        if self.selector is not None:
+            self.selector.close()
 
 
 class ObjectStoreMirrorReader(MirrorReader):
-    def __init__(self, objectstore, policy=util.policy_read_signed):
-        super(ObjectStoreMirrorReader, self).__init__(policy=policy)
+    def __init__(self, objectstore, policy=util.policy_read_signed,
+                 compressed=False):
+        super(ObjectStoreMirrorReader, self).__init__(policy=policy,
+                                                      compressed=compressed)
         self.objectstore = objectstore
 
     def source(self, path):
         return self.objectstore.source(path)
 
 
+class CachingMirrorReader(MirrorReader):
+    """Read the items of reader through cache, a blobcache.BlobCache.
+
+    reader is any MirrorReader.  An item already in cache is read from
+    the local copy; one that is not is added to it as it is read, once
+    it has been verified.  Index and products files are read as reader
+    reads them."""
+
+    def __init__(self, reader, cache):
+        super(CachingMirrorReader, self).__init__(policy=reader.policy,
+                                                  compressed=reader.compressed)
+        self.reader = reader
+        self.cache = cache
+
+    def read_json(self, path):
+        return self.reader.read_json(path)
+
+    def source(self, path):
+        return self.reader.source(path)
+
+    def item_source(self, path, checksums=None, size=None):
+        cached = self.cache.source(checksums, url=path)
+        if cached is not None:
+            return cached
+        return self.cache.filling(
+            self.reader.item_source(path, checksums=checksums, size=size),
+            checksums, size=size)
+
+
 class BasicMirrorWriter(MirrorWriter):
     def __init__(self, config=None):
         super(BasicMirrorWriter, self).__init__()
@@ -233,6 +409,11 @@ class BasicMirrorWriter(MirrorWriter):
         self.config = config
         self.checksumming_reader = self.config.get('checksumming_reader', True)
 
+    # set to True (on a writer whose insert_item may be called from
+    # several threads at once) to honour 'max_parallel_downloads'.  it is
+    # not turned on for any class, so subclasses do not inherit it.
+    concurrent_items = False
+
     def load_products(self, path=None, content_id=None):
         super(BasicMirrorWriter, self).load_products(path, content_id)
 
@@ -258,12 +439,33 @@ class BasicMirrorWriter(MirrorWriter):
 
         self.insert_index(path, src, content)
 
-    def sync_products(self, reader, path=None, src=None, content=None):
+    def sync(self, reader, path):
+        if not self.config.get('stream_products'):
+            return super(BasicMirrorWriter, self).sync(reader, path)
+        content, payload = reader.read_json(path)
+        stream = jsonstream.ProductsStream(payload)
+        fmt = stream.header.get("format", "UNSPECIFIED")
+        if fmt == "products:1.0":
+            return self.sync_products(reader, path, stream.header, content,
+                                      stream=stream)
+        elif fmt == "index:1.0":
+            return self.sync_index(reader, path, stream.header, content)
+        else:
+            raise TypeError("Unknown format '%s' in '%s'" % (fmt, path))
+
+    def sync_products(self, reader, path=None, src=None, content=None,
+                      stream=None):
+        # stream, if given, is an iterable of (product_name, product) such
+        # as a jsonstream.ProductsStream, and src holds the other top level
+        # fields.  Each product is then filtered and synced as it comes,
+        # with src['products'] holding only that product.  This is what
+        # the 'stream_products' config does.
         (src, content) = _get_data_content(path, src, content, reader)
 
         util.expand_tree(src)
 
-        check_tree_paths(src)
+        if stream is None:
+            check_tree_paths(src)
 
         content_id = src['content_id']
         target = self.load_products(path, content_id)
@@ -272,117 +474,38 @@ class BasicMirrorWriter(MirrorWriter):
 
         util.expand_tree(target)
 
-        stree = src.get('products', {})
         if 'products' not in target:
             target['products'] = {}
 
         tproducts = target['products']
 
         filtered_products = []
-        prodname = None
-
-        # Apply filters to items before filtering versions
-        for prodname, product in list(stree.items()):
-
-            for vername, version in list(product.get('versions', {}).items()):
-                for itemname, item in list(version.get('items', {}).items()):
-                    pgree = (prodname, vername, itemname)
-                    if not self.filter_item(item, src, target, pgree):
-                        LOG.debug("Filtered out item: %s/%s", itemname, item)
-                        del stree[prodname]['versions'][vername]['items'][
-                            itemname]
-                        if not stree[prodname]['versions'][vername].get(
-                                'items', {}):
-                            del stree[prodname]['versions'][vername]
-                        if not stree[prodname].get('versions', {}):
-                            del stree[prodname]
-
-        for prodname, product in stree.items():
-            if not self.filter_product(product, src, target, (prodname,)):
-                filtered_products.append(prodname)
-                continue
-
-            if prodname not in tproducts:
-                tproducts[prodname] = util.stringitems(product)
-            tproduct = tproducts[prodname]
-            if 'versions' not in tproduct:
-                tproduct['versions'] = {}
-
-            src_filtered_items = []
-
-            def _filter(itemkey):
-                ret = self.filter_version(product['versions'][itemkey],
-                                          src, target, (prodname, itemkey))
-                if not ret:
-                    src_filtered_items.append(itemkey)
-                return ret
-
-            (to_add, to_remove) = util.resolve_work(
-                src=list(product.get('versions', {}).keys()),
-                target=list(tproduct.get('versions', {}).keys()),
-                maxnum=self.config.get('max_items'),
-                keep=self.config.get('keep_items'), itemfilter=_filter)
 
-            LOG.info("%s/%s: to_add=%s to_remove=%s", content_id, prodname,
-                     to_add, to_remove)
-
-            tversions = tproduct['versions']
-            skipped_versions = []
-            for vername in to_add:
-                version = product['versions'][vername]
-
-                if vername not in tversions:
-                    tversions[vername] = util.stringitems(version)
-
-                added_items = []
-                for itemname, item in version.get('items', {}).items():
-                    pgree = (prodname, vername, itemname)
-
-                    added_items.append(itemname)
-
-                    ipath = item.get('path', None)
-                    ipath_cs = None
-                    if ipath and reader:
-                        if self.checksumming_reader:
-                            flat = util.products_exdata(src, pgree)
-                            ipath_cs = cs.ChecksummingContentSource(
-                                csrc=reader.source(ipath),
-                                size=flat.get('size'),
-                                checksums=checksum_util.item_checksums(flat))
-                        else:
-                            ipath_cs = reader.source(ipath)
-
-                    self.insert_item(item, src, target, pgree, ipath_cs)
-
-                if len(added_items):
-                    # do not insert versions that had all items filtered
-                    self.insert_version(version, src, target,
-                                        (prodname, vername))
-                else:
-                    skipped_versions.append(vername)
-
-            for vername in skipped_versions:
-                if vername in tproduct['versions']:
-                    del tproduct['versions'][vername]
-
-            if self.config.get('delete_filtered_items', False):
-                tkeys = tproduct.get('versions', {}).keys()
-                for v in src_filtered_items:
-                    if v not in to_remove and v in tkeys:
-                        to_remove.append(v)
-                LOG.info("After deletions %s/%s: to_add=%s to_remove=%s",
-                         content_id, prodname, to_add, to_remove)
-
-            for vername in to_remove:
-                tversion = tversions[vername]
-                for itemname in list(tversion.get('items', {}).keys()):
-                    self.remove_item(tversion['items'][itemname], src, target,
-                                     (prodname, vername, itemname))
-
-                self.remove_version(tversion, src, target, (prodname, vername))
-                del tversions[vername]
-
-            self.insert_product(tproduct, src, target, (prodname,))
+        if stream is None:
+            stree = src.get('products', {})
+            # Apply filters to items before filtering versions
+            for prodname, product in list(stree.items()):
+                if not self._filter_items(src, target, prodname, product):
+                    del stree[prodname]
+
+            for prodname, product in stree.items():
+                if not self._sync_product(reader, src, target, prodname,
+                                          product):
+                    filtered_products.append(prodname)
+        else:
+            stree = set()
+            aliases = src.get(util.ALIASNAME)
+            for prodname, product in stream:
+                util.expand_data(product, aliases)
+                psrc = dict(src)
+                psrc['products'] = {prodname: product}
+                check_tree_paths(psrc)
+                if not self._filter_items(psrc, target, prodname, product):
+                    continue
+                stree.add(prodname)
+                if not self._sync_product(reader, psrc, target, prodname,
+                                          product):
+                    filtered_products.append(prodname)
 
         # FIXME: below will remove products if they're in target
         # (result of load_products) but not in the source products.
@@ -404,12 +527,212 @@ class BasicMirrorWriter(MirrorWriter):
 
         self.insert_products(path, target, content)
 
+    def _filter_items(self, src, target, prodname, product):
+        # remove the items of product that filter_item rejects, and the
+        # versions that leaves empty.  Returns False if product is left
+        # with no versions.
+        for vername, version in list(product.get('versions', {}).items()):
+            for itemname, item in list(version.get('items', {}).items()):
+                pgree = (prodname, vername, itemname)
+                if not self.filter_item(item, src, target, pgree):
+                    LOG.debug("Filtered out item: %s/%s", itemname, item)
+                    del version['items'][itemname]
+                    if not version.get('items', {}):
+                        del product['versions'][vername]
+                    if not product.get('versions', {}):
+                        return False
+        return True
+
+    def _sync_product(self, reader, src, target, prodname, product):
+        # sync the versions of product into target.  Returns False if
+        # filter_product rejected it.
+        if not self.filter_product(product, src, target, (prodname,)):
+            return False
+
+        content_id = src['content_id']
+        tproducts = target['products']
+        if prodname not in tproducts:
+            tproducts[prodname] = util.stringitems(product)
+        tproduct = tproducts[prodname]
+        if 'versions' not in tproduct:
+            tproduct['versions'] = {}
+
+        src_filtered_items = []
+
+        def _filter(itemkey):
+            ret = self.filter_version(product['versions'][itemkey],
+                                      src, target, (prodname, itemkey))
+            if not ret:
+                src_filtered_items.append(itemkey)
+            return ret
+
+        (to_add, to_remove) = util.resolve_work(
+            src=list(product.get('versions', {}).keys()),
+            target=list(tproduct.get('versions', {}).keys()),
+            maxnum=self.config.get('max_items'),
+            keep=self.config.get('keep_items'), itemfilter=_filter)
+
+        LOG.info("%s/%s: to_add=%s to_remove=%s", content_id, prodname,
+                 to_add, to_remove)
+
+        tversions = tproduct['versions']
+        skipped_versions = self._insert_versions(
+            reader, src, target, prodname, product, to_add)
+
+        for vername in skipped_versions:
+            if vername in tproduct['versions']:
+                del tproduct['versions'][vername]
+
+        if self.config.get('delete_filtered_items', False):
+            tkeys = tproduct.get('versions', {}).keys()
+            for v in src_filtered_items:
+                if v not in to_remove and v in tkeys:
+                    to_remove.append(v)
+            LOG.info("After deletions %s/%s: to_add=%s to_remove=%s",
+                     content_id, prodname, to_add, to_remove)
+
+        for vername in to_remove:
+            tversion = tversions[vername]
+            for itemname in list(tversion.get('items', {}).keys()):
+                self.remove_item(tversion['items'][itemname], src, target,
+                                 (prodname, vername, itemname))
+
+            self.remove_version(tversion, src, target, (prodname, vername))
+            del tversions[vername]
+
+        self.insert_product(tproduct, src, target, (prodname,))
+        return True
+
+    def _item_source(self, reader, src, item, pedigree):
+        ipath = item.get('path', None)
+        if not (ipath and reader):
+            return None
+        flat = util.products_exdata(src, pedigree)
+        checksums = checksum_util.item_checksums(flat)
+        csrc = reader.item_source(ipath, checksums=checksums,
+                                  size=flat.get('size'))
+        if not self.checksumming_reader:
+            return csrc
+        return cs.ChecksummingContentSource(
+            csrc=csrc, size=flat.get('size'), checksums=checksums,
+            retries=self.config.get('item_retries', DEFAULT_ITEM_RETRIES))
+
+    def _insert_versions(self, reader, src, target, prodname, product,
+                         to_add):
+        # insert the items of each version in to_add and then the version
+        # itself.  Returns the list of versions that had no items.
+        # If 'max_parallel_downloads' is > 1 and this writer supports it,
+        # insert_item calls run in a pool of that many threads.  Versions
+        # are still inserted in order, each once all its items completed.
+        tversions = target['products'][prodname]['versions']
+        work = []
+        for vername in to_add:
+            version = product['versions'][vername]
+            if vername not in tversions:
+                tversions[vername] = util.stringitems(version)
+            pgrees = [(prodname, vername, itemname)
+                      for itemname in version.get('items', {})]
+            work.append((vername, version, pgrees))
+
+        maxpar = self.config.get('max_parallel_downloads') or 1
+        if not self.concurrent_items or maxpar <= 1:
+            skipped_versions = []
+            for vername, version, pgrees in work:
+                for pgree in pgrees:
+                    item = version['items'][pgree[2]]
+                    self.insert_item(item, src, target, pgree,
+                                     self._item_source(reader, src, item,
+                                                       pgree))
+                self._finish_version(version, src, target,
+                                     (prodname, vername), pgrees,
+                                     skipped_versions)
+            return skipped_versions
+
+        with futures.ThreadPoolExecutor(max_workers=maxpar) as executor:
+            pending = []
+            for vername, version, pgrees in work:
+                vfutures = []
+                for pgree in pgrees:
+                    item = version['items'][pgree[2]]
+                    vfutures.append(executor.submit(
+                        self.insert_item, item, src, target, pgree,
+                        self._item_source(reader, src, item, pgree)))
+                pending.append((vername, version, vfutures))
+
+            skipped_versions = []
+            try:
+                for vername, version, vfutures in pending:
+                    for future in vfutures:
+                        future.result()
+                    self._finish_version(version, src, target,
+                                         (prodname, vername), vfutures,
+                                         skipped_versions)
+            except Exception:
+                # do not start any more transfers.  leaving the 'with'
+                # waits for the ones already running before re-raising.
+                for _vername, _version, vfutures in pending:
+                    for future in vfutures:
+                        future.cancel()
+                raise
+        return skipped_versions
+
+    def _finish_version(self, version, src, target, pedigree, added_items,
+                        skipped):
+        if len(added_items):
+            # do not insert versions that had all items filtered
+            self.insert_version(version, src, target, pedigree)
+        else:
+            skipped.append(pedigree[1])
+
 
 # ObjectStoreMirrorWriter stores data in <prefix>/.data/<content_id>
 class ObjectStoreMirrorWriter(BasicMirrorWriter):
-    def __init__(self, config, objectstore):
+    """Mirror into an ObjectStore.
+
+    Item reference counts are kept in memory while syncing.  Each change
+    is appended to a journal next to .data/references.json, and the
+    table is written out (and the journal emptied) once per products or
+    index file.  If a sync is interrupted the journal is replayed on top
+    of references.json when the table is next loaded.  Where the store
+    cannot append in place (S3, swift), changes are appended JOURNAL_BATCH
+    at a time; those not yet written when a sync is interrupted are made
+    again by the next sync, as the products file was not saved either.
+
+    If state is a statedb.SqliteMirrorState the target trees and the
+    references are kept there instead, one row per item and reference.
+    What is still only in the JSON files is imported as it is first
+    needed, and export_state() writes the JSON files back out.
+
+    Whether an item is already stored is decided from one inventory()
+    of the store, where the store can list itself, rather than by
+    asking the store about each item.  With a state, an item whose path
+    is referenced by a recorded item with the same checksums is taken
+    as stored without listing the store.
+
+    insert_item may be called from several threads at once, so callers
+    that do not override it can set concurrent_items."""
+
+    def __init__(self, config, objectstore, state=None):
         super(ObjectStoreMirrorWriter, self).__init__(config=config)
         self.store = objectstore
+        self.state = state
+        # _lock guards the target tree and reference counts, _path_locks
+        # keep two items with the same 'path' from being stored at once.
+        # loading the reference counts and writing the journal are store
+        # I/O, done under _rc_lock and _journal_lock instead.
+        self._lock = threading.Lock()
+        self._rc_lock = threading.Lock()
+        self._journal_lock = threading.Lock()
+        self._path_locks = {}
+        self._rc = None
+        self._rc_dirty = False
+        self._rc_journaled = False
+        self._journal = []
+        self._inventoried = False
+
+    def _path_lock(self, path):
+        with self._lock:
+            return self._path_locks.setdefault(path, threading.Lock())
 
     def products_data_path(self, content_id):
         return ".data/%s" % content_id
@@ -417,47 +740,136 @@ class ObjectStoreMirrorWriter(BasicMirrorWriter):
     def _reference_count_data_path(self):
         return ".data/references.json"
 
-    def _load_rc_dict(self):
+    def _reference_journal_data_path(self):
+        return ".data/references.journal"
+
+    def _read_data(self, path):
+        # content of path in the store, or None if it does not exist.
         try:
-            with self.source(self._reference_count_data_path()) as source:
-                raw = source.read()
-            return json.load(io.StringIO(raw.decode('utf-8')))
+            with self.source(path) as source:
+                return source.read()
         except IOError as e:
             if e.errno == errno.ENOENT:
-                return {}
+                return None
             raise
 
+    def _load_rc_dict(self):
+        if self.state is not None:
+            self._import_rc()
+            return self.state.references()
+        return self._load_rc_json()
+
+    def _import_rc(self):
+        # move the JSON reference counts into an empty state database.
+        if self._rc is not None:
+            return
+        with self._rc_lock:
+            if self._rc is not None:
+                return
+            if not self.state.has_references():
+                self.state.set_references(self._read_rc_json())
+            self._rc = {}
+
+    def _load_rc_json(self):
+        if self._rc is not None:
+            return self._rc
+        with self._rc_lock:
+            if self._rc is None:
+                self._rc = self._read_rc_json()
+            return self._rc
+
+    def _read_rc_json(self):
+        raw = self._read_data(self._reference_count_data_path())
+        rc = {}
+        if raw is not None:
+            rc = json.load(io.StringIO(raw.decode('utf-8')))
+        journal = self._read_data(self._reference_journal_data_path())
+        if journal is not None:
+            replayed = _replay_rc_journal(rc, journal)
+            LOG.info("replayed %d reference count changes from %s", replayed,
+                     self._reference_journal_data_path())
+            self._rc_journaled = True
+            self._rc_dirty = bool(replayed)
+        return rc
+
     def _persist_rc_dict(self, rc):
         source = cs.MemoryContentSource(content=json.dumps(rc))
         self.store.insert(self._reference_count_data_path(), source)
 
+    def _journal_rc(self, op, path, id_):
+        with self._journal_lock:
+            self._journal.append(json.dumps([op, path, id_]) + "\n")
+            if (self.store.appends_in_place or
+                    len(self._journal) >= JOURNAL_BATCH):
+                self.store.append_content(
+                    self._reference_journal_data_path(),
+                    "".join(self._journal))
+                self._journal = []
+                self._rc_journaled = True
+
+    def _flush_rc(self):
+        # write the reference count table and empty the journal.
+        if self.state is not None:
+            return
+        with self._lock:
+            rc = None
+            if self._rc_dirty:
+                rc = dict(self._rc)
+                self._rc_dirty = False
+        with self._journal_lock:
+            if rc is not None:
+                self._persist_rc_dict(rc)
+            # the table has the changes not yet journaled.
+            self._journal = []
+            if self._rc_journaled:
+                # emptied rather than removed; store.remove is for items.
+                self.store.insert_content(
+                    self._reference_journal_data_path(), b"")
+                self._rc_journaled = False
+
     def _build_rc_id(self, src, pedigree):
         return '/'.join([src['content_id']] + list(pedigree))
 
     def _inc_rc(self, path, src, pedigree):
-        rc = self._load_rc_dict()
         id_ = self._build_rc_id(src, pedigree)
-        if path not in rc:
-            rc[path] = [id_]
-        else:
-            rc[path].append(id_)
-        self._persist_rc_dict(rc)
+        if self.state is not None:
+            self._import_rc()
+            self.state.add_reference(path, id_)
+            return
+        rc = self._load_rc_dict()
+        with self._lock:
+            changed = _apply_rc(rc, "inc", path, id_)
+            if changed:
+                self._rc_dirty = True
+        if changed:
+            self._journal_rc("inc", path, id_)
 
     def _dec_rc(self, path, src, pedigree):
-        rc = self._load_rc_dict()
+        # returns True if nothing references path any more.
         id_ = self._build_rc_id(src, pedigree)
-        entry = rc.get(path, None)
-        ok_to_delete = False
-        if entry is not None:
-            if len(entry) == 1:
-                del rc[path]
-                ok_to_delete = True
-            else:
-                rc[path] = list(filter(lambda x: x != id_, rc[path]))
-            self._persist_rc_dict(rc)
-        return ok_to_delete
+        if self.state is not None:
+            self._import_rc()
+            if not self.state.reference_count(path):
+                return False
+            return self.state.remove_reference(path, id_) == 0
+        rc = self._load_rc_dict()
+        with self._lock:
+            if path not in rc:
+                return False
+            changed = _apply_rc(rc, "dec", path, id_)
+            if changed:
+                self._rc_dirty = True
+            gone = path not in rc
+        if changed:
+            self._journal_rc("dec", path, id_)
+        return gone
 
     def load_products(self, path=None, content_id=None):
+        if content_id and self.state is not None:
+            self._import_rc()
+            tree = self.state.load_products(content_id)
+            if tree is not None:
+                return tree
         if content_id:
             try:
                 dpath = self.products_data_path(content_id)
@@ -480,28 +892,76 @@ class ObjectStoreMirrorWriter(BasicMirrorWriter):
     def source(self, path):
         return self.store.source(path)
 
+    def _stored(self, path, checksums, size=None, mutable=True):
+        # True if the store's inventory shows path already has this
+        # content.  False if it does not, or the store cannot tell.  the
+        # store is listed afresh once per writer.
+        with self._lock:
+            if not self._inventoried:
+                self.store.inventory(refresh=True)
+                self._inventoried = True
+        found = self.store.inventory()
+        if found is None:
+            return False
+        return objectstores.inventory_matches(found.get(path), checksums,
+                                              size=size, mutable=mutable)
+
+    def _recorded(self, path, checksums, size=None):
+        # True if state records a referenced item stored at path with
+        # these checksums and size.
+        if self.state is None or not checksums:
+            return False
+        self._import_rc()
+        if not self.state.reference_count(path):
+            return False
+        for content_id, pedigree in self.state.items_with_path(path):
+            item = self.state.get_item(content_id, pedigree)
+            if item is None or str(item.get('size')) != str(size):
+                continue
+            if all(item.get(k) == v for k, v in checksums.items()):
+                return True
+        return False
+
     def insert_item(self, data, src, target, pedigree, contentsource):
-        util.products_set(target, data, pedigree)
+        with self._lock:
+            util.products_set(target, data, pedigree)
         if 'path' not in data:
             return
         if not self.config.get('item_download', True):
             return
-        LOG.debug("inserting %s to %s", contentsource.url, data['path'])
-        self.store.insert(data['path'], contentsource,
-                          checksums=checksum_util.item_checksums(data),
-                          mutable=False, size=data.get('size'))
+        checksums = checksum_util.item_checksums(data)
+        size = data.get('size')
+        with self._path_lock(data['path']):
+            if (self._recorded(data['path'], checksums, size=size) or
+                    self._stored(data['path'], checksums, size=size,
+                                 mutable=False)):
+                LOG.debug("%s is already stored", data['path'])
+                contentsource.close()
+            else:
+                LOG.debug("inserting %s to %s", contentsource.url,
+                          data['path'])
+                self.store.insert(data['path'], contentsource,
+                                  checksums=checksums, mutable=False,
+                                  size=size)
         self._inc_rc(data['path'], src, pedigree)
 
     def insert_index_entry(self, data, src, pedigree, contentsource):
         epath = data.get('path', None)
         if not epath:
             return
-        self.store.insert(epath, contentsource,
-                          checksums=checksum_util.item_checksums(data))
+        checksums = checksum_util.item_checksums(data)
+        if self._stored(epath, checksums):
+            contentsource.close()
+            return
+        self.store.insert(epath, contentsource, checksums=checksums)
 
     def insert_products(self, path, target, content):
-        dpath = self.products_data_path(target['content_id'])
-        self.store.insert_content(dpath, util.dump_data(target))
+        self._flush_rc()
+        if self.state is not None:
+            self.state.save_products(target)
+        else:
+            dpath = self.products_data_path(target['content_id'])
+            self.store.insert_content(dpath, util.dump_data(target))
         if not path:
             return
         if not content:
@@ -509,6 +969,7 @@ class ObjectStoreMirrorWriter(BasicMirrorWriter):
         self.store.insert_content(path, content)
 
     def insert_index(self, path, src, content):
+        self._flush_rc()
         if not path:
             return
         if not content:
@@ -522,6 +983,51 @@ class ObjectStoreMirrorWriter(BasicMirrorWriter):
         if self._dec_rc(data['path'], src, pedigree):
             self.store.remove(data['path'])
 
+    def export_state(self):
+        # write the trees and references in state to the JSON files that
+        # are used without it.
+        for content_id in self.state.content_ids():
+            self.store.insert_content(
+                self.products_data_path(content_id),
+                util.dump_data(self.state.load_products(content_id)))
+        self.store.insert_content(self._reference_count_data_path(),
+                                  json.dumps(self.state.references()))
+
+
+def _apply_rc(rc, op, path, id_):
+    # apply one reference count change to rc, returning True if it changed
+    # anything.  applying a change twice is the same as applying it once,
+    # so a journal can be replayed over a table it was already written to.
+    refs = rc.get(path, [])
+    if op == "inc":
+        if id_ in refs:
+            return False
+        rc[path] = refs + [id_]
+        return True
+    if id_ not in refs:
+        return False
+    refs = [ref for ref in refs if ref != id_]
+    if refs:
+        rc[path] = refs
+    else:
+        del rc[path]
+    return True
+
+
+def _replay_rc_journal(rc, journal):
+    # apply the changes in journal (json lists, one per line) to rc.  a
+    # torn last line from an interrupted write is ignored.
+    count = 0
+    for line in journal.decode('utf-8').splitlines():
+        try:
+            (op, path, id_) = json.loads(line)
+        except ValueError:
+            LOG.warn("ignoring incomplete reference journal entry: %s", line)
+            continue
+        if _apply_rc(rc, op, path, id_):
+            count += 1
+    return count
+
 
 class ObjectFilterMirror(ObjectStoreMirrorWriter):
     def __init__(self, *args, **kwargs):
@@ -542,6 +1048,10 @@ class DryRunMirrorWriter(ObjectFilterMirror):
     def noop(*args):
         pass
 
+    def _import_rc(self):
+        # a dry run leaves the state as it is.
+        self._rc = {}
+
     insert_index = noop
     insert_index_entry = noop
     insert_products = noop
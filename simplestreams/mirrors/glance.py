@@ -15,6 +15,7 @@
 #   You should have received a copy of the GNU Affero General Public License
 #   along with Simplestreams.  If not, see <http://www.gnu.org/licenses/>.
 
+import simplestreams.contentsource as cs
 import simplestreams.filters as filters
 import simplestreams.mirrors as mirrors
 import simplestreams.util as util
@@ -375,9 +376,21 @@ class GlanceMirror(mirrors.BasicMirrorWriter):
             def progress_wrapper(written):
                 pass
 
+        # md5 (what glance records) and the checksums of the item are all
+        # computed in the one pass over the download, off the read thread.
+        # a ChecksummingContentSource verifies with the same hasher.
+        hasher = checksum_util.MultiHasher(
+            checksum_util.item_checksums(image_stream_data), threaded=True)
+        local_hasher = hasher
+        if (isinstance(contentsource, cs.ChecksummingContentSource) and
+                contentsource.algorithm == hasher.algorithm):
+            contentsource.set_checksummer(hasher)
+            local_hasher = None
+
         try:
             tmp_path, _ = util.get_local_copy(
-                contentsource, progress_callback=progress_wrapper)
+                contentsource, progress_callback=progress_wrapper,
+                hasher=local_hasher)
 
             if self.modify_hook:
                 (new_size, new_md5) = call_hook(
@@ -385,8 +398,9 @@ class GlanceMirror(mirrors.BasicMirrorWriter):
                     cmd=self.modify_hook)
             else:
                 new_size = os.path.getsize(tmp_path)
-                new_md5 = image_stream_data.get('md5')
+                new_md5 = hasher.hexdigests()['md5']
         finally:
+            hasher.close()
             contentsource.close()
 
         return tmp_path, new_size, new_md5
@@ -659,13 +673,19 @@ class ItemInfoDryRunMirror(GlanceMirror):
 def _checksum_file(fobj, read_size=util.READ_SIZE, checksums=None):
     if checksums is None:
         checksums = {'md5': None}
-    cksum = checksum_util.checksummer(checksums=checksums)
-    while True:
-        buf = fobj.read(read_size)
-        cksum.update(buf)
-        if len(buf) != read_size:
-            break
-    return cksum.hexdigest()
+    cksum = checksum_util.MultiHasher(checksums, algorithms=(),
+                                      threaded=True)
+    buf = bytearray(read_size)
+    view = memoryview(buf)
+    try:
+        while True:
+            count = fobj.readinto(buf)
+            cksum.update(view[:count])
+            if count != read_size:
+                break
+        return cksum.hexdigest()
+    finally:
+        cksum.close()
 
 
 def call_hook(item, path, cmd):
@@ -0,0 +1,310 @@
+#   Copyright (C) 2026 Canonical Ltd.
+#
+#   Simplestreams is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+#   Simplestreams is distributed in the hope that it will be useful, but
+#   WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#   or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public
+#   License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with Simplestreams.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import sys
+import threading
+import time
+
+from concurrent import futures
+
+from simplestreams.log import LOG
+
+if sys.version_info > (3, 0):
+    import http.client as httplib
+else:
+    import httplib
+
+try:
+    import requests
+    _REQUEST_ERRORS = (requests.exceptions.RequestException,)
+    try:
+        import urllib3
+        _REQUEST_ERRORS += (urllib3.exceptions.HTTPError,)
+    except ImportError:
+        pass
+except ImportError:
+    _REQUEST_ERRORS = ()
+
+# seconds without any data before a read is considered stalled.
+DEFAULT_TIMEOUT = 60
+# seconds to wait for a response before also asking the next mirror.
+DEFAULT_HEDGE_DELAY = 2
+# consecutive failures that take a mirror out of rotation, and the seconds
+# it stays out before being given another chance.
+DEFAULT_FAILURE_THRESHOLD = 3
+DEFAULT_RESET_TIME = 60
+# weight of the newest sample in the moving averages.
+EWMA_WEIGHT = 0.3
+# mirrors are ranked by the expected time to fetch this many bytes.
+SCORE_BYTES = 1024 * 1024 * 16
+# threads shared by the hedged opens of all sources of a selector.
+DEFAULT_OPEN_WORKERS = 16
+
+_FAILURE_ERRORS = (EnvironmentError, httplib.HTTPException) + _REQUEST_ERRORS
+
+
+class ResumeNotSupported(IOError):
+    pass
+
+
+def is_mirror_failure(exc):
+    # True if exc says something about the health of the mirror (timeouts,
+    # connection errors, 5xx) rather than about the content requested.
+    if isinstance(exc, ResumeNotSupported):
+        return False
+    if not isinstance(exc, _FAILURE_ERRORS):
+        return False
+    if getattr(exc, 'errno', None) == errno.ENOENT:
+        return False
+    code = getattr(exc, 'code', None)
+    response = getattr(exc, 'response', None)
+    if code is None and response is not None:
+        code = getattr(response, 'status_code', None)
+    if isinstance(code, int) and code < 500:
+        return False
+    return True
+
+
+def _ewma(old, new):
+    if old is None:
+        return new
+    return (1 - EWMA_WEIGHT) * old + EWMA_WEIGHT * new
+
+
+class MirrorStats(object):
+    def __init__(self, base):
+        self.base = base
+        self.latency = None
+        self.throughput = None
+        self.failures = 0
+        self.tripped_at = None
+
+    def score(self):
+        # expected seconds to fetch SCORE_BYTES.  mirrors that have not been
+        # measured yet score 0 so that they get tried.
+        score = 0.0
+        if self.latency is not None:
+            score += self.latency
+        if self.throughput:
+            score += float(SCORE_BYTES) / self.throughput
+        return score
+
+    def __repr__(self):
+        return ("MirrorStats(base=%s, latency=%s, throughput=%s, failures=%s)"
+                % (self.base, self.latency, self.throughput, self.failures))
+
+
+class MirrorSelector(object):
+    """Rank equivalent mirrors by measured latency and throughput.
+
+    bases is the list of mirror url prefixes.  A mirror that fails
+    failure_threshold times in a row (timeouts, connection errors, 5xx)
+    is skipped for reset_time seconds.  open() asks the next mirror in
+    parallel if the first has not answered within hedge_delay seconds,
+    and timeout is passed on to url readers as their socket timeout.
+    Only opening is hedged: a transfer that stalls part way is noticed
+    when the socket times out, so a timeout of None means DEFAULT_TIMEOUT
+    rather than none."""
+
+    def __init__(self, bases, timeout=DEFAULT_TIMEOUT,
+                 hedge_delay=DEFAULT_HEDGE_DELAY,
+                 failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 reset_time=DEFAULT_RESET_TIME,
+                 workers=DEFAULT_OPEN_WORKERS):
+        self.bases = list(bases)
+        if timeout is None:
+            timeout = DEFAULT_TIMEOUT
+        self.timeout = timeout
+        self.hedge_delay = hedge_delay
+        self.failure_threshold = failure_threshold
+        self.reset_time = reset_time
+        self.workers = workers
+        self.stats = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        for base in self.bases:
+            self.stats[base] = MirrorStats(base)
+
+    def add_base(self, base):
+        with self._lock:
+            if base not in self.stats:
+                self.bases.append(base)
+                self.stats[base] = MirrorStats(base)
+
+    def base_for(self, url):
+        # the longest known base that url is under, or url itself.
+        found = None
+        for base in self.bases:
+            if url.startswith(base) and (found is None or
+                                         len(base) > len(found)):
+                found = base
+        return url if found is None else found
+
+    def _get_stats(self, url):
+        base = self.base_for(url)
+        with self._lock:
+            if base not in self.stats:
+                self.stats[base] = MirrorStats(base)
+            return self.stats[base]
+
+    def is_healthy(self, url):
+        stats = self._get_stats(url)
+        with self._lock:
+            if stats.tripped_at is None:
+                return True
+            if time.time() - stats.tripped_at >= self.reset_time:
+                # let one request through.  another failure trips it again.
+                stats.tripped_at = None
+                return True
+            return False
+
+    def rank(self, urls, ordered=False):
+        # return urls ordered best first.  mirrors that are tripped go last,
+        # they are still used if nothing else is left.  if ordered is True
+        # the healthy urls keep the order they were given in.
+        keyed = []
+        for pos, url in enumerate(urls):
+            healthy = self.is_healthy(url)
+            score = 0 if ordered else self._get_stats(url).score()
+            keyed.append((not healthy, score, pos, url))
+        return [k[-1] for k in sorted(keyed)]
+
+    def record_latency(self, url, seconds):
+        stats = self._get_stats(url)
+        with self._lock:
+            stats.latency = _ewma(stats.latency, seconds)
+            stats.failures = 0
+            stats.tripped_at = None
+
+    def record_transfer(self, url, size, seconds):
+        if size <= 0 or seconds <= 0:
+            return
+        stats = self._get_stats(url)
+        with self._lock:
+            stats.throughput = _ewma(stats.throughput, size / seconds)
+
+    def record_failure(self, url, exc=None):
+        stats = self._get_stats(url)
+        with self._lock:
+            stats.failures += 1
+            tripped = (stats.failures >= self.failure_threshold and
+                       stats.tripped_at is None)
+            if stats.failures >= self.failure_threshold:
+                stats.tripped_at = time.time()
+        if tripped:
+            LOG.warn("mirror %s failed %d times, skipping it for %ds: %s",
+                     stats.base, stats.failures, self.reset_time, exc)
+
+    def open(self, urls, opener, ordered=False):
+        """Return (url, opener(url)) for the best url that can be opened.
+
+        urls are tried in rank order (see rank for ordered).  If one has
+        not answered within hedge_delay seconds the next is started
+        alongside it and the first to succeed wins; the others are closed
+        when they finish.  If none succeed the last mirror failure is
+        raised, or ENOENT."""
+        queue = self.rank(urls, ordered=ordered)
+        running = {}
+        failure = None
+        winner = None
+        if len(queue) > 1:
+            submit = self._get_executor().submit
+        else:
+            # nothing to hedge with, so open in this thread.
+            submit = _call_now
+        try:
+            launch = True
+            while True:
+                if launch and queue:
+                    url = queue.pop(0)
+                    running[submit(opener, url)] = (url, time.time())
+                if not running:
+                    break
+                wait = self.hedge_delay if queue else None
+                done, _ = futures.wait(running, timeout=wait,
+                                       return_when=futures.FIRST_COMPLETED)
+                # a timeout means the running requests are slow, hedge.
+                launch = not done
+                for fut in done:
+                    url, start = running.pop(fut)
+                    try:
+                        result = fut.result()
+                    except Exception as e:
+                        if is_mirror_failure(e):
+                            self.record_failure(url, e)
+                            failure = e
+                        elif (getattr(e, 'errno', None) != errno.ENOENT and
+                              not isinstance(e, ResumeNotSupported)):
+                            failure = e
+                        LOG.debug("opening %s failed: %s", url, e)
+                        launch = True
+                        continue
+                    if winner is None:
+                        self.record_latency(url, time.time() - start)
+                        winner = (url, result)
+                    else:
+                        _close_result(result)
+                if winner is not None:
+                    break
+        finally:
+            for fut in running:
+                fut.add_done_callback(_close_future)
+
+        if winner is not None:
+            return winner
+        if failure is not None:
+            raise failure
+        myerr = IOError("Unable to open any of %s" % urls)
+        myerr.errno = errno.ENOENT
+        raise myerr
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = futures.ThreadPoolExecutor(
+                    max_workers=self.workers)
+            return self._executor
+
+    def close(self):
+        # stop the open threads once they are idle.
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+
+def _call_now(func, *args):
+    # func(*args) as an already completed future.
+    fut = futures.Future()
+    try:
+        fut.set_result(func(*args))
+    except Exception as e:
+        fut.set_exception(e)
+    return fut
+
+
+def _close_result(result):
+    try:
+        result.close()
+    except Exception as e:
+        LOG.debug("closing unused response failed: %s", e)
+
+
+def _close_future(fut):
+    if not fut.cancelled() and fut.exception() is None:
+        _close_result(fut.result())
+
+# vi: ts=4 expandtab
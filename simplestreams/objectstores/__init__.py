@@ -15,19 +15,49 @@
 #   You should have received a copy of the GNU Affero General Public License
 #   along with Simplestreams.  If not, see <http://www.gnu.org/licenses/>.
 
+import calendar
+import collections
 import errno
+import hashlib
 import os
+import threading
+import time
 
 import simplestreams.contentsource as cs
 import simplestreams.util as util
+from simplestreams import blobcache
 from simplestreams import checksum_util
+from simplestreams import localcopy
+from simplestreams import segmented
 from simplestreams.log import LOG
 
-READ_BUFFER_SIZE = 1024 * 10
+# transfers copy through one buffer of this size, so it can be large.
+READ_BUFFER_SIZE = 1024 * 1024
+# content addressed FileStores keep one copy of each item here, by sha256.
+BLOB_DIR = ".blobs"
+# next to each blob, the paths of the items stored from it.
+BLOB_REFS_SUFFIX = ".refs"
+
+# what a listing of a store says about one object.  etag is the md5 of
+# the content where the store knows it, mtime is seconds since the epoch.
+StoredObject = collections.namedtuple('StoredObject',
+                                      ('size', 'etag', 'mtime'))
+
+# only guards creating each store's own inventory lock.  subclasses need
+# not call ObjectStore.__init__, so it cannot be made there.
+_NEW_LOCK = threading.Lock()
+
+# python2 has no os.scandir.
+_scandir = getattr(os, 'scandir', None)
 
 
 class ObjectStore(object):
     read_size = READ_BUFFER_SIZE
+    # True if append_content adds to path in place.  if False it rewrites
+    # the whole object, so it should be called rarely.
+    appends_in_place = False
+    _inventories = None
+    _inventory_lock = None
 
     def insert(self, path, reader, checksums=None, mutable=True, size=None):
         # store content from reader.read() into path, expecting result checksum
@@ -39,6 +69,19 @@ class ObjectStore(object):
         self.insert(path=path, reader=cs.MemoryContentSource(content=content),
                     checksums=checksums, mutable=mutable)
 
+    def append_content(self, path, content):
+        # append content to path, creating it if needed.  stores that
+        # cannot append rewrite the whole object.
+        if not isinstance(content, bytes):
+            content = content.encode('utf-8')
+        try:
+            with self.source(path) as source:
+                content = source.read() + content
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        self.insert_content(path, content)
+
     def remove(self, path):
         # remove path from store
         raise NotImplementedError()
@@ -52,8 +95,51 @@ class ObjectStore(object):
                                   checksums=checksums,
                                   read_size=self.read_size)
 
+    def list_objects(self, prefix=""):
+        # yield (path, StoredObject) for each object whose path starts
+        # with prefix.
+        raise NotImplementedError()
+
+    def inventory(self, prefix="", refresh=False):
+        """Return a dict of path to StoredObject for the objects under
+        prefix, or None if the store cannot list its objects.
+
+        The store is listed once, in as few requests as it allows, and
+        the result kept: later calls (and inventoried()) answer from it
+        without any I/O until refresh is True.  Objects removed through
+        the store are dropped from it; objects inserted since are not
+        added, so it may only be out of date in the safe direction."""
+        with _NEW_LOCK:
+            if self._inventory_lock is None:
+                self._inventory_lock = threading.Lock()
+        with self._inventory_lock:
+            if self._inventories is None:
+                self._inventories = {}
+            if refresh or prefix not in self._inventories:
+                try:
+                    found = dict(self.list_objects(prefix))
+                except NotImplementedError:
+                    found = None
+                self._inventories[prefix] = found
+            return self._inventories[prefix]
+
+    def inventoried(self, path):
+        # (True, StoredObject or None) if an inventory already taken
+        # covers path, else (False, None).
+        for prefix, found in (self._inventories or {}).items():
+            if found is not None and path.startswith(prefix):
+                return (True, found.get(path))
+        return (False, None)
+
+    def _uninventory(self, path):
+        for found in (self._inventories or {}).values():
+            if found is not None:
+                found.pop(path, None)
+
 
 class MemoryObjectStore(ObjectStore):
+    appends_in_place = True
+
     def __init__(self, data=None):
         super(MemoryObjectStore, self).__init__()
         if data is None:
@@ -64,9 +150,22 @@ class MemoryObjectStore(ObjectStore):
         self.data[path] = reader.read()
         reader.close()
 
+    def append_content(self, path, content):
+        if not isinstance(content, bytes):
+            content = content.encode('utf-8')
+        self.data[path] = self.data.get(path, b'') + content
+
     def remove(self, path):
         # remove path from store
         del self.data[path]
+        self._uninventory(path)
+
+    def list_objects(self, prefix=""):
+        for path, content in list(self.data.items()):
+            if path.startswith(prefix):
+                yield (path, StoredObject(len(content),
+                                          hashlib.md5(content).hexdigest(),
+                                          None))
 
     def source(self, path):
         try:
@@ -77,14 +176,46 @@ class MemoryObjectStore(ObjectStore):
 
 
 class FileStore(ObjectStore):
+    appends_in_place = True
 
-    def __init__(self, prefix, complete_callback=None):
+    def __init__(self, prefix, complete_callback=None, segments=1,
+                 segment_min_size=segmented.DEFAULT_MIN_SIZE,
+                 hardlink=False, checksum_cache=None, rehash=False,
+                 content_addressed=False):
         """ complete_callback is called periodically to notify users when a
         file is being inserted. It takes three arguments: the path that is
         inserted, the number of bytes downloaded, and the number of total
-        bytes. """
+        bytes.
+
+        If segments is greater than 1, http(s) items of at least
+        segment_min_size bytes are downloaded as that many concurrent
+        Range requests.
+
+        Items read from local files are cloned or copied by the kernel
+        rather than read through python.  If hardlink is True they may be
+        hardlinked instead, so the store shares their inode with the
+        source.
+
+        checksum_cache, if given, is a checksumcache.ChecksumCache that
+        remembers the checksums of files already verified, so an unchanged
+        file is not read again to check it.  Without one files are always
+        read.  If rehash is True files are always read, and the cache is
+        only updated.
+
+        If content_addressed is True, immutable items with a sha256 are
+        also kept once in BLOB_DIR under prefix, and an item whose blob
+        is already there is hardlinked (or reflinked) from it without
+        reading reader at all.  A blob is checked against its sha256 (or
+        checksum_cache) before it is used.  remove_unused_blobs() removes
+        the blobs no item is stored from any more. """
         self.prefix = prefix
         self.complete_callback = complete_callback
+        self.segments = segments
+        self.segment_min_size = segment_min_size
+        self.hardlink = hardlink
+        self.checksum_cache = checksum_cache or None
+        self.rehash = rehash
+        self.content_addressed = content_addressed
 
     def insert(self, path, reader, checksums=None, mutable=True, size=None,
                sparse=False):
@@ -94,16 +225,32 @@ class FileStore(ObjectStore):
             if not mutable:
                 # if the file exists, and not mutable, return
                 return
-            if has_valid_checksum(path=path, reader=self.source,
-                                  checksums=checksums,
-                                  read_size=self.read_size):
+            if self.exists_with_checksum(path, checksums):
                 return
 
+        blob = None
+        if self.content_addressed and not mutable:
+            blob = self._blob_path(checksums)
+        if (blob is not None and
+                self._link_blob(blob, wpath, checksums, size)):
+            LOG.debug("%s is already stored as %s", path, blob)
+            reader.close()
+            if self.complete_callback and size is not None:
+                self.complete_callback(path, int(size), int(size))
+            return
+
+        buf = bytearray(self.read_size)
+        view = memoryview(buf)
         zeros = None
         if sparse is True:
-            zeros = '\0' * self.read_size
+            zeros = memoryview(b'\0' * self.read_size)
 
-        cksum = checksum_util.checksummer(checksums)
+        if checksums:
+            # hash on a worker thread while the next block is read.
+            cksum = checksum_util.MultiHasher(checksums, algorithms=(),
+                                              threaded=True)
+        else:
+            cksum = checksum_util.checksummer(checksums)
         out_d = os.path.dirname(wpath)
         partfile = os.path.join(out_d, "%s.part" % os.path.basename(wpath))
 
@@ -113,6 +260,15 @@ class FileStore(ObjectStore):
             isinstance(reader, cs.ChecksummingContentSource) and
             cksum.algorithm == reader.algorithm)
 
+        if not os.path.exists(partfile):
+            if ((not sparse and self._insert_local(path, reader, partfile,
+                                                   checksums, size)) or
+                    self._insert_segmented(path, reader, partfile, checksums,
+                                           size)):
+                os.rename(partfile, wpath)
+                self._inserted(wpath, checksums, reader, blob)
+                return
+
         if os.path.exists(partfile):
             try:
                 orig_part_size = os.path.getsize(partfile)
@@ -125,9 +281,9 @@ class FileStore(ObjectStore):
                           orig_part_size, path, partfile)
                 with open(partfile, "rb") as fp:
                     while True:
-                        buf = fp.read(self.read_size)
-                        cksum.update(buf)
-                        if len(buf) != self.read_size:
+                        count = fp.readinto(buf)
+                        cksum.update(view[:count])
+                        if count != self.read_size:
                             break
 
             except NotImplementedError:
@@ -135,38 +291,44 @@ class FileStore(ObjectStore):
                 orig_part_size = 0
                 os.unlink(partfile)
 
-        with open(partfile, "ab") as wfp:
-
-            while True:
-                try:
-                    buf = reader.read(self.read_size)
-                except checksum_util.InvalidChecksum:
-                    break
-                buflen = len(buf)
-                if (buflen != self.read_size and zeros is not None and
-                        zeros[0:buflen] == buf):
-                    wfp.seek(wfp.tell() + buflen)
-                elif buf == zeros:
-                    wfp.seek(wfp.tell() + buflen)
-                else:
-                    wfp.write(buf)
+        if reader_does_checksum and not orig_part_size:
+            reader.set_checksummer(cksum)
 
-                if not reader_does_checksum:
-                    cksum.update(buf)
+        # not "ab": sparse writes seek past runs of zeros, which append
+        # mode would ignore.
+        try:
+            with open(partfile, "r+b" if orig_part_size else "wb") as wfp:
+                wfp.seek(0, os.SEEK_END)
 
-                if size is not None:
-                    if self.complete_callback:
-                        self.complete_callback(path, wfp.tell(), size)
-                    if wfp.tell() > size:
-                        # file is too big, so the checksum won't match; we
-                        # might as well stop downloading.
+                while True:
+                    try:
+                        buflen = reader.readinto(buf)
+                    except checksum_util.InvalidChecksum:
                         break
+                    data = view[:buflen]
+                    if zeros is not None and zeros[:buflen] == data:
+                        wfp.seek(wfp.tell() + buflen)
+                    else:
+                        wfp.write(data)
+
+                    if not reader_does_checksum:
+                        cksum.update(data)
+
+                    if size is not None:
+                        if self.complete_callback:
+                            self.complete_callback(path, wfp.tell(), size)
+                        if wfp.tell() > size:
+                            # file is too big, so the checksum won't match;
+                            # we might as well stop downloading.
+                            break
 
-                if buflen != self.read_size:
-                    break
+                    if buflen != self.read_size:
+                        break
 
-            if zeros is not None:
-                wfp.truncate(wfp.tell())
+                if zeros is not None:
+                    wfp.truncate(wfp.tell())
+        finally:
+            cksum.close()
 
         reader.close()
 
@@ -184,8 +346,226 @@ class FileStore(ObjectStore):
                     LOG.warn(resume_msg)
                 raise checksum_util.InvalidChecksum(path=path, cksum=cksum)
         os.rename(partfile, wpath)
+        self._inserted(wpath, checksums, reader, blob)
+
+    def exists_with_checksum(self, path, checksums=None):
+        wpath = self._fullpath(path)
+        cache = self.checksum_cache
+        if cache is not None and not self.rehash:
+            if cache.check(wpath, checksums):
+                return True
+        if not has_valid_checksum(path=path, reader=self.source,
+                                  checksums=checksums,
+                                  read_size=self.read_size):
+            return False
+        if cache is not None:
+            cache.record(wpath, checksums)
+        return True
+
+    def _inserted(self, wpath, checksums, reader, blob=None):
+        # remember the checksum wpath was just verified against, and keep
+        # it as blob.
+        if blob is not None:
+            self._store_blob(wpath, blob)
+        if self.checksum_cache is None:
+            return
+        if isinstance(reader, cs.ChecksummingContentSource):
+            checksums = {reader.algorithm: reader.checksummer.expected}
+        self.checksum_cache.record(wpath, checksums)
+
+    def _blob_path(self, checksums):
+        sha256 = (checksums or {}).get('sha256')
+        if not sha256:
+            return None
+        sha256 = sha256.lower()
+        return os.path.join(self.prefix, BLOB_DIR, "sha256", sha256[:2],
+                            sha256)
+
+    def _link_blob(self, blob, wpath, checksums, size):
+        # make wpath a copy of blob if it exists and has the expected size
+        # and sha256.  returns False if it does not.
+        try:
+            st = os.stat(blob)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        if size is not None and st.st_size != int(size):
+            LOG.warn("ignoring blob %s of size %d, expected %s", blob,
+                     st.st_size, size)
+            return False
+        bpath = os.path.relpath(blob, self.prefix)
+        if not self.exists_with_checksum(
+                bpath, {'sha256': checksums['sha256']}):
+            LOG.warn("removing blob %s, its content does not match", blob)
+            util.rm_f_file(blob)
+            return False
+        util.mkdir_p(os.path.dirname(wpath))
+        tmp = "%s.part" % wpath
+        util.rm_f_file(tmp)
+        try:
+            localcopy.copy_file(blob, tmp, hardlink=True)
+            os.rename(tmp, wpath)
+        except Exception:
+            util.rm_f_file(tmp)
+            raise
+        self._add_blob_ref(blob, wpath)
+        return True
+
+    def _store_blob(self, wpath, blob):
+        if not os.path.exists(blob):
+            util.mkdir_p(os.path.dirname(blob))
+            tmp = "%s.%d.part" % (blob, os.getpid())
+            util.rm_f_file(tmp)
+            try:
+                localcopy.copy_file(wpath, tmp, hardlink=True)
+                os.rename(tmp, blob)
+            except Exception:
+                util.rm_f_file(tmp)
+                raise
+        self._add_blob_ref(blob, wpath)
+
+    def _add_blob_ref(self, blob, wpath):
+        with open(blob + BLOB_REFS_SUFFIX, "a") as fp:
+            fp.write(os.path.relpath(wpath, self.prefix) + "\n")
+
+    def _stored_from_blob(self, path, blob):
+        # True if the item at path still has the content of blob.  it may
+        # be a hardlink to it, or a reflink or copy.
+        try:
+            st = os.stat(self._fullpath(path))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        bst = os.stat(blob)
+        if (st.st_dev, st.st_ino) == (bst.st_dev, bst.st_ino):
+            return True
+        if st.st_size != bst.st_size:
+            return False
+        return self.exists_with_checksum(
+            path, {'sha256': os.path.basename(blob)})
+
+    def remove_unused_blobs(self):
+        # remove blobs that no item is stored from any more, going by the
+        # references kept next to them.  returns their paths.
+        removed = []
+        for root, _dirs, files in os.walk(os.path.join(self.prefix,
+                                                       BLOB_DIR)):
+            for fname in files:
+                if fname.endswith(BLOB_REFS_SUFFIX):
+                    continue
+                fpath = os.path.join(root, fname)
+                refs_path = fpath + BLOB_REFS_SUFFIX
+                try:
+                    with open(refs_path) as fp:
+                        refs = sorted(set(fp.read().splitlines()))
+                except IOError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    refs = []
+                used = [path for path in refs
+                        if self._stored_from_blob(path, fpath)]
+                if used:
+                    if used != refs:
+                        with open(refs_path, "w") as fp:
+                            fp.write("".join(p + "\n" for p in used))
+                    continue
+                os.unlink(fpath)
+                util.rm_f_file(refs_path)
+                removed.append(fpath)
+        return removed
+
+    def _insert_local(self, path, reader, partfile, checksums, size):
+        # copy a file backed reader into partfile without reading it
+        # through python, then verify it.  returns False if reader is not
+        # file backed.
+        src = localcopy.source_path(reader)
+        if src is None:
+            return False
+
+        if isinstance(reader, cs.ChecksummingContentSource):
+            checksums = {reader.algorithm: reader.checksummer.expected}
+            size = reader.size
+
+        try:
+            method = localcopy.copy_file(src, partfile, hardlink=self.hardlink)
+        except Exception:
+            util.rm_f_file(partfile)
+            raise
+        finally:
+            reader.close()
+        LOG.debug("%s of %s to %s", method, src, partfile)
+
+        try:
+            segmented.verify_file(partfile, checksums, size=size, path=path)
+        except checksum_util.InvalidChecksum:
+            os.unlink(partfile)
+            raise
+        if self.complete_callback and size is not None:
+            self.complete_callback(path, int(size), int(size))
+        return True
+
+    def _insert_segmented(self, path, reader, partfile, checksums, size):
+        # download reader into partfile in segments and verify it.
+        # returns False if that was not possible, and nothing was done.
+        if self.segments <= 1 or size is None:
+            return False
+        if int(size) < self.segment_min_size:
+            return False
+        source = segmented.can_segment(reader)
+        if source is None:
+            return False
+
+        if isinstance(reader, cs.ChecksummingContentSource):
+            checksums = {reader.algorithm: reader.checksummer.expected}
+            size = reader.size
+
+        if self.complete_callback:
+            def progress(written):
+                self.complete_callback(path, written, int(size))
+        else:
+            progress = None
+
+        downloader = segmented.SegmentedDownloader(
+            source, size, segments=self.segments,
+            progress_callback=progress)
+        try:
+            downloader.download(partfile)
+        except segmented.RangeNotSupported as e:
+            LOG.debug("%s, not using segments", e)
+            os.unlink(partfile)
+            return False
+        except Exception:
+            os.unlink(partfile)
+            raise
+        finally:
+            reader.close()
+
+        try:
+            segmented.verify_file(partfile, checksums, size=size, path=path)
+        except checksum_util.InvalidChecksum:
+            os.unlink(partfile)
+            raise
+        filling = blobcache.filling_source(reader)
+        if filling is not None:
+            filling.fill_from(partfile)
+        return True
+
+    def append_content(self, path, content):
+        if not isinstance(content, bytes):
+            content = content.encode('utf-8')
+        wpath = self._fullpath(path)
+        util.mkdir_p(os.path.dirname(wpath))
+        with open(wpath, "ab") as fp:
+            fp.write(content)
+            fp.flush()
+            os.fsync(fp.fileno())
 
     def remove(self, path):
+        self._uninventory(path)
+        if self.checksum_cache is not None:
+            self.checksum_cache.remove(self._fullpath(path))
         try:
             os.unlink(self._fullpath(path))
         except OSError as e:
@@ -205,21 +585,93 @@ class FileStore(ObjectStore):
     def source(self, path):
         return cs.UrlContentSource(url=self._fullpath(path))
 
+    def list_objects(self, prefix=""):
+        # one walk of the directories under prefix.  partial downloads
+        # are not objects.  the etag is left None rather than reading
+        # each file for its md5, so a mutable file is never matched from
+        # the inventory; insert() checks it with exists_with_checksum
+        # (and checksum_cache, if there is one).
+        top = self._fullpath(os.path.dirname(prefix))
+        for fpath, st in _walk_files(top):
+            path = os.path.relpath(fpath, self.prefix).replace(os.sep, "/")
+            if not path.startswith(prefix) or path.endswith(".part"):
+                continue
+            yield (path, StoredObject(st.st_size, None, st.st_mtime))
+
     def _fullpath(self, path):
         return os.path.join(self.prefix, path)
 
 
+def _walk_files(top):
+    # yield (path, stat) for the files under top.  os.scandir gets the
+    # stat from the directory entry where it can; without it, each file
+    # found by os.walk is stat-ed.
+    if _scandir is None:
+        for root, _dirs, files in os.walk(top):
+            for fname in files:
+                fpath = os.path.join(root, fname)
+                try:
+                    yield (fpath, os.stat(fpath))
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+        return
+    pending = [top]
+    while pending:
+        try:
+            entries = list(_scandir(pending.pop()))
+        except OSError as e:
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                pending.append(entry.path)
+                continue
+            yield (entry.path, entry.stat())
+
+
+def inventory_matches(stored, checksums=None, size=None, mutable=True):
+    # True if stored, a StoredObject from an inventory, is known to be the
+    # content described by checksums and size.  as in the stores' own
+    # insert, an immutable object only has to exist (with the right
+    # size); a mutable one also has to have the expected md5.
+    if stored is None:
+        return False
+    if (size is not None and stored.size is not None and
+            int(size) != stored.size):
+        return False
+    if not mutable:
+        return True
+    md5 = (checksums or {}).get('md5')
+    return bool(md5) and stored.etag == md5
+
+
+def listing_time(stamp):
+    # seconds since the epoch from the ISO 8601 last modified time in an
+    # S3 or swift listing, or None.
+    if not stamp:
+        return None
+    try:
+        return calendar.timegm(
+            time.strptime(stamp.split(".")[0], "%Y-%m-%dT%H:%M:%S"))
+    except ValueError:
+        return None
+
+
 def has_valid_checksum(path, reader, checksums=None,
                        read_size=READ_BUFFER_SIZE):
     if checksums is None:
         return False
     try:
         cksum = checksum_util.SafeCheckSummer(checksums)
+        buf = bytearray(read_size)
+        view = memoryview(buf)
         with reader(path) as rfp:
             while True:
-                buf = rfp.read(read_size)
-                cksum.update(buf)
-                if len(buf) != read_size:
+                count = rfp.readinto(buf)
+                cksum.update(view[:count])
+                if count != read_size:
                     break
             return cksum.check()
     except Exception:
@@ -0,0 +1,176 @@
+#   Copyright (C) 2026 Canonical Ltd.
+#
+#   Simplestreams is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+#   Simplestreams is distributed in the hope that it will be useful, but
+#   WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#   or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public
+#   License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with Simplestreams.  If not, see <http://www.gnu.org/licenses/>.
+
+from concurrent import futures
+
+import simplestreams.contentsource as cs
+from simplestreams import checksum_util
+from simplestreams.log import LOG
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# S3 wants parts of at least 5MiB, all but the last.
+DEFAULT_PART_SIZE = 1024 * 1024 * 16
+DEFAULT_WORKERS = 4
+READ_SIZE = 1024 * 1024
+
+
+class Upload(object):
+    """One object being written to a store that takes it in parts.
+
+    upload() calls put() if the content fits in one part.  Otherwise it
+    calls begin(), then upload_part() (from several threads at once)
+    for each part, numbered from 1, and complete() with the list of
+    upload_part() results in part order, or abort() if anything went
+    wrong."""
+
+    def put(self, data):
+        raise NotImplementedError()
+
+    def begin(self):
+        raise NotImplementedError()
+
+    def upload_part(self, part_num, data):
+        raise NotImplementedError()
+
+    def complete(self, parts):
+        raise NotImplementedError()
+
+    def abort(self):
+        pass
+
+
+def _fill(reader, view, read_size=READ_SIZE):
+    # read into view until it is full or reader is at its end.  returns
+    # (count, eof).
+    filled = 0
+    while filled < len(view):
+        want = min(read_size, len(view) - filled)
+        count = reader.readinto(view[filled:filled + want])
+        filled += count
+        if count != want:
+            return (filled, True)
+    return (filled, False)
+
+
+def upload(reader, target, checksums=None, size=None,
+           part_size=DEFAULT_PART_SIZE, workers=DEFAULT_WORKERS,
+           path=None, executor=None):
+    """Copy reader to target, an Upload, without spooling it to disk.
+
+    Parts of part_size bytes are read into up to workers + 1 buffers
+    and uploaded by up to workers threads while the next part is read,
+    so memory stays bounded.  Buffers are allocated as they are needed,
+    and content of a known size smaller than part_size is read into
+    one buffer of about its size.  The content is checked against
+    checksums and size as it is read (a ChecksummingContentSource
+    checks itself); on a mismatch the upload is aborted and
+    InvalidChecksum raised, so a bad object is never completed.
+
+    Parts are sent on executor if given, which may be shared by several
+    uploads, else on a pool of workers threads of this upload's own."""
+    if isinstance(reader, cs.ChecksummingContentSource):
+        cksum = None
+    else:
+        cksum = checksum_util.checksummer(checksums)
+
+    first_size = part_size
+    if size is not None:
+        # a byte more than size is enough to tell content is too big.
+        first_size = min(part_size, int(size) + 1)
+    free = queue.Queue()
+    free.put(bytearray(first_size))
+    allocated = 1
+
+    def send(part_num, buf, count):
+        try:
+            return target.upload_part(part_num, memoryview(buf)[:count])
+        finally:
+            free.put(buf)
+
+    total = 0
+    pending = []
+    started = False
+    own_executor = executor is None
+    if own_executor:
+        executor = futures.ThreadPoolExecutor(max_workers=workers)
+    try:
+        part_num = 0
+        while True:
+            if free.empty() and allocated < workers + 1:
+                free.put(bytearray(part_size))
+                allocated += 1
+            buf = free.get()
+            try:
+                (count, eof) = _fill(reader, memoryview(buf))
+            except checksum_util.InvalidChecksum:
+                (count, eof) = (0, True)
+            total += count
+            part_num += 1
+            if cksum is not None:
+                cksum.update(memoryview(buf)[:count])
+            if size is not None and total > int(size):
+                # too big, the checksum cannot match either.
+                eof = True
+            if eof and not started:
+                _check(reader, cksum, total, size, path)
+                target.put(memoryview(buf)[:count])
+                return
+            if not started:
+                target.begin()
+                started = True
+            if count:
+                pending.append(executor.submit(send, part_num, buf, count))
+            else:
+                free.put(buf)
+            if eof:
+                break
+            # stop reading early if a part already failed.
+            for fut in pending:
+                if fut.done() and fut.exception() is not None:
+                    raise fut.exception()
+
+        parts = [fut.result() for fut in pending]
+        _check(reader, cksum, total, size, path)
+        target.complete(parts)
+    except BaseException:
+        for fut in pending:
+            fut.cancel()
+        futures.wait(pending)
+        if started:
+            try:
+                target.abort()
+            except Exception as e:
+                LOG.warn("aborting upload of %s failed: %s", path, e)
+        raise
+    finally:
+        if own_executor:
+            executor.shutdown(wait=True)
+
+
+def _check(reader, cksum, total, size, path):
+    if cksum is None:
+        if not reader.check():
+            raise checksum_util.invalid_checksum_for_reader(reader)
+        return
+    if (size is not None and total != int(size)) or not cksum.check():
+        raise checksum_util.InvalidChecksum(
+            path=path or reader.url, cksum=cksum, size=total,
+            expected_size=None if size is None else int(size))
+
+# vi: ts=4 expandtab
@@ -18,12 +18,57 @@
 import boto.exception
 import boto.s3
 import boto.s3.connection
+import boto.s3.multipart
+from concurrent import futures
 from contextlib import closing
+import contextlib
 import errno
-import tempfile
+import io
+import threading
 
 import simplestreams.objectstores as objectstores
 import simplestreams.contentsource as cs
+from simplestreams import checksum_util
+from simplestreams.objectstores import multipart
+
+# items are stored with the checksum they were verified against in this
+# metadata field, as the etag of a multipart upload is not their md5.
+CHECKSUM_META = "simplestreams-checksum"
+
+
+class _S3Upload(multipart.Upload):
+    def __init__(self, store, key_name, metadata):
+        self.store = store
+        self.key_name = key_name
+        self.metadata = metadata
+        self.mp = None
+
+    def put(self, data):
+        with closing(self.store.bucket.new_key(self.key_name)) as key:
+            for name, value in self.metadata.items():
+                key.set_metadata(name, value)
+            key.set_contents_from_string(bytes(data))
+
+    def begin(self):
+        self.mp = self.store.bucket.initiate_multipart_upload(
+            self.key_name, metadata=self.metadata)
+
+    def upload_part(self, part_num, data):
+        # boto connections are not shared between threads, so each part
+        # is sent through one of the store's idle connections.
+        with self.store.pooled_bucket() as bucket:
+            mp = boto.s3.multipart.MultiPartUpload(bucket)
+            mp.key_name = self.mp.key_name
+            mp.id = self.mp.id
+            mp.upload_part_from_file(io.BytesIO(data), part_num,
+                                     size=len(data))
+        return part_num
+
+    def complete(self, parts):
+        self.mp.complete_upload()
+
+    def abort(self):
+        self.mp.cancel_upload()
 
 
 class S3ObjectStore(objectstores.ObjectStore):
@@ -31,7 +76,15 @@ class S3ObjectStore(objectstores.ObjectStore):
     _bucket = None
     _connection = None
 
-    def __init__(self, prefix):
+    def __init__(self, prefix, part_size=multipart.DEFAULT_PART_SIZE,
+                 upload_workers=multipart.DEFAULT_WORKERS, pool_size=None):
+        """ Items are uploaded straight from their reader, in parts of
+        part_size bytes.  Parts are sent on one pool of upload_workers
+        threads, shared by all the items being inserted at the time,
+        through connections of the store's own, of which up to
+        pool_size (default upload_workers + 1) are kept idle.
+
+        close() the store when done with it. """
         # expect 's3://bucket/path_prefix'
         self.prefix = prefix
         if prefix.startswith("s3://"):
@@ -40,6 +93,25 @@ class S3ObjectStore(objectstores.ObjectStore):
             path = prefix
 
         (self.bucketname, self.path_prefix) = path.split("/", 1)
+        self.part_size = part_size
+        self.upload_workers = upload_workers
+        if pool_size is None:
+            pool_size = upload_workers + 1
+        self.pool_size = pool_size
+        self._idle = []
+        self._lock = threading.Lock()
+        self.executor = futures.ThreadPoolExecutor(max_workers=upload_workers)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        with self._lock:
+            (idle, self._idle) = (self._idle, [])
+        for bucket in idle:
+            bucket.connection.close()
+        if self._connection:
+            self._connection.close()
+            self._connection = None
+            self._bucket = None
 
     @property
     def _conn(self):
@@ -54,20 +126,52 @@ class S3ObjectStore(objectstores.ObjectStore):
             self._bucket = self._conn.get_bucket(self.bucketname)
         return self._bucket
 
+    @contextlib.contextmanager
+    def pooled_bucket(self):
+        # the bucket through an idle connection, or a new one.  one whose
+        # request failed is closed rather than used again.
+        with self._lock:
+            bucket = self._idle.pop() if self._idle else None
+        if bucket is None:
+            conn = boto.s3.connection.S3Connection()
+            bucket = conn.get_bucket(self.bucketname, validate=False)
+        try:
+            yield bucket
+        except Exception:
+            bucket.connection.close()
+            raise
+        with self._lock:
+            if len(self._idle) < self.pool_size:
+                self._idle.append(bucket)
+                return
+        bucket.connection.close()
+
     def insert(self, path, reader, checksums=None, mutable=True, size=None):
         # store content from reader.read() into path, expecting result checksum
+        # an inventory saying path is absent saves asking for its key.
+        (known, stored) = self.inventoried(path)
+        absent = known and stored is None
+        if (not mutable and not absent and
+                self.exists_with_checksum(path, checksums)):
+            reader.close()
+            return
+        metadata = {}
+        if isinstance(reader, cs.ChecksummingContentSource):
+            verified = {reader.algorithm: reader.checksummer.expected}
+        else:
+            verified = checksums
+        cksum = checksum_util.checksummer(verified)
+        if cksum.expected:
+            metadata[CHECKSUM_META] = "%s:%s" % (cksum.algorithm,
+                                                 cksum.expected)
         try:
-            tfile = tempfile.TemporaryFile()
-            with reader(path) as rfp:
-                while True:
-                    buf = rfp.read(self.read_size)
-                    tfile.write(buf)
-                    if len(buf) != self.read_size:
-                        break
-            with closing(self.bucket.new_key(self.path_prefix + path)) as key:
-                key.set_contents_from_file(tfile)
+            multipart.upload(
+                reader, _S3Upload(self, self.path_prefix + path, metadata),
+                checksums=checksums, size=size, part_size=self.part_size,
+                workers=self.upload_workers, path=path,
+                executor=self.executor)
         finally:
-            tfile.close()
+            reader.close()
 
     def insert_content(self, path, content, checksums=None, mutable=True):
         with closing(self.bucket.new_key(self.path_prefix + path)) as key:
@@ -75,8 +179,20 @@ class S3ObjectStore(objectstores.ObjectStore):
 
     def remove(self, path):
         # remove path from store
+        self._uninventory(path)
         self.bucket.delete_key(self.path_prefix + path)
 
+    def list_objects(self, prefix=""):
+        # bucket.list pages through the listing 1000 keys at a time.  the
+        # etag of a multipart object is not an md5, so it is left out.
+        for key in self.bucket.list(prefix=self.path_prefix + prefix):
+            etag = key.etag.strip('"')
+            if "-" in etag:
+                etag = None
+            mtime = objectstores.listing_time(key.last_modified)
+            yield (key.name[len(self.path_prefix):],
+                   objectstores.StoredObject(key.size, etag, mtime))
+
     def source(self, path):
         # essentially return an 'open(path, r)'
         key = self.bucket.get_key(self.path_prefix + path)
@@ -92,6 +208,15 @@ class S3ObjectStore(objectstores.ObjectStore):
         if key is None:
             return False
 
+        if not checksums:
+            return False
+
+        stored = key.get_metadata(CHECKSUM_META)
+        if stored:
+            (algorithm, _, hexdigest) = stored.partition(":")
+            if checksums.get(algorithm) == hexdigest:
+                return True
+
         if 'md5' in checksums:
             return checksums['md5'] == key.etag.replace('"', "")
 
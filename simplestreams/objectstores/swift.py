@@ -18,11 +18,29 @@
 import simplestreams.objectstores as objectstores
 import simplestreams.contentsource as cs
 import simplestreams.openstack as openstack
+from simplestreams import checksum_util
+from simplestreams.log import LOG
+from simplestreams.objectstores import multipart
 
+import contextlib
 import errno
 import hashlib
+import json
+import threading
+import time
+from concurrent import futures
 from swiftclient import Connection, ClientException
 
+# items larger than this are stored as a static large object: segments
+# of this size, uploaded in parallel, and a manifest that joins them.
+DEFAULT_SEGMENT_SIZE = 1024 * 1024 * 64
+# times the upload of one segment is tried before the item fails.  only
+# failures that may pass (no response, or a 5xx one) are tried again.
+SEGMENT_RETRIES = 3
+# items are stored with the checksum they were verified against in this
+# header, as the etag of a large object is not their md5.
+CHECKSUM_HEADER = "X-Object-Meta-Simplestreams-Checksum"
+
 
 def get_swiftclient(**kwargs):
     # nmap has entries that need name changes from a 'get_service_conn_info'
@@ -45,14 +63,147 @@ def get_swiftclient(**kwargs):
     return Connection(**connargs)
 
 
+class SwiftConnectionPool(object):
+    """Swift Connections made from one get_service_conn_info result.
+
+    They all use its token (or keystone session), so making another
+    connection does not authenticate again.  A Connection is used by one
+    thread at a time; maxsize is the number of idle ones kept."""
+
+    def __init__(self, conn_info, maxsize=multipart.DEFAULT_WORKERS + 1):
+        self.conn_info = conn_info
+        self.maxsize = maxsize
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def get_connection(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return get_swiftclient(**self.conn_info)
+
+    def put_connection(self, conn, exc=None):
+        # a connection whose request failed without a response from the
+        # server (an http error status is a response) is not reused.
+        if exc is None or getattr(exc, 'http_status', None) is not None:
+            with self._lock:
+                if len(self._idle) < self.maxsize:
+                    self._idle.append(conn)
+                    return
+        conn.close()
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self.get_connection()
+        try:
+            yield conn
+        except Exception as e:
+            self.put_connection(conn, e)
+            raise
+        self.put_connection(conn)
+
+    def close(self):
+        with self._lock:
+            (idle, self._idle) = (self._idle, [])
+        for conn in idle:
+            conn.close()
+
+
+def _pooled_iter(pool, conn, iterator):
+    # yield the chunks of a get_object response, handing conn back to
+    # pool once it has all been read.
+    try:
+        for chunk in iterator:
+            yield chunk
+    except Exception as e:
+        pool.put_connection(conn, e)
+        raise
+    except GeneratorExit:
+        # not read to the end, the response is still on the connection.
+        conn.close()
+        raise
+    pool.put_connection(conn)
+
+
 class SwiftContentSource(cs.IteratorContentSource):
     def is_enoent(self, exc):
         return is_enoent(exc)
 
 
+class _SwiftUpload(multipart.Upload):
+    # segments go to the store's segment container, named by the object,
+    # the time of the upload and their number.
+    def __init__(self, store, obj, headers):
+        self.store = store
+        self.obj = obj
+        self.headers = headers
+        self.seg_prefix = "%s/slo/%.6f" % (obj, time.time())
+        self.segments = []
+        self.lock = threading.Lock()
+
+    def put(self, data):
+        data = bytes(data)
+        with self.store.pool.connection() as conn:
+            conn.put_object(self.store.container, self.obj, data,
+                            content_length=len(data),
+                            etag=hashlib.md5(data).hexdigest(),
+                            headers=self.headers)
+
+    def begin(self):
+        self.store.ensure_segment_container()
+
+    def upload_part(self, part_num, data):
+        # a segment that failed for want of a response or with a server
+        # error is sent again on its own; its content is still in memory.
+        name = "%s/%08d" % (self.seg_prefix, part_num)
+        with self.lock:
+            self.segments.append(name)
+        data = bytes(data)
+        etag = hashlib.md5(data).hexdigest()
+        for attempt in range(1, SEGMENT_RETRIES + 1):
+            try:
+                with self.store.pool.connection() as conn:
+                    conn.put_object(self.store.segment_container, name,
+                                    data, content_length=len(data),
+                                    etag=etag)
+                break
+            except Exception as e:
+                if attempt == SEGMENT_RETRIES or not _retryable(e):
+                    raise
+                LOG.warn("upload of segment %s failed (attempt %d of %d): "
+                         "%s", name, attempt, SEGMENT_RETRIES, e)
+        return {'path': "/%s/%s" % (self.store.segment_container, name),
+                'etag': etag, 'size_bytes': len(data)}
+
+    def complete(self, parts):
+        with self.store.pool.connection() as conn:
+            conn.put_object(self.store.container, self.obj,
+                            json.dumps(parts), headers=self.headers,
+                            query_string="multipart-manifest=put")
+
+    def abort(self):
+        self.store.delete_segments([(self.store.segment_container, name)
+                                    for name in self.segments])
+
+
 class SwiftObjectStore(objectstores.ObjectStore):
 
-    def __init__(self, prefix, region=None):
+    def __init__(self, prefix, region=None,
+                 segment_size=DEFAULT_SEGMENT_SIZE,
+                 upload_workers=multipart.DEFAULT_WORKERS, pool_size=None,
+                 ksclient=None):
+        """ Items are uploaded straight from their reader.  Those larger
+        than segment_size are sent as a static large object, in segments
+        kept in the container <container>_segments.
+
+        Requests go over a SwiftConnectionPool keeping up to pool_size
+        (default upload_workers + 1) connections.  Segment uploads and
+        deletes run on one pool of upload_workers threads, shared by
+        all the items being inserted at the time.
+
+        ksclient is a keystone client to get the swift endpoint and token
+        from, so that stores for several regions authenticate once.
+        close() the store when done with it. """
         # expect 'swift://bucket/path_prefix'
         self.prefix = prefix
         if prefix.startswith("swift://"):
@@ -61,6 +212,10 @@ class SwiftObjectStore(objectstores.ObjectStore):
             path = prefix
 
         (self.container, self.path_prefix) = path.split("/", 1)
+        self.segment_container = self.container + "_segments"
+        self.segment_size = segment_size
+        self.upload_workers = upload_workers
+        self._segments_ready = False
 
         super(SwiftObjectStore, self).__init__()
 
@@ -68,34 +223,118 @@ class SwiftObjectStore(objectstores.ObjectStore):
         if region is not None:
             self.keystone_creds['region_name'] = region
 
-        conn_info = openstack.get_service_conn_info('object-store',
-                                                    **self.keystone_creds)
-        self.swiftclient = get_swiftclient(**conn_info)
+        conn_info = openstack.get_service_conn_info(
+            'object-store', client=ksclient, **self.keystone_creds)
+        if pool_size is None:
+            pool_size = upload_workers + 1
+        self.pool = SwiftConnectionPool(conn_info, maxsize=pool_size)
+        self.executor = futures.ThreadPoolExecutor(max_workers=upload_workers)
 
         # http://docs.openstack.org/developer/swift/misc.html#acls
-        self.swiftclient.put_container(self.container,
-                                       headers={'X-Container-Read':
-                                                '.r:*,.rlistings'})
+        with self.pool.connection() as conn:
+            conn.put_container(self.container,
+                               headers={'X-Container-Read': '.r:*,.rlistings'})
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.pool.close()
+
+    def ensure_segment_container(self):
+        # readable by all as the containers' items are, or the large
+        # objects cannot be read.
+        if self._segments_ready:
+            return
+        with self.pool.connection() as conn:
+            conn.put_container(self.segment_container,
+                               headers={'X-Container-Read': '.r:*,.rlistings'})
+        self._segments_ready = True
+
+    def delete_segments(self, segments):
+        # delete segments, a list of (container, name), in parallel as
+        # they were uploaded.
+        pending = [self.executor.submit(self.delete_object, container, name)
+                   for (container, name) in segments]
+        for fut in pending:
+            fut.result()
+
+    def delete_object(self, container, obj, query_string=None):
+        # delete obj, which need not exist.
+        try:
+            with self.pool.connection() as conn:
+                conn.delete_object(container, obj, query_string=query_string)
+        except Exception as exc:
+            if not is_enoent(exc):
+                raise
 
     def insert(self, path, reader, checksums=None, mutable=True, size=None):
         # store content from reader.read() into path, expecting result checksum
-        self._insert(path=path, contents=reader, checksums=checksums,
-                     mutable=mutable)
+        try:
+            existing = self._existing(path)
+            if self._stored(existing, checksums, mutable):
+                return
+            replaced = self._segments(path, existing)
+            if isinstance(reader, cs.ChecksummingContentSource):
+                verified = {reader.algorithm: reader.checksummer.expected}
+            else:
+                verified = checksums
+            cksum = checksum_util.checksummer(verified)
+            headers = {}
+            if cksum.expected:
+                headers[CHECKSUM_HEADER] = "%s:%s" % (cksum.algorithm,
+                                                      cksum.expected)
+            multipart.upload(
+                reader, _SwiftUpload(self, self.path_prefix + path, headers),
+                checksums=checksums, size=size, part_size=self.segment_size,
+                workers=self.upload_workers, path=path,
+                executor=self.executor)
+            self.delete_segments(replaced)
+        finally:
+            reader.close()
 
     def insert_content(self, path, content, checksums=None, mutable=True):
         self._insert(path=path, contents=content, checksums=checksums,
                      mutable=mutable)
 
     def remove(self, path):
-        self.swiftclient.delete_object(container=self.container,
-                                       obj=self.path_prefix + path)
+        # a large object is removed with its segments.
+        self._uninventory(path)
+        query = None
+        headers = self._head_path(path)
+        if headers.get('x-static-large-object', '').lower() == 'true':
+            query = "multipart-manifest=delete"
+        with self.pool.connection() as conn:
+            conn.delete_object(self.container, self.path_prefix + path,
+                               query_string=query)
+
+    def list_objects(self, prefix=""):
+        # a container listing is paged by the server; full_listing fetches
+        # every page.
+        with self.pool.connection() as conn:
+            (_headers, objs) = conn.get_container(
+                self.container, prefix=self.path_prefix + prefix,
+                full_listing=True)
+        for obj in objs:
+            if 'subdir' in obj:
+                continue
+            # the hash of a large object is not the md5 of its content.
+            etag = None if 'slo_etag' in obj else obj.get('hash')
+            yield (obj['name'][len(self.path_prefix):],
+                   objectstores.StoredObject(
+                       obj.get('bytes'), etag,
+                       objectstores.listing_time(obj.get('last_modified'))))
 
     def source(self, path):
         def itgen():
-            (_headers, iterator) = self.swiftclient.get_object(
-                container=self.container, obj=self.path_prefix + path,
-                resp_chunk_size=self.read_size)
-            return iterator
+            # the connection stays with the response until it is read.
+            conn = self.pool.get_connection()
+            try:
+                (_headers, iterator) = conn.get_object(
+                    container=self.container, obj=self.path_prefix + path,
+                    resp_chunk_size=self.read_size)
+            except Exception as e:
+                self.pool.put_connection(conn, e)
+                raise
+            return _pooled_iter(self.pool, conn, iterator)
 
         return SwiftContentSource(itgen=itgen, url=self.prefix + path)
 
@@ -104,22 +343,51 @@ class SwiftObjectStore(objectstores.ObjectStore):
 
     def _head_path(self, path):
         try:
-            headers = self.swiftclient.head_object(container=self.container,
-                                                   obj=self.path_prefix + path)
+            with self.pool.connection() as conn:
+                headers = conn.head_object(self.container,
+                                           self.path_prefix + path)
         except Exception as exc:
             if is_enoent(exc):
                 return {}
             raise
         return headers
 
+    def _existing(self, path):
+        # the headers of path, or {} if it does not exist.
+        (known, stored) = self.inventoried(path)
+        if known and stored is None:
+            # the inventory says it is not there; no need to ask.
+            return {}
+        return self._head_path(path)
+
+    def _stored(self, headers, checksums, mutable):
+        # True if the object with headers need not be written: it exists
+        # and is immutable, or has checksums.
+        if not headers:
+            return False
+        return not mutable or headers_match_checksums(headers, checksums)
+
+    def _segments(self, path, headers):
+        # [(container, name)] of the segments of path, which has headers,
+        # if it is a large object.  once path is written again nothing
+        # uses them, so they are looked up before and deleted after.
+        if headers.get('x-static-large-object', '').lower() != 'true':
+            return []
+        with self.pool.connection() as conn:
+            (_headers, manifest) = conn.get_object(
+                self.container, self.path_prefix + path,
+                query_string="multipart-manifest=get")
+        if isinstance(manifest, bytes):
+            manifest = manifest.decode('utf-8')
+        return [tuple(seg['name'].lstrip("/").split("/", 1))
+                for seg in json.loads(manifest)]
+
     def _insert(self, path, contents, checksums=None, mutable=True, size=None):
-        # content is a ContentSource or a string
-        headers = self._head_path(path)
-        if headers:
-            if not mutable:
-                return
-            if headers_match_checksums(headers, checksums):
-                return
+        # content is a string
+        existing = self._existing(path)
+        if self._stored(existing, checksums, mutable):
+            return
+        replaced = self._segments(path, existing)
 
         insargs = {'container': self.container, 'obj': self.path_prefix + path,
                    'contents': contents}
@@ -135,17 +403,30 @@ class SwiftObjectStore(objectstores.ObjectStore):
         elif isinstance(contents, str):
             insargs['etag'] = hashlib.md5(contents).hexdigest()
 
-        self.swiftclient.put_object(**insargs)
+        with self.pool.connection() as conn:
+            conn.put_object(**insargs)
+        self.delete_segments(replaced)
 
 
 def headers_match_checksums(headers, checksums):
     if not (headers and checksums):
         return False
+    stored = headers.get(CHECKSUM_HEADER.lower())
+    if stored:
+        (algorithm, _, hexdigest) = stored.partition(":")
+        if checksums.get(algorithm) == hexdigest:
+            return True
     if ('md5' in checksums and headers.get('etag') == checksums.get('md5')):
         return True
     return False
 
 
+def _retryable(exc):
+    # True if exc is a failure to get a response, or a server error.
+    status = getattr(exc, 'http_status', None)
+    return status is None or status >= 500
+
+
 def is_enoent(exc):
     return ((isinstance(exc, IOError) and exc.errno == errno.ENOENT) or
             (isinstance(exc, ClientException) and exc.http_status == 404))
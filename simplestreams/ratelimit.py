@@ -0,0 +1,148 @@
+#   Copyright (C) 2026 Canonical Ltd.
+#
+#   Simplestreams is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+#   Simplestreams is distributed in the hope that it will be useful, but
+#   WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#   or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public
+#   License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with Simplestreams.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import re
+import threading
+import time
+
+# bytes handed to one transfer before the next waiting one gets a turn.
+DEFAULT_QUANTUM = 1024 * 64
+
+_SUFFIXES = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+
+def parse_rate(rate):
+    # '512k', '10M', '1.5G' or a plain number of bytes per second.
+    # 0 or 'unlimited' mean no limit and return None.
+    mat = re.match(r"^\s*([0-9.]+)\s*([kmg]?)(?:i?b?)(?:/s)?\s*$",
+                   str(rate).lower())
+    if str(rate).strip().lower() in ("unlimited", "none", "-"):
+        return None
+    if not mat:
+        raise ValueError("Invalid rate '%s'" % rate)
+    value = int(float(mat.group(1)) * _SUFFIXES[mat.group(2)])
+    return value or None
+
+
+def _parse_time(hhmm):
+    mat = re.match(r"^([0-9]{1,2}):([0-9]{2})$", hhmm.strip())
+    if not mat or int(mat.group(1)) > 24 or int(mat.group(2)) > 59:
+        raise ValueError("Invalid time '%s'" % hhmm)
+    return int(mat.group(1)) * 60 + int(mat.group(2))
+
+
+def parse_schedule(spec):
+    # spec is a rate, or comma separated 'HH:MM-HH:MM=RATE' windows in
+    # local time.  returns (default_rate, [(start_min, end_min, rate)]).
+    # outside all windows transfers are unlimited.
+    windows = []
+    if "=" not in spec:
+        return (parse_rate(spec), windows)
+    for tok in spec.split(","):
+        try:
+            span, rate = tok.split("=")
+            start, end = span.split("-")
+        except ValueError:
+            raise ValueError("Invalid schedule entry '%s'" % tok)
+        windows.append((_parse_time(start), _parse_time(end),
+                        parse_rate(rate)))
+    return (None, windows)
+
+
+class BandwidthLimiter(object):
+    """A token bucket shared by every transfer of a sync.
+
+    rate is in bytes per second, None for unlimited.  windows is a list of
+    (start_minute, end_minute, rate) in local time that override rate
+    while they apply (a window may wrap past midnight).  Transfers call
+    consume() with the number of bytes they moved; waiting transfers are
+    served round robin, quantum bytes at a time, so concurrent transfers
+    get an equal share of the rate."""
+
+    def __init__(self, rate=None, windows=None, burst=None,
+                 quantum=DEFAULT_QUANTUM):
+        self.rate = rate
+        self.windows = windows or []
+        self.quantum = quantum
+        self.burst = burst
+        self._tokens = None
+        self._last = time.time()
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+
+    @classmethod
+    def from_spec(cls, spec, **kwargs):
+        # a limiter for a --limit-rate spec, or None if spec is empty.
+        if not spec:
+            return None
+        (rate, windows) = parse_schedule(spec)
+        return cls(rate=rate, windows=windows, **kwargs)
+
+    def current_rate(self, now=None):
+        if not self.windows:
+            return self.rate
+        tm = time.localtime(now)
+        minute = tm.tm_hour * 60 + tm.tm_min
+        for (start, end, rate) in self.windows:
+            if start <= end and start <= minute < end:
+                return rate
+            if start > end and (minute >= start or minute < end):
+                return rate
+        return self.rate
+
+    def _capacity(self, rate):
+        return max(self.burst or rate, self.quantum)
+
+    def _refill(self, rate):
+        now = time.time()
+        if self._tokens is None:
+            self._tokens = self._capacity(rate)
+        else:
+            self._tokens = min(self._capacity(rate),
+                               self._tokens + (now - self._last) * rate)
+        self._last = now
+
+    def consume(self, size):
+        # block until size more bytes may be transferred.
+        if size <= 0 or (self.rate is None and not self.windows):
+            return
+        remaining = size
+        turn = object()
+        with self._cond:
+            while remaining > 0:
+                self._queue.append(turn)
+                while True:
+                    rate = self.current_rate()
+                    if rate is None:
+                        # unlimited right now.
+                        self._queue.remove(turn)
+                        self._cond.notify_all()
+                        return
+                    self._refill(rate)
+                    want = min(self.quantum, remaining)
+                    if self._queue[0] is turn:
+                        if self._tokens >= want:
+                            self._tokens -= want
+                            remaining -= want
+                            self._queue.popleft()
+                            self._cond.notify_all()
+                            break
+                        timeout = (want - self._tokens) / float(rate)
+                    else:
+                        timeout = None
+                    self._cond.wait(timeout)
+
+# vi: ts=4 expandtab
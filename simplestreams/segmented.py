@@ -0,0 +1,231 @@
+#   Copyright (C) 2026 Canonical Ltd.
+#
+#   Simplestreams is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+#   Simplestreams is distributed in the hope that it will be useful, but
+#   WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#   or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public
+#   License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with Simplestreams.  If not, see <http://www.gnu.org/licenses/>.
+
+import mmap
+import os
+import sys
+import threading
+
+from concurrent import futures
+
+import simplestreams.contentsource as cs
+from simplestreams import blobcache
+from simplestreams import checksum_util
+from simplestreams.log import LOG
+
+DEFAULT_SEGMENTS = 4
+# items smaller than this are not worth splitting
+DEFAULT_MIN_SIZE = 1024 * 1024 * 64
+READ_SIZE = 1024 * 1024
+MMAP_BLOCK = 1024 * 1024 * 16
+# times a segment that fails part way is resumed from where it got to.
+DEFAULT_SEGMENT_RETRIES = 3
+
+
+class RangeNotSupported(IOError):
+    pass
+
+
+class _Aborted(Exception):
+    # another segment failed, so this one stopped.
+    pass
+
+
+def segment_ranges(size, segments):
+    # split size bytes into (start, length) tuples of nearly equal length
+    segments = max(1, min(segments, size))
+    seglen = size // segments
+    ranges = []
+    for n in range(segments):
+        start = n * seglen
+        if n == segments - 1:
+            ranges.append((start, size - start))
+        else:
+            ranges.append((start, seglen))
+    return ranges
+
+
+def can_segment(reader):
+    # return the UrlContentSource under reader if it can be read in
+    # segments, or None.  a FillingContentSource is looked through; its
+    # cache can be filled from the result with fill_from().
+    if isinstance(reader, cs.ChecksummingContentSource):
+        reader = reader.cs
+    if isinstance(reader, blobcache.FillingContentSource):
+        reader = reader.cs
+    if not isinstance(reader, cs.UrlContentSource) or reader.fd is not None:
+        return None
+    if not reader.input_url.startswith(("http://", "https://")):
+        return None
+    return reader
+
+
+class SegmentedDownloader(object):
+    """Download one item as several concurrent Range requests.
+
+    source is an unopened UrlContentSource for the item, which is cloned
+    for each segment.  If source.stripe is set, each segment starts at a
+    different one of its mirrors.  A segment that fails part way is
+    reopened where it stopped, up to retries times.  progress_callback, if
+    given, is called with the total number of bytes written so far."""
+
+    def __init__(self, source, size, segments=DEFAULT_SEGMENTS,
+                 read_size=READ_SIZE, progress_callback=None,
+                 retries=DEFAULT_SEGMENT_RETRIES):
+        self.source = source
+        self.size = int(size)
+        self.segments = segments
+        self.read_size = read_size
+        self.progress_callback = progress_callback
+        self.retries = retries
+        self.written = 0
+        self._lock = threading.Lock()
+        self._abort = threading.Event()
+
+    def _progress(self, buflen):
+        with self._lock:
+            self.written += buflen
+            written = self.written
+        if self.progress_callback:
+            self.progress_callback(written)
+
+    def _fetch(self, fname, start, length, index=0):
+        # write length bytes at start of fname.  stops with _Aborted once
+        # another segment has failed.
+        offset = start
+        end = start + length
+        attempt = 0
+        with open(fname, "r+b") as wfp:
+            while offset < end:
+                if self.source.stripe:
+                    src = self.source.clone(rotate=index + attempt)
+                else:
+                    src = self.source.clone()
+                src.set_start_pos(offset)
+                try:
+                    src.open()
+                    if not src.at_offset:
+                        raise RangeNotSupported(
+                            "Range request not honored for %s" % src.url)
+                    wfp.seek(offset)
+                    while offset < end:
+                        if self._abort.is_set():
+                            raise _Aborted()
+                        buf = src.read(min(self.read_size, end - offset))
+                        if not buf:
+                            raise IOError("%s: short read at offset %d" %
+                                          (src.url, offset))
+                        wfp.write(buf)
+                        offset += len(buf)
+                        self._progress(len(buf))
+                except RangeNotSupported:
+                    raise
+                except (IOError, OSError) as e:
+                    if attempt >= self.retries or self._abort.is_set():
+                        raise
+                    attempt += 1
+                    LOG.warn("segment of %s failed at offset %d, resuming "
+                             "(%d/%d): %s", self.source.url, offset, attempt,
+                             self.retries, e)
+                finally:
+                    src.close()
+
+    def download(self, fname):
+        # write the whole item to fname.  raises RangeNotSupported if the
+        # server does not do Range requests.
+        ranges = segment_ranges(self.size, self.segments)
+        LOG.debug("downloading %s in %d segments", self.source.url,
+                  len(ranges))
+        with open(fname, "wb") as wfp:
+            wfp.truncate(self.size)
+
+        self._abort.clear()
+        with futures.ThreadPoolExecutor(max_workers=len(ranges)) as ex:
+            pending = [ex.submit(self._fetch, fname, start, length, index)
+                       for index, (start, length) in enumerate(ranges)]
+            futures.wait(pending, return_when=futures.FIRST_EXCEPTION)
+            # if one failed, stop the running segments at their next read
+            # rather than waiting for them to finish.
+            self._abort.set()
+            for future in pending:
+                future.cancel()
+
+        errors = [future.exception() for future in pending
+                  if not future.cancelled()]
+        errors = [e for e in errors
+                  if e is not None and not isinstance(e, _Aborted)]
+        if errors:
+            raise errors[0]
+
+
+def _mmap_checksummer(fp, checksummer, size):
+    # hash fp through a read-only mapping, MMAP_BLOCK bytes per update so
+    # that hashlib releases the GIL for each.
+    mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        with memoryview(mapped) as view:
+            try:
+                for start in range(0, size, MMAP_BLOCK):
+                    checksummer.update(view[start:start + MMAP_BLOCK])
+            finally:
+                # a threaded MultiHasher hashes views of the mapping as
+                # they are, so let it finish before the mapping goes.
+                checksummer.close()
+    finally:
+        mapped.close()
+
+
+def file_checksummer(fname, checksummer, read_size=READ_SIZE):
+    # feed the content of fname to checksummer and return the size read.
+    with open(fname, "rb") as fp:
+        size = os.fstat(fp.fileno()).st_size
+        # python2 mmaps do not have the buffer interface memoryview needs.
+        if size and sys.version_info > (3, 0):
+            try:
+                _mmap_checksummer(fp, checksummer, size)
+                return size
+            except (EnvironmentError, ValueError, TypeError) as e:
+                LOG.debug("mmap of %s failed, reading it: %s", fname, e)
+
+        size = 0
+        buf = bytearray(read_size)
+        view = memoryview(buf)
+        while True:
+            count = fp.readinto(buf)
+            checksummer.update(view[:count])
+            size += count
+            if count != read_size:
+                break
+    return size
+
+
+def verify_file(fname, checksums, size=None, path=None):
+    # raise InvalidChecksum if fname does not match checksums and size.
+    if checksums:
+        cksum = checksum_util.MultiHasher(checksums, algorithms=(),
+                                          threaded=True)
+    else:
+        cksum = checksum_util.checksummer(checksums)
+    try:
+        found = file_checksummer(fname, cksum)
+    finally:
+        cksum.close()
+    expected_size = found if size is None else int(size)
+    if found != expected_size or not cksum.check():
+        raise checksum_util.InvalidChecksum(
+            path=path or fname, cksum=cksum, size=found,
+            expected_size=expected_size)
+
+# vi: ts=4 expandtab
@@ -0,0 +1,261 @@
+#   Copyright (C) 2026 Canonical Ltd.
+#
+#   Simplestreams is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+#   Simplestreams is distributed in the hope that it will be useful, but
+#   WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#   or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public
+#   License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with Simplestreams.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import sqlite3
+import threading
+
+try:
+    from urllib.parse import quote
+except ImportError:
+    quote = None
+
+# where ObjectStoreMirrorWriter targets keep the database, under the
+# store's prefix.
+DEFAULT_PATH = ".data/state.db"
+
+# products tree levels: (table, key columns, child dict)
+_LEVELS = (
+    ('trees', (), 'products'),
+    ('products', ('product',), 'versions'),
+    ('versions', ('product', 'version'), 'items'),
+    ('items', ('product', 'version', 'item'), None),
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS trees (
+    content_id TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS products (
+    content_id TEXT, product TEXT, data TEXT NOT NULL,
+    PRIMARY KEY (content_id, product));
+CREATE TABLE IF NOT EXISTS versions (
+    content_id TEXT, product TEXT, version TEXT, data TEXT NOT NULL,
+    PRIMARY KEY (content_id, product, version));
+CREATE TABLE IF NOT EXISTS items (
+    content_id TEXT, product TEXT, version TEXT, item TEXT, path TEXT,
+    data TEXT NOT NULL, PRIMARY KEY (content_id, product, version, item));
+CREATE INDEX IF NOT EXISTS items_path ON items (path);
+CREATE TABLE IF NOT EXISTS refs (
+    path TEXT, ref TEXT, PRIMARY KEY (path, ref));
+"""
+
+
+def _connect(path, readonly=False):
+    if readonly and quote is not None:
+        uri = "file:%s?mode=ro" % quote(os.path.abspath(path))
+        return sqlite3.connect(uri, uri=True, isolation_level=None,
+                               check_same_thread=False)
+    # python2's sqlite3 cannot open read-only; a reader just does not write.
+    return sqlite3.connect(path, isolation_level=None,
+                           check_same_thread=False)
+
+
+def _dump(data):
+    return json.dumps(data, sort_keys=True)
+
+
+def tree_rows(tree):
+    # return {(level, key): json} with one row per level of tree.  each
+    # row holds that level's fields, its child dict emptied.
+    rows = {}
+
+    def add(level, key, data):
+        (_table, _columns, child) = _LEVELS[level]
+        fields = dict(data)
+        if child is not None and child in fields:
+            fields[child] = {}
+        rows[(level, key)] = _dump(fields)
+        if child is None:
+            return
+        for name, cdata in data.get(child, {}).items():
+            add(level + 1, key + (name,), cdata)
+
+    add(0, (), tree)
+    return rows
+
+
+class SqliteMirrorState(object):
+    """The target trees and item references of a mirror, in sqlite.
+
+    ObjectStoreMirrorWriter keeps these as whole JSON documents under
+    .data/.  Here there is a row for each product, version, item and
+    reference, so saving a tree only writes the rows that changed (in
+    one transaction), and looking up an item or the references to a
+    path is an index lookup.
+
+    With readonly, an existing database is opened for reading only, as
+    for a dry run."""
+
+    def __init__(self, path, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        self._lock = threading.RLock()
+        self._db = _connect(path, readonly=readonly)
+        if readonly:
+            return
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _rows(self, content_id):
+        rows = {}
+        for level, (table, columns, _child) in enumerate(_LEVELS):
+            cols = ", ".join(columns + ('data',))
+            query = "SELECT %s FROM %s WHERE content_id=?" % (cols, table)
+            for row in self._db.execute(query, (content_id,)):
+                rows[(level, tuple(row[:-1]))] = row[-1]
+        return rows
+
+    def content_ids(self):
+        with self._lock:
+            return [row[0] for row in self._db.execute(
+                "SELECT content_id FROM trees ORDER BY content_id")]
+
+    def load_products(self, content_id):
+        # the products tree stored for content_id, or None.
+        with self._lock:
+            rows = self._rows(content_id)
+        if (0, ()) not in rows:
+            return None
+        nodes = {}
+        for (level, key) in sorted(rows, key=lambda k: k[0]):
+            node = json.loads(rows[(level, key)])
+            nodes[key] = node
+            if level:
+                parent = nodes.get(key[:-1])
+                if parent is None:
+                    continue
+                child = _LEVELS[level - 1][2]
+                parent.setdefault(child, {})[key[-1]] = node
+        return nodes[()]
+
+    def save_products(self, tree):
+        # make the stored tree for tree['content_id'] equal to tree.
+        content_id = tree['content_id']
+        new = tree_rows(tree)
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                old = self._rows(content_id)
+                for (level, key) in old:
+                    if (level, key) in new:
+                        continue
+                    (table, columns, _child) = _LEVELS[level]
+                    where = " AND ".join("%s=?" % c
+                                         for c in ('content_id',) + columns)
+                    self._db.execute("DELETE FROM %s WHERE %s" %
+                                     (table, where), (content_id,) + key)
+                for (level, key), data in new.items():
+                    if old.get((level, key)) == data:
+                        continue
+                    (table, columns, _child) = _LEVELS[level]
+                    cols = ('content_id',) + columns + ('data',)
+                    values = (content_id,) + key + (data,)
+                    if table == 'items':
+                        cols += ('path',)
+                        values += (json.loads(data).get('path'),)
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO %s (%s) VALUES (%s)" %
+                        (table, ", ".join(cols), ", ".join("?" * len(cols))),
+                        values)
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def remove_products(self, content_id):
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                for table, _columns, _child in _LEVELS:
+                    self._db.execute(
+                        "DELETE FROM %s WHERE content_id=?" % table,
+                        (content_id,))
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def get_item(self, content_id, pedigree):
+        # the stored item at pedigree (product, version, item), or None.
+        with self._lock:
+            row = self._db.execute(
+                "SELECT data FROM items WHERE content_id=? AND product=? "
+                "AND version=? AND item=?",
+                (content_id,) + tuple(pedigree)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def has_item(self, content_id, pedigree):
+        return self.get_item(content_id, pedigree) is not None
+
+    def items_with_path(self, path):
+        # [(content_id, pedigree)] of the stored items whose path is path.
+        with self._lock:
+            return [(row[0], tuple(row[1:])) for row in self._db.execute(
+                "SELECT content_id, product, version, item FROM items "
+                "WHERE path=?", (path,))]
+
+    def has_references(self):
+        with self._lock:
+            return self._db.execute(
+                "SELECT 1 FROM refs LIMIT 1").fetchone() is not None
+
+    def references(self):
+        # {path: [ref, ...]} as in references.json.
+        refs = {}
+        with self._lock:
+            for path, ref in self._db.execute(
+                    "SELECT path, ref FROM refs ORDER BY rowid"):
+                refs.setdefault(path, []).append(ref)
+        return refs
+
+    def set_references(self, refs):
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.execute("DELETE FROM refs")
+                self._db.executemany(
+                    "INSERT OR IGNORE INTO refs (path, ref) VALUES (?, ?)",
+                    [(path, ref) for path in refs for ref in refs[path]])
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def add_reference(self, path, ref):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR IGNORE INTO refs (path, ref) VALUES (?, ?)",
+                (path, ref))
+
+    def remove_reference(self, path, ref):
+        # remove ref to path, returning the number of references left.
+        with self._lock:
+            self._db.execute("DELETE FROM refs WHERE path=? AND ref=?",
+                             (path, ref))
+            return self.reference_count(path)
+
+    def reference_count(self, path):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT COUNT(*) FROM refs WHERE path=?", (path,)).fetchone()
+        return row[0]
+
+# vi: ts=4 expandtab
@@ -0,0 +1,262 @@
+#   Copyright (C) 2026 Canonical Ltd.
+#
+#   Simplestreams is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+#   Simplestreams is distributed in the hope that it will be useful, but
+#   WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#   or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public
+#   License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with Simplestreams.  If not, see <http://www.gnu.org/licenses/>.
+
+import base64
+import socket
+import ssl
+import sys
+import threading
+
+if sys.version_info > (3, 0):
+    import http.client as httplib
+    import urllib.parse as urlparse
+    from urllib.request import getproxies, proxy_bypass
+else:
+    import httplib
+    import urlparse
+    from urllib import getproxies, proxy_bypass
+
+DEFAULT_POOL_MAXSIZE = 4
+MAX_REDIRECTS = 10
+
+
+def _proxy_for(scheme, netloc):
+    # the proxy url that http_proxy/https_proxy say to reach netloc through
+    # with scheme, or None if there is none or no_proxy excludes the host.
+    proxy = getproxies().get(scheme)
+    if not proxy or proxy_bypass(netloc):
+        return None
+    return proxy
+
+
+def _proxy_headers(proxy):
+    # a Proxy-Authorization header for credentials embedded in the proxy url.
+    parsed = urlparse.urlparse(proxy)
+    if parsed.username is None:
+        return {}
+    token = ("%s:%s" % (urlparse.unquote(parsed.username),
+                        urlparse.unquote(parsed.password or ""))
+             ).encode('utf-8')
+    return {'Proxy-Authorization':
+            "Basic %s" % base64.b64encode(token).decode('ascii')}
+
+
+def _set_timeout(conn, timeout):
+    conn.timeout = timeout
+    if conn.sock is not None:
+        conn.sock.settimeout(timeout)
+
+
+class _ResumingHTTPSConnection(httplib.HTTPSConnection):
+    # an HTTPSConnection that offers the last TLS session negotiated with
+    # this host back to the server, so reconnects can skip the full handshake.
+    pool = None
+
+    def connect(self):
+        if self.pool is None or not hasattr(ssl.SSLSocket, 'session'):
+            return httplib.HTTPSConnection.connect(self)
+
+        httplib.HTTPConnection.connect(self)
+        server_hostname = self._tunnel_host or self.host
+        self.sock = self._context.wrap_socket(
+            self.sock, server_hostname=server_hostname,
+            session=self.pool.get_tls_session(server_hostname))
+        self.pool.set_tls_session(server_hostname, self.sock.session)
+
+
+class PooledResponse(object):
+    # wraps an httplib response so that closing it hands a fully consumed
+    # keep-alive connection back to the pool it came from.
+    def __init__(self, pool, key, conn, resp, timeout=None):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.resp = resp
+        self.timeout = timeout
+        self.status = resp.status
+        self.reason = resp.reason
+        self.headers = resp.msg
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return self.resp.read()
+        return self.resp.read(size)
+
+    def readinto(self, buf):
+        if not hasattr(self.resp, 'readinto'):
+            # python2 httplib responses only do read()
+            data = self.resp.read(len(buf))
+            buf[:len(data)] = data
+            return len(data)
+        return self.resp.readinto(buf)
+
+    def close(self):
+        if self.conn is None:
+            return
+        if self.resp.isclosed() and not self.resp.will_close:
+            if self.timeout is not None:
+                # a timeout was for this request only, not the next user.
+                _set_timeout(self.conn, socket.getdefaulttimeout())
+            self.pool.put_connection(self.key, self.conn)
+        else:
+            self.resp.close()
+            self.conn.close()
+        self.conn = None
+
+
+class UrlSessionPool(object):
+    """Keep-alive connections shared by all url readers of a MirrorReader.
+
+    maxsize is the number of idle connections kept per host.  Connections
+    go through the proxy named by http_proxy/https_proxy unless no_proxy
+    excludes the host."""
+
+    def __init__(self, maxsize=DEFAULT_POOL_MAXSIZE, ssl_context=None):
+        self.maxsize = maxsize
+        self.ssl_context = ssl_context
+        self._idle = {}
+        self._tls_sessions = {}
+        self._requests_session = None
+        self._lock = threading.Lock()
+
+    @property
+    def requests_session(self):
+        with self._lock:
+            if self._requests_session is None:
+                import requests
+                import requests.adapters
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=self.maxsize, pool_maxsize=self.maxsize)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._requests_session = session
+            return self._requests_session
+
+    def get_tls_session(self, host):
+        with self._lock:
+            return self._tls_sessions.get(host)
+
+    def set_tls_session(self, host, session):
+        with self._lock:
+            self._tls_sessions[host] = session
+
+    def get_connection(self, key, fresh=False):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle and not fresh:
+                return idle.pop()
+        return self._new_connection(key)
+
+    def _new_connection(self, key):
+        (scheme, netloc, proxy) = key
+        host = netloc
+        if proxy is not None:
+            host = urlparse.urlparse(proxy).netloc.rpartition('@')[2]
+        if scheme == "https":
+            if self.ssl_context is None:
+                self.ssl_context = ssl.create_default_context()
+            conn = _ResumingHTTPSConnection(host, context=self.ssl_context)
+            conn.pool = self
+            if proxy is not None:
+                conn.set_tunnel(netloc, headers=_proxy_headers(proxy))
+        elif scheme == "http":
+            conn = httplib.HTTPConnection(host)
+        else:
+            raise ValueError("Unsupported scheme '%s' for pool" % scheme)
+        return conn
+
+    def put_connection(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.maxsize:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def urlopen(self, url, headers=None, username=None, password=None,
+                timeout=None):
+        # issue a GET for url over a pooled connection, following redirects.
+        # returns a PooledResponse, which must be closed by the caller.
+        # timeout, if given, is the socket timeout in seconds.
+        if headers is None:
+            headers = {}
+        headers = dict(headers)
+        if username is not None:
+            token = ("%s:%s" % (username, password)).encode('utf-8')
+            headers['Authorization'] = (
+                "Basic %s" % base64.b64encode(token).decode('ascii'))
+
+        origin = None
+        for _ in range(MAX_REDIRECTS + 1):
+            parsed = urlparse.urlparse(url)
+            proxy = _proxy_for(parsed.scheme, parsed.netloc)
+            key = (parsed.scheme, parsed.netloc, proxy)
+            if origin is None:
+                origin = key[:2]
+            elif key[:2] != origin:
+                # credentials are for the host they were given for, not
+                # wherever it redirects to.
+                headers = dict((k, v) for k, v in headers.items()
+                               if k.lower() != 'authorization')
+            reqpath = parsed.path or "/"
+            if parsed.query:
+                reqpath += "?" + parsed.query
+            reqheaders = headers
+            if proxy is not None and parsed.scheme == "http":
+                # a plain http proxy is sent the whole url.  https goes
+                # through a CONNECT tunnel set up by _new_connection.
+                reqpath = "http://%s%s" % (parsed.netloc, reqpath)
+                reqheaders = dict(headers)
+                reqheaders.update(_proxy_headers(proxy))
+
+            resp = None
+            for attempt in (0, 1):
+                conn = self.get_connection(key, fresh=bool(attempt))
+                if timeout is not None:
+                    _set_timeout(conn, timeout)
+                try:
+                    conn.request("GET", reqpath, headers=reqheaders)
+                    resp = conn.getresponse()
+                    break
+                except (httplib.HTTPException, IOError):
+                    # a kept-alive connection may have been closed by the
+                    # server while idle.  retry once on a fresh one.
+                    conn.close()
+                    if attempt:
+                        raise
+
+            location = resp.getheader('location')
+            if resp.status in (301, 302, 303, 307, 308) and location:
+                resp.read()
+                PooledResponse(self, key, conn, resp, timeout).close()
+                url = urlparse.urljoin(url, location)
+                continue
+
+            return PooledResponse(self, key, conn, resp, timeout)
+
+        raise IOError("Too many redirects for %s" % url)
+
+    def close(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for conn in idle:
+                    conn.close()
+            self._idle = {}
+            if self._requests_session is not None:
+                self._requests_session.close()
+                self._requests_session = None
+
+# vi: ts=4 expandtab
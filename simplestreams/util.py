@@ -16,6 +16,8 @@
 #   along with Simplestreams.  If not, see <http://www.gnu.org/licenses/>.
 
 import errno
+import gzip
+import io
 import os
 import re
 import subprocess
@@ -27,6 +29,11 @@ import simplestreams.contentsource as cs
 import simplestreams.checksum_util as checksum_util
 from simplestreams.log import LOG
 
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
 ALIASNAME = "_aliases"
 
 PGP_SIGNED_MESSAGE_HEADER = "-----BEGIN PGP SIGNED MESSAGE-----"
@@ -35,7 +42,7 @@ PGP_SIGNATURE_FOOTER = "-----END PGP SIGNATURE-----"
 
 _UNSET = object()
 
-READ_SIZE = (1024 * 10)
+READ_SIZE = (1024 * 1024)
 
 PRODUCTS_TREE_DATA = (
     ("products", "product_name"),
@@ -337,6 +344,31 @@ def dump_data(data):
                       separators=(',', ': ')).encode('utf-8')
 
 
+def compress_data(data, suffix):
+    # return bytes data compressed for a file ending in suffix (one of
+    # cs.COMPRESSED_SUFFIXES).  no timestamp is stored, so the same data
+    # always compresses to the same bytes.
+    if suffix == '.xz' and lzma:
+        return lzma.compress(data)
+    if suffix == '.gz':
+        out = io.BytesIO()
+        with gzip.GzipFile(fileobj=out, mode="wb", mtime=0) as fp:
+            fp.write(data)
+        return out.getvalue()
+    raise ValueError("unsupported compression '%s'" % suffix)
+
+
+def write_compressed(fname, data, suffixes):
+    # write data compressed to fname + suffix for each of suffixes.
+    # returns the list of files written.
+    written = []
+    for suffix in suffixes:
+        with open(fname + suffix, "wb") as fp:
+            fp.write(compress_data(data, suffix))
+        written.append(fname + suffix)
+    return written
+
+
 def timestamp(ts=None):
     return time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.gmtime(ts))
 
@@ -424,17 +456,24 @@ def mkdir_p(path):
     return
 
 
-def get_local_copy(contentsource, read_size=READ_SIZE, progress_callback=None):
+def get_local_copy(contentsource, read_size=READ_SIZE, progress_callback=None,
+                   hasher=None):
+    # copy contentsource to a temporary file.  hasher, if given, is
+    # updated with every block written.
     (tfd, tpath) = tempfile.mkstemp()
     tfile = os.fdopen(tfd, "wb")
     try:
         LOG.debug("getting local copy of %s", contentsource.url)
+        buf = bytearray(read_size)
+        view = memoryview(buf)
         while True:
-            buf = contentsource.read(read_size)
+            count = contentsource.readinto(buf)
             if progress_callback:
-                progress_callback(read_size)
-            tfile.write(buf)
-            if len(buf) != read_size:
+                progress_callback(count)
+            if hasher is not None:
+                hasher.update(view[:count])
+            tfile.write(view[:count])
+            if count != read_size:
                 break
         return (tpath, True)
 
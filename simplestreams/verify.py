@@ -0,0 +1,234 @@
+#   Copyright (C) 2026 Canonical Ltd.
+#
+#   Simplestreams is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU Affero General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or (at your
+#   option) any later version.
+#
+#   Simplestreams is distributed in the hope that it will be useful, but
+#   WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+#   or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public
+#   License for more details.
+#
+#   You should have received a copy of the GNU Affero General Public License
+#   along with Simplestreams.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import json
+import os
+
+from concurrent import futures
+
+from simplestreams import checksum_util
+from simplestreams import objectstores
+from simplestreams import segmented
+from simplestreams import statedb
+from simplestreams import util
+from simplestreams.log import LOG
+
+DATA_DIR = ".data"
+REFERENCES = "references.json"
+JOURNAL = "references.journal"
+# paths under these are metadata, never items or orphans.
+DEFAULT_IGNORE = (DATA_DIR + "/", objectstores.BLOB_DIR + "/", "streams/")
+
+OK = "ok"
+MISSING = "missing"
+CORRUPT = "corrupt"
+
+
+class ItemInfo(object):
+    def __init__(self, path, checksums=None, size=None):
+        self.path = path
+        self.checksums = checksums or {}
+        self.size = size
+        self.owners = []
+
+    def __repr__(self):
+        return "ItemInfo(path=%s, size=%s, owners=%s)" % (
+            self.path, self.size, self.owners)
+
+
+class VerifyResult(object):
+    def __init__(self):
+        self.verified = []
+        self.missing = []
+        self.corrupt = []
+        self.orphaned = []
+        self.bytes_read = 0
+
+    def ok(self):
+        return not (self.missing or self.corrupt or self.orphaned)
+
+    def to_dict(self):
+        return {'verified': len(self.verified),
+                'bytes_read': self.bytes_read,
+                'missing': sorted(self.missing),
+                'corrupt': sorted(self.corrupt),
+                'orphaned': sorted(self.orphaned)}
+
+
+def _load_json_state(data_d):
+    # ([(name, products tree)], references) from the JSON files in data_d.
+    trees = []
+    try:
+        names = sorted(os.listdir(data_d))
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        names = []
+    for name in names:
+        fpath = os.path.join(data_d, name)
+        if (name in (REFERENCES, JOURNAL) or name.endswith(".part") or
+                name.startswith(os.path.basename(statedb.DEFAULT_PATH))):
+            continue
+        if not os.path.isfile(fpath):
+            continue
+        with open(fpath, "rb") as fp:
+            trees.append((name, util.load_content(fp.read())))
+
+    try:
+        with open(os.path.join(data_d, REFERENCES), "r") as fp:
+            references = json.load(fp)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        references = {}
+    return (trees, references)
+
+
+def _load_db_state(db_path):
+    state = statedb.SqliteMirrorState(db_path, readonly=True)
+    try:
+        trees = [(content_id, state.load_products(content_id))
+                 for content_id in state.content_ids()]
+        return (trees, state.references())
+    finally:
+        state.close()
+
+
+def load_items(mirror_d):
+    # return a dict of path to ItemInfo for every item recorded in the
+    # products trees and references of an ObjectStoreMirrorWriter target
+    # at mirror_d, from its state database if it has one, else from the
+    # JSON files in .data/.
+    db_path = os.path.join(mirror_d, statedb.DEFAULT_PATH)
+    if os.path.exists(db_path):
+        (trees, references) = _load_db_state(db_path)
+    else:
+        (trees, references) = _load_json_state(
+            os.path.join(mirror_d, DATA_DIR))
+
+    items = {}
+    for name, tree in trees:
+        def add_item(item, tree, pedigree):
+            if 'path' not in item:
+                return
+            flat = util.products_exdata(tree, pedigree,
+                                        insert_fieldnames=False)
+            info = items.get(item['path'])
+            if info is None:
+                info = ItemInfo(item['path'],
+                                checksum_util.item_checksums(flat),
+                                flat.get('size'))
+                items[item['path']] = info
+            else:
+                info.size = info.size or flat.get('size')
+                info.checksums = (info.checksums or
+                                  checksum_util.item_checksums(flat))
+            info.owners.append(
+                '/'.join([tree.get('content_id', name)] + list(pedigree)))
+
+        util.walk_products(tree, cb_item=add_item)
+
+    for path, owners in references.items():
+        info = items.setdefault(path, ItemInfo(path))
+        for owner in owners:
+            if owner not in info.owners:
+                info.owners.append(owner)
+
+    return items
+
+
+def check_file(fpath, checksums, size=None):
+    # return (status, bytes_read, message) for the file fpath.  run in a
+    # worker process, so only plain values go in and out.
+    try:
+        st = os.stat(fpath)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return (MISSING, 0, "%s: missing" % fpath)
+        raise
+    if size is not None and st.st_size != int(size):
+        return (CORRUPT, 0, "%s: size %d, expected %s" %
+                (fpath, st.st_size, size))
+    if not checksums:
+        return (OK, 0, None)
+    cksum = checksum_util.checksummer(checksums)
+    found = segmented.file_checksummer(fpath, cksum)
+    if not cksum.check():
+        return (CORRUPT, found, "%s: %s %s, expected %s" %
+                (fpath, cksum.algorithm, cksum.hexdigest(), cksum.expected))
+    return (OK, found, None)
+
+
+def find_orphans(mirror_d, items, ignore=DEFAULT_IGNORE):
+    # paths of files under mirror_d that no item refers to.
+    orphans = []
+    for root, dirs, files in os.walk(mirror_d):
+        dirs.sort()
+        for fname in sorted(files):
+            rel = os.path.relpath(os.path.join(root, fname), mirror_d)
+            rel = rel.replace(os.sep, "/")
+            if rel.startswith(tuple(ignore)) or rel in items:
+                continue
+            orphans.append(rel)
+    return orphans
+
+
+def verify_mirror(mirror_d, jobs=None, ignore=DEFAULT_IGNORE,
+                  progress_callback=None):
+    """Verify every item of an ObjectStoreMirrorWriter target at mirror_d.
+
+    Items are hashed in a pool of jobs processes (default one per cpu),
+    largest first, through mmap.  Files under mirror_d that are not
+    items and not under one of the ignore prefixes are reported as
+    orphaned.  progress_callback is called with (path, status, message)
+    as each item completes.  Returns a VerifyResult."""
+    items = load_items(mirror_d)
+    result = VerifyResult()
+    result.orphaned = find_orphans(mirror_d, items, ignore=ignore)
+
+    def item_size(info):
+        try:
+            return int(info.size)
+        except (TypeError, ValueError):
+            return 0
+
+    ordered = sorted(items.values(), key=item_size, reverse=True)
+    with futures.ProcessPoolExecutor(max_workers=jobs) as ex:
+        pending = dict(
+            (ex.submit(check_file, os.path.join(mirror_d, info.path),
+                       info.checksums, info.size), info.path)
+            for info in ordered)
+        for fut in futures.as_completed(pending):
+            path = pending[fut]
+            try:
+                (status, count, msg) = fut.result()
+            except Exception as e:
+                (status, count, msg) = (CORRUPT, 0, "%s: %s" % (path, e))
+            result.bytes_read += count
+            if status == MISSING:
+                result.missing.append(path)
+            elif status == CORRUPT:
+                result.corrupt.append(path)
+            else:
+                result.verified.append(path)
+            if msg:
+                LOG.warn("%s", msg)
+            if progress_callback:
+                progress_callback(path, status, msg)
+
+    return result
+
+# vi: ts=4 expandtab
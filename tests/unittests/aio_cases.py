@@ -0,0 +1,197 @@
+import asyncio
+import errno
+import hashlib
+import os
+import shutil
+import socket
+import tempfile
+from unittest import TestCase
+
+from simplestreams import aio
+from simplestreams import checksum_util
+from simplestreams import mirrors
+from simplestreams import objectstores
+from tests.testutil import get_mirror_reader, EXAMPLES_DIR
+from tests.unittests.test_contentsource import RandomPortServer
+
+FOOCLOUD_DIR = os.path.join(EXAMPLES_DIR, "foocloud")
+
+
+def _policy(content, path):  # pylint: disable=W0613
+    return content
+
+
+def run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+def read_tree(top):
+    found = {}
+    for root, _dirs, files in os.walk(top):
+        for fname in files:
+            fpath = os.path.join(root, fname)
+            with open(fpath, "rb") as fp:
+                found[os.path.relpath(fpath, top)] = fp.read()
+    return found
+
+
+class TestAsyncUrlContentSource(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = RandomPortServer(FOOCLOUD_DIR)
+        cls.server.serve()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.unserve()
+
+    def read(self, csrc, size=-1):
+        async def _read():
+            async with csrc as fp:
+                return await fp.read(size)
+        return run(_read())
+
+    def test_read_http(self):
+        path = "streams/v1/index.json"
+        with open(os.path.join(FOOCLOUD_DIR, path), "rb") as fp:
+            expected = fp.read()
+        csrc = aio.AsyncUrlContentSource(self.server.url_for(path))
+        self.assertEqual(expected, self.read(csrc))
+
+    def test_read_http_size(self):
+        path = "streams/v1/index.json"
+        csrc = aio.AsyncUrlContentSource(self.server.url_for(path))
+        self.assertEqual(b'{', self.read(csrc, 1)[0:1])
+        self.assertEqual(10, len(self.read(
+            aio.AsyncUrlContentSource(self.server.url_for(path)), 10)))
+
+    def test_missing_is_enoent(self):
+        csrc = aio.AsyncUrlContentSource(self.server.url_for("nothere"))
+        with self.assertRaises(IOError) as ctx:
+            self.read(csrc)
+        self.assertEqual(errno.ENOENT, ctx.exception.errno)
+
+    def test_falls_back_to_mirror(self):
+        path = "streams/v1/index.json"
+        csrc = aio.AsyncUrlContentSource(
+            self.server.url_for("nothere"),
+            mirrors=[self.server.url_for(path)])
+        self.assertTrue(self.read(csrc).startswith(b'{'))
+
+
+class TestAsyncUrlMirrorReader(TestCase):
+    def test_stalled_server_times_out(self):
+        sock = socket.socket()
+        self.addCleanup(sock.close)
+        sock.bind(("127.0.0.1", 0))
+        sock.listen(1)
+        reader = aio.AsyncUrlMirrorReader(
+            "http://127.0.0.1:%d/" % sock.getsockname()[1], timeout=0.1)
+        self.addCleanup(reader.close)
+
+        async def _read():
+            async with reader.source("x") as fp:
+                return await fp.read()
+        self.assertRaises(IOError, run, _read())
+
+    def test_sources_share_pool(self):
+        path = "streams/v1/index.json"
+        with RandomPortServer(FOOCLOUD_DIR) as server:
+            reader = aio.AsyncUrlMirrorReader(server.url_for(),
+                                              policy=_policy)
+            self.addCleanup(reader.close)
+            sources = [reader.source(path) for _ in range(2)]
+        self.assertIsNotNone(reader.reader.pool)
+        for source in sources:
+            self.assertIs(reader.reader.pool, source.cs.pool)
+
+
+class TestAsyncChecksummingContentSource(TestCase):
+    def test_bad_checksum_raises(self):
+        csrc = aio.AsyncChecksummingContentSource(
+            aio.AsyncMemoryContentSource(content=b"hello"), size=5,
+            checksums={'md5': '0' * 32})
+        self.assertRaises(checksum_util.InvalidChecksum, run, csrc.read(10))
+
+    def test_good_checksum(self):
+        csrc = aio.AsyncChecksummingContentSource(
+            aio.AsyncMemoryContentSource(content=b"hello"), size=5,
+            checksums={'md5': '5d41402abc4b2a76b9719d911017c592'})
+        self.assertEqual(b"hello", run(csrc.read(10)))
+        self.assertTrue(csrc.check())
+
+
+class TestAsyncFileStore(TestCase):
+    def setUp(self):
+        self.tmpd = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpd)
+        self.src = os.path.join(self.tmpd, "src")
+        with open(self.src, "wb") as fp:
+            fp.write(b"0123456789")
+        self.store = aio.AsyncFileStore(os.path.join(self.tmpd, "store"))
+
+    def insert(self, expected, size):
+        reader = aio.AsyncChecksummingContentSource(
+            aio.AsyncUrlContentSource(self.src), size=size,
+            checksums={'sha256': hashlib.sha256(expected).hexdigest()})
+        run(self.store.insert("item", reader, checksums={
+            'sha256': hashlib.sha256(expected).hexdigest()}, size=size))
+
+    def test_resumes_partial_download(self):
+        os.makedirs(self.store.prefix)
+        with open(os.path.join(self.store.prefix, "item.part"), "wb") as fp:
+            fp.write(b"abcd")
+        self.insert(b"abcd456789", 10)
+        with open(os.path.join(self.store.prefix, "item"), "rb") as fp:
+            self.assertEqual(b"abcd456789", fp.read())
+
+    def test_wrong_size_fails(self):
+        self.assertRaises(checksum_util.InvalidChecksum, self.insert,
+                          b"0123456789", 5)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.store.prefix, "item")))
+
+
+class TestAsyncObjectStoreMirrorWriter(TestCase):
+    def setUp(self):
+        self.tmpd = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpd)
+
+    def sync_expected(self):
+        target = os.path.join(self.tmpd, "sync")
+        tmirror = mirrors.ObjectStoreMirrorWriter(
+            config={}, objectstore=objectstores.FileStore(target))
+        tmirror.sync(get_mirror_reader("foocloud"), "streams/v1/index.json")
+        return read_tree(target)
+
+    def test_sync_matches_sync_writer(self):
+        target = os.path.join(self.tmpd, "async")
+        reader = aio.AsyncObjectStoreMirrorReader(
+            objectstores.FileStore(FOOCLOUD_DIR), policy=_policy)
+        writer = aio.AsyncObjectStoreMirrorWriter(
+            {}, aio.AsyncFileStore(target))
+        run(writer.sync(reader, "streams/v1/index.json"))
+        self.assertEqual(self.sync_expected(), read_tree(target))
+
+    def test_sync_over_http(self):
+        target = os.path.join(self.tmpd, "async")
+        with RandomPortServer(FOOCLOUD_DIR) as server:
+            reader = aio.AsyncUrlMirrorReader(server.url_for(),
+                                              policy=_policy)
+            self.addCleanup(reader.close)
+            writer = aio.AsyncObjectStoreMirrorWriter(
+                {}, aio.AsyncFileStore(target), max_concurrency=4)
+            run(writer.sync(reader, "streams/v1/index.json"))
+        self.assertEqual(self.sync_expected(), read_tree(target))
+
+    def test_sync_to_adapted_store(self):
+        store = objectstores.MemoryObjectStore()
+        reader = aio.AsyncObjectStoreMirrorReader(
+            objectstores.FileStore(FOOCLOUD_DIR), policy=_policy)
+        writer = aio.AsyncObjectStoreMirrorWriter(
+            {}, aio.AsyncObjectStoreAdapter(store))
+        run(writer.sync(reader, "streams/v1/index.json"))
+        expected = self.sync_expected()
+        self.assertEqual(sorted(expected.keys()), sorted(store.data.keys()))
@@ -0,0 +1,7 @@
+# the asyncio tests are in aio_cases, which python2 cannot even parse.
+import sys
+
+if sys.version_info >= (3, 5):
+    from tests.unittests.aio_cases import *  # noqa: F401,F403
+
+# vi: ts=4 expandtab
@@ -0,0 +1,226 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import mock
+
+from simplestreams import blobcache
+from simplestreams import localcopy
+from simplestreams import mirrors
+from simplestreams import segmented
+from simplestreams.contentsource import (
+    ChecksummingContentSource, MemoryContentSource, UrlContentSource)
+
+
+class SeekableSource(MemoryContentSource):
+    resumable = True
+
+    def set_start_pos(self, offset):
+        self.fd.seek(offset)
+
+    def close(self):
+        pass
+
+
+def sha256(data):
+    return {'sha256': hashlib.sha256(data).hexdigest()}
+
+
+class TestBlobCache(TestCase):
+    def setUp(self):
+        self.tmpd = tempfile.mkdtemp()
+        self.cache = blobcache.BlobCache(os.path.join(self.tmpd, "cache"),
+                                         max_size=25)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpd)
+
+    def fill(self, data, checksums=None, size=None, read_size=4):
+        if checksums is None:
+            checksums = sha256(data)
+        src = self.cache.filling(MemoryContentSource(content=data),
+                                 checksums, size=size)
+        found = b""
+        while True:
+            buf = src.read(read_size)
+            found += buf
+            if len(buf) != read_size:
+                break
+        src.close()
+        self.assertEqual(data, found)
+
+    def cached(self, checksums):
+        # True if the blob for checksums is in the cache.
+        src = self.cache.source(checksums)
+        if src is None:
+            return False
+        src.close()
+        return True
+
+    def test_verified_content_cached(self):
+        data = b"0123456789"
+        self.assertIsNone(self.cache.source(sha256(data)))
+        self.fill(data, size=len(data))
+        cached = self.cache.source(sha256(data))
+        self.addCleanup(cached.close)
+        self.assertEqual(self.cache.blob_path(sha256(data)),
+                         localcopy.source_path(cached))
+        with cached as src:
+            self.assertEqual(data, src.read())
+
+    def test_bad_content_not_cached(self):
+        self.fill(b"0123456789", checksums=sha256(b"other"))
+        self.fill(b"0123456789", size=11)
+        self.assertIsNone(self.cache.source(sha256(b"0123456789")))
+        self.assertEqual([], self.cache._blobs())
+
+    def test_partial_read_not_cached(self):
+        data = b"0123456789"
+        src = self.cache.filling(MemoryContentSource(content=data),
+                                 sha256(data), size=len(data))
+        src.read(4)
+        src.close()
+        self.assertIsNone(self.cache.source(sha256(data)))
+
+    def test_resumed_read_cached(self):
+        data = b"0123456789"
+        src = self.cache.filling(SeekableSource(content=data),
+                                 sha256(data), size=len(data))
+        src.read(4)
+        src.close()
+        src.set_start_pos(4)
+        self.assertEqual(data[4:], src.read())
+        self.assertIsNotNone(self.cache.source(sha256(data)))
+
+        src = self.cache.filling(SeekableSource(content=b"abcdef"),
+                                 sha256(b"abcdef"), size=6)
+        src.read(4)
+        src.set_start_pos(2)
+        src.read()
+        self.assertIsNone(self.cache.source(sha256(b"abcdef")))
+
+    def test_least_recently_used_evicted(self):
+        blobs = [(b"%d" % i) * 10 for i in range(3)]
+        for num, data in enumerate(blobs[:2]):
+            self.fill(data)
+            os.utime(self.cache.blob_path(sha256(data)), (num, num))
+        # using the oldest makes the other one least recently used.
+        self.assertTrue(self.cached(sha256(blobs[0])))
+        self.fill(blobs[2])
+        self.assertTrue(self.cached(sha256(blobs[0])))
+        self.assertFalse(self.cached(sha256(blobs[1])))
+        self.assertTrue(self.cached(sha256(blobs[2])))
+
+    def test_open_blob_not_evicted(self):
+        for data in (b"a" * 10, b"b" * 10):
+            self.fill(data)
+        pinned = self.cache.source(sha256(b"a" * 10))
+        pinned.open()
+        blob = self.cache.blob_path(sha256(b"a" * 10))
+        try:
+            os.utime(blob, (0, 0))
+            self.assertEqual([self.cache.blob_path(sha256(b"b" * 10))],
+                             self.cache.evict(max_size=0))
+            self.assertEqual(b"a" * 10, pinned.read())
+        finally:
+            pinned.close()
+        self.assertEqual([blob], self.cache.evict(max_size=0))
+
+    def test_blob_pinned_before_open(self):
+        # as when it is copied by path rather than read.
+        self.fill(b"a" * 10)
+        blob = self.cache.blob_path(sha256(b"a" * 10))
+        pinned = self.cache.source(sha256(b"a" * 10))
+        try:
+            self.assertEqual([], self.cache.evict(max_size=0))
+            self.assertEqual(blob, localcopy.source_path(pinned))
+        finally:
+            pinned.close()
+        self.assertEqual([blob], self.cache.evict(max_size=0))
+
+    def test_evicted_before_pinned_is_miss(self):
+        self.fill(b"a" * 10)
+        blob = self.cache.blob_path(sha256(b"a" * 10))
+        lock = blobcache._lock
+
+        def evict_then_lock(fp, exclusive=False):
+            os.unlink(blob)
+            return lock(fp, exclusive=exclusive)
+
+        with mock.patch.object(blobcache, '_lock',
+                               side_effect=evict_then_lock):
+            self.assertIsNone(self.cache.source(sha256(b"a" * 10)))
+
+    def test_walked_once_under_max_size(self):
+        with mock.patch.object(self.cache, '_blobs',
+                               wraps=self.cache._blobs) as walk:
+            for data in (b"a" * 10, b"b" * 10, b"c" * 10):
+                self.fill(data)
+        # the first add walks; the third goes over max_size.
+        self.assertEqual(2, walk.call_count)
+        self.assertFalse(self.cached(sha256(b"a" * 10)))
+        self.assertTrue(self.cached(sha256(b"c" * 10)))
+
+    def test_helpers_see_through_filling(self):
+        fpath = os.path.join(self.tmpd, "item")
+        with open(fpath, "wb") as fp:
+            fp.write(b"0123456789")
+        checksums = sha256(b"0123456789")
+        local = ChecksummingContentSource(
+            self.cache.filling(UrlContentSource(url=fpath), checksums),
+            checksums, size=10)
+        self.assertEqual(fpath, localcopy.source_path(local))
+        remote = UrlContentSource(url="http://example.com/item")
+        filling = self.cache.filling(remote, checksums)
+        self.assertIs(remote, segmented.can_segment(filling))
+        self.assertIs(filling, blobcache.filling_source(filling))
+        self.assertIsNone(blobcache.filling_source(remote))
+
+    def test_fill_from_file(self):
+        fpath = os.path.join(self.tmpd, "item")
+        with open(fpath, "wb") as fp:
+            fp.write(b"0123456789")
+        os.utime(fpath, (1, 1))
+        checksums = sha256(b"0123456789")
+        filling = self.cache.filling(
+            UrlContentSource(url="http://example.com/item"), checksums)
+        filling.fill_from(fpath)
+        with self.cache.source(checksums) as src:
+            self.assertEqual(b"0123456789", src.read())
+        self.assertEqual(1, os.stat(fpath).st_mtime)
+
+
+class CountingReader(mirrors.MirrorReader):
+    def __init__(self, data):
+        super(CountingReader, self).__init__()
+        self.data = data
+        self.reads = []
+
+    def source(self, path):
+        self.reads.append(path)
+        return MemoryContentSource(content=self.data[path], url=path)
+
+
+class TestCachingMirrorReader(TestCase):
+    def setUp(self):
+        self.tmpd = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpd)
+
+    def test_items_read_once(self):
+        data = b"item content" * 100
+        upstream = CountingReader({"a/item": data, "b/item": data})
+        reader = mirrors.CachingMirrorReader(
+            upstream, blobcache.BlobCache(self.tmpd))
+        for path in ("a/item", "b/item", "a/item"):
+            with reader.item_source(path, checksums=sha256(data),
+                                    size=len(data)) as src:
+                self.assertEqual(data, src.read())
+        self.assertEqual(["a/item"], upstream.reads)
+
+        # without checksums there is nothing to cache by.
+        reader.item_source("a/item").read()
+        self.assertEqual(["a/item", "a/item"], upstream.reads)
@@ -0,0 +1,94 @@
+import hashlib
+from unittest import TestCase
+
+from simplestreams import checksum_util
+
+DATA = [b"0123456789" * 1000, b"", b"abcdef" * 333, b"x"]
+
+
+def expected_digests(data):
+    content = b"".join(data)
+    return dict((meth, hashlib.new(meth, content).hexdigest())
+                for meth in checksum_util.CHECKSUMS)
+
+
+class TestMultiHasher(TestCase):
+    def feed(self, hasher):
+        for block in DATA:
+            hasher.update(memoryview(bytearray(block)))
+        return hasher
+
+    def test_all_digests(self):
+        for threaded in (False, True):
+            hasher = self.feed(checksum_util.MultiHasher(threaded=threaded))
+            self.assertEqual(expected_digests(DATA), hasher.hexdigests())
+            self.assertEqual("sha512", hasher.algorithm)
+
+    def test_check_uses_strongest_given(self):
+        digests = expected_digests(DATA)
+        checksums = {'md5': digests['md5'], 'sha256': digests['sha256']}
+        hasher = self.feed(
+            checksum_util.MultiHasher(checksums, threaded=True))
+        self.assertEqual("sha256", hasher.algorithm)
+        self.assertEqual(digests['sha256'], hasher.hexdigest())
+        self.assertTrue(hasher.check())
+
+        checksums['sha256'] = "0" * 64
+        hasher = self.feed(
+            checksum_util.MultiHasher(checksums, threaded=True))
+        self.assertFalse(hasher.check())
+
+    def test_only_needed_algorithm(self):
+        hasher = self.feed(checksum_util.MultiHasher(
+            {'sha256': None}, algorithms=(), threaded=True))
+        self.assertEqual(
+            {'sha256': expected_digests(DATA)['sha256']},
+            hasher.hexdigests())
+
+    def test_update_after_hexdigest(self):
+        hasher = checksum_util.MultiHasher(threaded=True)
+        hasher.update(DATA[0])
+        hasher.hexdigest()
+        hasher.update(DATA[2])
+        self.assertEqual(expected_digests([DATA[0], DATA[2]]),
+                         hasher.hexdigests())
+
+    def test_close_stops_worker(self):
+        hasher = checksum_util.MultiHasher(threaded=True)
+        hasher.update(DATA[0])
+        worker = hasher._worker
+        self.assertTrue(worker.is_alive())
+        hasher.close()
+        self.assertFalse(worker.is_alive())
+        hasher.close()
+
+    def test_read_only_blocks_not_copied(self):
+        hasher = checksum_util.MultiHasher(threaded=True)
+        for block in DATA:
+            hasher.update(block)
+        hasher.close()
+        # no buffer was ever grown to copy a block into.
+        self.assertEqual([0, 0], [len(b) for b in hasher._free.queue])
+        self.assertEqual(expected_digests(DATA), hasher.hexdigests())
+
+    def test_writable_blocks_copied(self):
+        hasher = checksum_util.MultiHasher(threaded=True)
+        buf = bytearray(DATA[0])
+        hasher.update(buf)
+        buf[:] = b"y" * len(buf)
+        self.assertEqual(expected_digests(DATA[:1]), hasher.hexdigests())
+
+    def test_worker_error_raised_by_next_update(self):
+        class BrokenHash(object):
+            def update(self, data):
+                raise RuntimeError("broken")
+
+        hasher = checksum_util.MultiHasher(threaded=True)
+        hasher._hashers = {'md5': BrokenHash()}
+        hasher.update(DATA[0])
+        hasher.close()
+        self.assertRaises(RuntimeError, hasher.update, DATA[2])
+
+    def test_no_usable_algorithm(self):
+        self.assertRaises(TypeError, checksum_util.MultiHasher,
+                          algorithms=())
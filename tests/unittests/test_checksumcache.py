@@ -0,0 +1,147 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from simplestreams import checksumcache
+from simplestreams import contentsource
+from simplestreams import objectstores
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+CONTENT = b"0123456789" * 100
+CHECKSUMS = {'md5': hashlib.md5(CONTENT).hexdigest(),
+             'sha256': hashlib.sha256(CONTENT).hexdigest()}
+
+
+class CacheTests(object):
+    def setUp(self):
+        self.tmpd = tempfile.mkdtemp()
+        self.fpath = os.path.join(self.tmpd, "item")
+        with open(self.fpath, "wb") as fp:
+            fp.write(CONTENT)
+        self.cache = self.get_cache()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpd)
+
+    def test_unknown_file(self):
+        self.assertFalse(self.cache.check(self.fpath, CHECKSUMS))
+
+    def test_record_and_check(self):
+        self.cache.record(self.fpath, CHECKSUMS)
+        self.assertTrue(self.cache.check(self.fpath, CHECKSUMS))
+        # only the strongest checksum is compared.
+        self.assertTrue(self.cache.check(
+            self.fpath, {'sha256': CHECKSUMS['sha256']}))
+        self.assertFalse(self.cache.check(
+            self.fpath, {'sha256': "0" * 64}))
+        self.assertFalse(self.cache.check(
+            self.fpath, {'md5': CHECKSUMS['md5']}))
+
+    def test_change_invalidates(self):
+        self.cache.record(self.fpath, CHECKSUMS)
+        st = os.stat(self.fpath)
+        os.utime(self.fpath, (st.st_atime, st.st_mtime + 10))
+        self.assertFalse(self.cache.check(self.fpath, CHECKSUMS))
+
+    def test_no_expected_checksum(self):
+        self.cache.record(self.fpath, {'sha256': None})
+        self.assertFalse(self.cache.check(self.fpath, {'sha256': None}))
+        self.assertFalse(self.cache.check(self.fpath, None))
+
+    def test_remove(self):
+        self.cache.record(self.fpath, CHECKSUMS)
+        self.cache.remove(self.fpath)
+        os.unlink(self.fpath)
+        self.cache.remove(self.fpath)
+
+
+class TestXattrChecksumCache(CacheTests, TestCase):
+    def get_cache(self):
+        cache = checksumcache.XattrChecksumCache()
+        if not cache.enabled:
+            self.skipTest("no extended attribute support")
+        return cache
+
+    def test_copy_is_not_trusted(self):
+        self.cache.record(self.fpath, CHECKSUMS)
+        copy = self.fpath + ".copy"
+        shutil.copy2(self.fpath, copy)
+        value = os.getxattr(self.fpath, checksumcache.XATTR_NAME)
+        os.setxattr(copy, checksumcache.XATTR_NAME, value)
+        self.assertFalse(self.cache.check(copy, CHECKSUMS))
+
+
+class TestSqliteChecksumCache(CacheTests, TestCase):
+    def get_cache(self):
+        return checksumcache.SqliteChecksumCache(
+            os.path.join(self.tmpd, "cache.db"))
+
+    def test_persists(self):
+        self.cache.record(self.fpath, CHECKSUMS)
+        self.cache.close()
+        cache = self.get_cache()
+        self.assertTrue(cache.check(self.fpath, CHECKSUMS))
+
+
+class TestFileStoreChecksumCache(TestCase):
+    def setUp(self):
+        self.tmpd = tempfile.mkdtemp()
+        self.target = os.path.join(self.tmpd, "target")
+        self.cache = checksumcache.SqliteChecksumCache(
+            os.path.join(self.tmpd, "cache.db"))
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.tmpd)
+
+    def insert(self, store):
+        store.insert("item", contentsource.MemoryContentSource(
+            content=CONTENT), checksums=CHECKSUMS)
+
+    def test_unchanged_item_not_read(self):
+        store = objectstores.FileStore(self.target, checksum_cache=self.cache)
+        self.insert(store)
+        with mock.patch.object(objectstores, 'has_valid_checksum') as hvc:
+            self.assertTrue(store.exists_with_checksum("item", CHECKSUMS))
+            self.insert(store)
+        self.assertEqual(0, hvc.call_count)
+
+    def test_rehash(self):
+        store = objectstores.FileStore(self.target, checksum_cache=self.cache,
+                                       rehash=True)
+        self.insert(store)
+        with mock.patch.object(objectstores, 'has_valid_checksum',
+                               return_value=True) as hvc:
+            self.assertTrue(store.exists_with_checksum("item", CHECKSUMS))
+        self.assertEqual(1, hvc.call_count)
+
+    def test_modified_item_is_read(self):
+        store = objectstores.FileStore(self.target, checksum_cache=self.cache)
+        self.insert(store)
+        with open(os.path.join(self.target, "item"), "r+b") as fp:
+            fp.write(b"X")
+        self.assertFalse(store.exists_with_checksum("item", CHECKSUMS))
+        self.insert(store)
+        with open(os.path.join(self.target, "item"), "rb") as fp:
+            self.assertEqual(CONTENT, fp.read())
+
+    def test_no_cache_by_default(self):
+        store = objectstores.FileStore(self.target)
+        self.assertIsNone(store.checksum_cache)
+        self.insert(store)
+        if hasattr(os, 'listxattr'):
+            self.assertNotIn(
+                checksumcache.XATTR_NAME,
+                os.listxattr(os.path.join(self.target, "item")))
+
+    def test_disabled(self):
+        store = objectstores.FileStore(self.target, checksum_cache=False)
+        self.assertIsNone(store.checksum_cache)
+        self.insert(store)
+        self.assertTrue(store.exists_with_checksum("item", CHECKSUMS))
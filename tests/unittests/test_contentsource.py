@@ -1,3 +1,5 @@
+import errno
+import io
 import os
 import shutil
 import sys
@@ -5,7 +7,10 @@ import tempfile
 
 from os.path import join, dirname
 from simplestreams import objectstores
+from simplestreams import checksum_util
 from simplestreams import contentsource
+from simplestreams import urlpool
+from simplestreams import util
 from subprocess import Popen, PIPE, STDOUT
 from unittest import TestCase, skipIf
 from nose.tools import raises
@@ -324,6 +329,21 @@ class BaseReaderTest(BaseDirUsingTestCase):
 
         self.assertEqual(content, self.fdata)
 
+    def test_readinto(self):
+        buf = bytearray(5)
+        content = b''
+        fp = self.reader(self.geturl(self.fpath))
+        try:
+            while True:
+                count = fp.readinto(buf)
+                content += bytes(buf[:count])
+                if count != len(buf):
+                    break
+        finally:
+            fp.close()
+
+        self.assertEqual(content, self.fdata)
+
 
 @skipIf(contentsource.requests is None, "requests not available")
 class RequestsBase(object):
@@ -379,3 +399,245 @@ class UserAgentTests(BaseDirUsingTestCase):
     def test_urllib2_sends_user_agent_when_supplied(self):
         self.read_url(contentsource.Urllib2UrlReader, "myagent2")
         self.assertIn("myagent2", self.server.read_output())
+
+
+class TestPooledUrllib2UrlReader(BaseReaderTest):
+    __test__ = True
+    http = True
+
+    def setUp(self):
+        super(TestPooledUrllib2UrlReader, self).setUp()
+        self.pool = urlpool.UrlSessionPool()
+
+    def reader(self, url):
+        return contentsource.Urllib2UrlReader(url, pool=self.pool)
+
+    def test_missing_is_enoent(self):
+        with self.assertRaises(IOError) as ctx:
+            self.reader(self.geturl("does-not-exist"))
+        self.assertEqual(errno.ENOENT, ctx.exception.errno)
+
+
+@skipIf(contentsource.requests is None, "requests not available")
+class TestPooledRequestsUrlReader(BaseReaderTest):
+    __test__ = True
+    http = True
+
+    def setUp(self):
+        super(TestPooledRequestsUrlReader, self).setUp()
+        self.pool = urlpool.UrlSessionPool()
+
+    def reader(self, url):
+        return contentsource.RequestsUrlReader(url, pool=self.pool)
+
+
+class TestChunkBuffer(TestCase):
+    def chunks(self):
+        return iter([b"abc", b"", b"defgh", b"i", b"jklmnop"])
+
+    def test_read_all(self):
+        buf = contentsource.ChunkBuffer(self.chunks())
+        self.assertEqual(b"abcdefghijklmnop", buf.read())
+        self.assertEqual(b"", buf.read())
+
+    def test_reads_across_chunks(self):
+        buf = contentsource.ChunkBuffer(self.chunks())
+        found = []
+        while True:
+            data = buf.read(4)
+            if not data:
+                break
+            found.append(data)
+        self.assertEqual([b"abcd", b"efgh", b"ijkl", b"mnop"], found)
+
+    def test_read_whole_chunk_is_not_copied(self):
+        chunk = b"x" * 10
+        buf = contentsource.ChunkBuffer(iter([chunk]))
+        self.assertIs(chunk, buf.read(10))
+
+    def test_read_then_read_all(self):
+        buf = contentsource.ChunkBuffer(self.chunks())
+        self.assertEqual(b"ab", buf.read(2))
+        self.assertEqual(b"cdefghijklmnop", buf.read(-1))
+
+    def test_readinto(self):
+        buf = contentsource.ChunkBuffer(self.chunks())
+        target = bytearray(6)
+        self.assertEqual(6, buf.readinto(target))
+        self.assertEqual(b"abcdef", bytes(target))
+        self.assertEqual(6, buf.readinto(target))
+        self.assertEqual(b"ghijkl", bytes(target))
+        self.assertEqual(4, buf.readinto(target))
+        self.assertEqual(b"mnop", bytes(target[:4]))
+        self.assertEqual(0, buf.readinto(target))
+
+
+class TestIteratorContentSource(TestCase):
+    def getcs(self):
+        return contentsource.IteratorContentSource(
+            lambda: iter([b"abc", b"defgh", b"ij"]))
+
+    def test_read_sizes(self):
+        src = self.getcs()
+        self.assertEqual(b"abcd", src.read(4))
+        self.assertEqual(b"efghij", src.read(100))
+        self.assertEqual(b"", src.read(4))
+
+    def test_readinto(self):
+        src = self.getcs()
+        target = bytearray(8)
+        self.assertEqual(8, src.readinto(target))
+        self.assertEqual(b"abcdefgh", bytes(target))
+        self.assertEqual(b"ij", src.read())
+
+
+class TestChecksummingReadinto(TestCase):
+    data = b'hello world\n'
+    md5 = '6f5902ac237024bdd0c176cb93063dc4'
+
+    def getcs(self, md5=None):
+        src = contentsource.MemoryContentSource(content=self.data)
+        return contentsource.ChecksummingContentSource(
+            src, {'md5': md5 or self.md5}, size=len(self.data))
+
+    def test_readinto_checks(self):
+        src = self.getcs()
+        buf = bytearray(5)
+        content = b''
+        while True:
+            count = src.readinto(buf)
+            content += bytes(buf[:count])
+            if count != len(buf):
+                break
+        self.assertEqual(self.data, content)
+        self.assertTrue(src.check())
+
+    def test_readinto_bad_checksum(self):
+        src = self.getcs(md5='0' * 32)
+        buf = bytearray(64)
+        with self.assertRaises(checksum_util.InvalidChecksum):
+            src.readinto(buf)
+
+
+class TestDecompressingContentSource(TestCase):
+    data = b'{"format": "products:1.0"}\n' * 5000
+
+    def getcs(self, suffix, content=None):
+        if content is None:
+            content = util.compress_data(self.data, suffix)
+        # MemoryContentSource would take the bytes for text on python2.
+        return contentsource.DecompressingContentSource(
+            contentsource.FdContentSource(fd=io.BytesIO(content)), suffix)
+
+    def test_read_gz(self):
+        self.assertEqual(self.data, self.getcs('.gz').read())
+
+    @skipIf(contentsource.lzma is None, "lzma not available")
+    def test_read_xz(self):
+        self.assertEqual(self.data, self.getcs('.xz').read())
+
+    def test_readinto(self):
+        src = self.getcs('.gz')
+        buf = bytearray(len(self.data) + 10)
+        self.assertEqual(len(self.data), src.readinto(buf))
+        self.assertEqual(self.data, bytes(buf[:len(self.data)]))
+
+    def test_already_decoded_passes_through(self):
+        src = self.getcs('.gz', content=self.data)
+        self.assertEqual(self.data, src.read())
+
+    def test_truncated(self):
+        content = util.compress_data(self.data, '.gz')
+        src = self.getcs('.gz', content=content[:len(content) // 2])
+        self.assertRaises(Exception, src.read)
+
+    def test_compress_is_reproducible(self):
+        self.assertEqual(util.compress_data(self.data, '.gz'),
+                         util.compress_data(self.data, '.gz'))
+
+
+class FlakyReader(object):
+    # serves data from offset, raising error once read reaches fail_at.
+    def __init__(self, data, offset, fail_at=None, error=None):
+        self.data = data
+        self.pos = offset or 0
+        self.fail_at = fail_at
+        self.error = error
+
+    def read(self, size=-1):
+        end = len(self.data) if size < 0 else self.pos + size
+        if self.fail_at is not None and end > self.fail_at:
+            if self.error is None:
+                # the connection was closed early.
+                end = self.fail_at
+            else:
+                raise self.error
+        ret = self.data[self.pos:end]
+        self.pos += len(ret)
+        return ret
+
+    def close(self):
+        pass
+
+
+class TestChecksummingRetry(TestCase):
+    data = b'0123456789' * 100
+    md5 = '427008b3fe192f663d665f56cd75716c'
+
+    def getcs(self, failures, retries=3):
+        # failures is a list of (fail_at, error) for successive opens.
+        self.offsets = []
+        failures = list(failures)
+
+        def url_reader(url, offset=None, **kwargs):
+            self.offsets.append(offset)
+            fail_at, error = failures.pop(0) if failures else (None, None)
+            return FlakyReader(self.data, offset, fail_at, error)
+
+        src = contentsource.UrlContentSource("http://example.com/f",
+                                             url_reader=url_reader)
+        return contentsource.ChecksummingContentSource(
+            src, {'md5': self.md5}, size=len(self.data), retries=retries,
+            retry_delay=0)
+
+    def read_all(self, src, size=64):
+        content = b''
+        while True:
+            buf = src.read(size)
+            content += buf
+            if len(buf) != size:
+                return content
+
+    def test_resumes_after_reset(self):
+        src = self.getcs([(300, IOError(errno.ECONNRESET, "reset")),
+                          (700, IOError(errno.ECONNRESET, "reset"))])
+        self.assertEqual(self.data, self.read_all(src))
+        self.assertTrue(src.check())
+        self.assertEqual([None, 256, 640], self.offsets)
+
+    def test_resumes_after_early_end(self):
+        src = self.getcs([(500, None)])
+        self.assertEqual(self.data, self.read_all(src))
+        self.assertEqual([None, 448], self.offsets)
+
+    def test_readinto_resumes(self):
+        src = self.getcs([(500, IOError(errno.ETIMEDOUT, "timed out"))])
+        buf = bytearray(len(self.data))
+        self.assertEqual(len(self.data), src.readinto(buf))
+        self.assertEqual(self.data, bytes(buf))
+
+    def test_gives_up_after_retries(self):
+        error = IOError(errno.ECONNRESET, "reset")
+        src = self.getcs([(300, error)] * 3, retries=2)
+        self.assertRaises(IOError, self.read_all, src)
+        self.assertEqual(3, len(self.offsets))
+
+    def test_no_retry_for_missing(self):
+        error = IOError(errno.ENOENT, "gone")
+        src = self.getcs([(300, error)])
+        self.assertRaises(IOError, self.read_all, src)
+        self.assertEqual([None], self.offsets)
+
+    def test_no_retries_by_default(self):
+        src = self.getcs([(500, None)], retries=0)
+        self.assertRaises(checksum_util.InvalidChecksum, self.read_all, src)
@@ -1,5 +1,6 @@
 from contextlib import contextmanager
 from copy import deepcopy
+import gzip
 import json
 import os
 import shutil
@@ -264,3 +265,16 @@ class TestWriteStreams(TestCase):
                 'item-1': {'arch': 'amd64'},
                 'item-2': {'arch': 'amd64'}, }}}}}}
         self.assertEqual(bar, expected)
+
+    def test_compressed_copies(self):
+        trees = {'bar': {'products': {'prodbar': {}}}}
+        with temp_dir() as out_dir, patch('sys.stderr', StringIO()):
+            filenames = write_streams(out_dir, trees, self.updated,
+                                      FakeNamer, compress=['.gz'])
+            with gzip.open(os.path.join(out_dir, 'bar.json.gz')) as fp:
+                bar = json.loads(fp.read().decode('utf-8'))
+        self.assertEqual(sorted([
+            os.path.join(out_dir, name) for name in
+            ('foo.json', 'foo.json.gz', 'bar.json', 'bar.json.gz')]),
+            sorted(filenames))
+        self.assertEqual({'products': {'prodbar': {}}}, bar)
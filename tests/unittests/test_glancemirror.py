@@ -486,8 +486,9 @@ class TestGlanceMirror(TestCase):
         self.assertEqual(omd5, md5)
 
     def test_download_image_progress_callback(self):
-        # Progress callback is called with image name, size, status and buffer
-        # size after every 10kb of data: 3 times for 25kb of data below.
+        # Progress callback is called with image name, size, status and the
+        # bytes read after every block of util.READ_SIZE (1Mb) of data: once
+        # for 25kb of data below.
         content = "abcdefghij" * int(1024 * 2.5)
         content_source = MemoryContentSource(
             url="http://image-store/fooubuntu-X-disk1.img", content=content)
@@ -508,7 +509,7 @@ class TestGlanceMirror(TestCase):
 
         self.assertEqual(
             [{"name": "foobuntu-X", "size": 25600, "status": "Downloading",
-              "written": 10240}] * 3,
+              "written": 25600}],
             self.progress_calls)
 
     def test_download_image_error(self):
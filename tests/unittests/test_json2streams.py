@@ -197,7 +197,8 @@ class TestParseArgs(TestCase):
     def test_defaults(self):
         args = parse_args(['file1', 'outdir'])
         self.assertEqual(
-            Namespace(items_file=['file1'], out_d='outdir', juju_format=False),
+            Namespace(items_file=['file1'], out_d='outdir', juju_format=False,
+                      compress=[]),
             args)
 
     def test_multiple_files(self):
@@ -209,3 +210,7 @@ class TestParseArgs(TestCase):
     def test_juju_format(self):
         args = parse_args(['file1', 'outdir', '--juju-format'])
         self.assertIs(True, args.juju_format)
+
+    def test_compress(self):
+        args = parse_args(['file1', 'outdir', '--compress', 'gz'])
+        self.assertEqual(['gz'], args.compress)
@@ -0,0 +1,47 @@
+import json
+from unittest import TestCase
+
+from simplestreams.jsonstream import ProductsStream
+
+DOC = {
+    "_aliases": {"arch": {"x": {"arch": "amd64"}}},
+    "content_id": "com.example:download",
+    "format": "products:1.0",
+    "products": {
+        "p1": {"versions": {"v1": {"items": {
+            "i1": {"path": "a/{b}[c]\"d\".img", "size": 1}}}}},
+        "p2": {"arch": "x", "label": u"caf\u00e9", "versions": {}},
+    },
+    "updated": "Mon, 01 Jan 2018 00:00:00 +0000",
+}
+
+
+class TestProductsStream(TestCase):
+    def test_header_and_products(self):
+        for indent in (None, 1):
+            stream = ProductsStream(json.dumps(DOC, indent=indent,
+                                               sort_keys=True))
+            header = dict(DOC)
+            del header['products']
+            self.assertEqual(header, stream.header)
+            self.assertEqual(DOC['products'], dict(stream))
+
+    def test_bytes(self):
+        stream = ProductsStream(json.dumps(DOC).encode('utf-8'))
+        self.assertEqual(["p1", "p2"], sorted(name for name, _ in stream))
+
+    def test_products_not_an_object(self):
+        stream = ProductsStream('{"format": "products:1.0", "products": []}')
+        self.assertEqual([], stream.header['products'])
+        self.assertEqual([], list(stream))
+
+    def test_no_products(self):
+        index = {"format": "index:1.0", "index": {"a": {"path": "a.json"}}}
+        stream = ProductsStream(json.dumps(index))
+        self.assertEqual(index, stream.header)
+        self.assertEqual([], list(stream))
+
+    def test_invalid(self):
+        for text in ('[]', '{"a": 1', '{"a": 1} x', '{"a" 1}',
+                     '{"a": 1 "b": 2}', '{"products": {"a": }}'):
+            self.assertRaises(ValueError, ProductsStream, text)
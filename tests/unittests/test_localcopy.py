@@ -0,0 +1,108 @@
+import errno
+import hashlib
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import mock
+
+from simplestreams import checksum_util
+from simplestreams import contentsource
+from simplestreams import localcopy
+from simplestreams import objectstores
+
+CONTENT = b"local content\n" * 1000
+
+
+class TestLocalCopy(TestCase):
+    def setUp(self):
+        self.tmpd = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmpd, "src")
+        with open(self.src, "wb") as fp:
+            fp.write(CONTENT)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpd)
+
+    def read(self, path):
+        with open(path, "rb") as fp:
+            return fp.read()
+
+    def test_source_path(self):
+        src = contentsource.UrlContentSource("file://" + self.src)
+        self.assertEqual(self.src, localcopy.source_path(src))
+        self.assertEqual(self.src, localcopy.source_path(
+            contentsource.UrlContentSource(self.src)))
+        ck = contentsource.ChecksummingContentSource(
+            src, {'md5': hashlib.md5(CONTENT).hexdigest()}, len(CONTENT))
+        self.assertEqual(self.src, localcopy.source_path(ck))
+
+    def test_source_path_not_local(self):
+        self.assertIsNone(localcopy.source_path(
+            contentsource.UrlContentSource("http://example.com/f")))
+        self.assertIsNone(localcopy.source_path(
+            contentsource.UrlContentSource(self.src + ".missing")))
+        self.assertIsNone(localcopy.source_path(
+            contentsource.MemoryContentSource(content=CONTENT)))
+        resumed = contentsource.UrlContentSource(self.src)
+        resumed.set_start_pos(10)
+        self.assertIsNone(localcopy.source_path(resumed))
+
+    def test_copy(self):
+        dst = os.path.join(self.tmpd, "dst")
+        method = localcopy.copy_file(self.src, dst)
+        self.assertNotEqual("hardlink", method)
+        self.assertEqual(CONTENT, self.read(dst))
+        self.assertNotEqual(os.stat(self.src).st_ino, os.stat(dst).st_ino)
+
+    def test_hardlink(self):
+        dst = os.path.join(self.tmpd, "dst")
+        self.assertEqual("hardlink",
+                         localcopy.copy_file(self.src, dst, hardlink=True))
+        self.assertEqual(os.stat(self.src).st_ino, os.stat(dst).st_ino)
+
+    def test_falls_back_to_plain_copy(self):
+        dst = os.path.join(self.tmpd, "dst")
+        unsupported = OSError(errno.EXDEV, "cross device")
+        with mock.patch.object(localcopy, '_reflink', return_value=False):
+            with mock.patch.object(localcopy.os, 'copy_file_range',
+                                   side_effect=unsupported, create=True):
+                self.assertEqual("copy", localcopy.copy_file(self.src, dst))
+        self.assertEqual(CONTENT, self.read(dst))
+
+
+class TestFileStoreLocalInsert(TestCase):
+    def setUp(self):
+        self.tmpd = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmpd, "src")
+        with open(self.src, "wb") as fp:
+            fp.write(CONTENT)
+        self.target = os.path.join(self.tmpd, "target")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpd)
+
+    def insert(self, md5, hardlink=False):
+        store = objectstores.FileStore(self.target, hardlink=hardlink)
+        reader = contentsource.ChecksummingContentSource(
+            contentsource.UrlContentSource("file://" + self.src),
+            {'md5': md5}, len(CONTENT))
+        with mock.patch.object(reader, 'read') as read:
+            store.insert("a/item", reader, size=len(CONTENT))
+            self.assertFalse(read.called)
+        return os.path.join(self.target, "a/item")
+
+    def test_insert(self):
+        dst = self.insert(hashlib.md5(CONTENT).hexdigest())
+        with open(dst, "rb") as fp:
+            self.assertEqual(CONTENT, fp.read())
+
+    def test_insert_hardlink(self):
+        dst = self.insert(hashlib.md5(CONTENT).hexdigest(), hardlink=True)
+        self.assertEqual(os.stat(self.src).st_ino, os.stat(dst).st_ino)
+
+    def test_bad_checksum(self):
+        self.assertRaises(checksum_util.InvalidChecksum, self.insert,
+                          "0" * 32)
+        self.assertEqual([], os.listdir(os.path.join(self.target, "a")))
@@ -0,0 +1,107 @@
+import shutil
+import tempfile
+from unittest import TestCase
+
+from simplestreams import contentsource
+from simplestreams import metacache
+from simplestreams import mirrors
+
+CONTENT = b'{"format": "index:1.0"}'
+
+
+class FakeHttpReader(contentsource.UrlReader):
+    # answers conditional requests for CONTENT with etag "v1".
+    requests = []
+    etag = '"v1"'
+
+    def __init__(self, url, offset=None, headers=None):
+        self.requests.append(headers or {})
+        self.data = CONTENT
+        self.status = 200
+        self.response_headers = {'etag': self.etag}
+        if (headers or {}).get('If-None-Match') == self.etag:
+            self.status = 304
+            self.data = b''
+
+    def read(self, size=-1):
+        ret, self.data = self.data, b''
+        return ret
+
+    def close(self):
+        pass
+
+
+class TestMetadataCache(TestCase):
+    def setUp(self):
+        self.tmpd = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpd)
+
+    def test_roundtrip(self):
+        cache = metacache.MetadataCache(self.tmpd)
+        self.assertIsNone(cache.get("http://x/a"))
+        cache.put("http://x/a", "raw", "payload",
+                  {'etag': '"1"', 'last-modified': 'yesterday'})
+        entry = cache.get("http://x/a")
+        self.assertEqual("payload", entry['payload'])
+        self.assertEqual({'If-None-Match': '"1"',
+                          'If-Modified-Since': 'yesterday'},
+                         cache.request_headers(entry))
+
+    def test_without_validators_not_stored(self):
+        cache = metacache.MetadataCache(self.tmpd)
+        cache.put("http://x/a", "raw", "payload", {})
+        self.assertIsNone(cache.get("http://x/a"))
+
+    def test_namespaces_are_separate(self):
+        signed = metacache.signed_policy_cache(self.tmpd, checked=True)
+        unsigned = metacache.signed_policy_cache(self.tmpd, checked=False)
+        unsigned.put("http://x/a", "raw", "payload", {'etag': '"1"'})
+        self.assertIsNone(signed.get("http://x/a"))
+        self.assertIsNone(metacache.signed_policy_cache(None))
+
+
+class TestCachedReadJson(TestCase):
+    def setUp(self):
+        self.tmpd = tempfile.mkdtemp()
+        FakeHttpReader.requests = []
+        self.policy_calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpd)
+
+    def policy(self, content, path):
+        self.policy_calls.append(path)
+        return content
+
+    def getreader(self):
+        reader = mirrors.UrlMirrorReader(
+            "http://example.com/", policy=self.policy, user_agent=None,
+            pool_maxsize=0, cache=metacache.MetadataCache(self.tmpd))
+
+        def fake_cs(url, **kwargs):
+            kwargs['url_reader'] = FakeHttpReader
+            return contentsource.UrlContentSource(url, **kwargs)
+
+        reader._cs = fake_cs
+        return reader
+
+    def test_not_modified_uses_cache(self):
+        first = self.getreader().read_json("streams/v1/index.json")
+        second = self.getreader().read_json("streams/v1/index.json")
+        self.assertEqual(first, second)
+        self.assertEqual(CONTENT.decode(), second[1])
+        # the policy (signature check) only ran for the full download.
+        self.assertEqual(["streams/v1/index.json"], self.policy_calls)
+        self.assertEqual([{}, {'If-None-Match': '"v1"'}],
+                         FakeHttpReader.requests)
+
+    def test_changed_content_is_downloaded(self):
+        self.getreader().read_json("streams/v1/index.json")
+        FakeHttpReader.etag = '"v2"'
+        try:
+            self.getreader().read_json("streams/v1/index.json")
+        finally:
+            FakeHttpReader.etag = '"v1"'
+        self.assertEqual(2, len(self.policy_calls))
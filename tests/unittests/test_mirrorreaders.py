@@ -1,4 +1,8 @@
+import os
+import shutil
+import tempfile
 from unittest import TestCase
+from simplestreams import util
 from simplestreams.mirrors import UrlMirrorReader
 from simplestreams.contentsource import URL_READER
 import simplestreams.mirrors
@@ -114,3 +118,92 @@ class TestUrlMirrorReader(TestCase):
 
         # Restore default UrlReader.
         simplestreams.mirrors.cs.URL_READER = URL_READER
+
+
+class TestStripedUrlMirrorReader(TestCase):
+    def getreader(self):
+        return UrlMirrorReader("http://a/", mirrors=["http://b/", "http://c/"],
+                               user_agent=None, stripe=True,
+                               policy=lambda content, path: content)
+
+    def test_sources_rotate_over_mirrors(self):
+        reader = self.getreader()
+        firsts = [reader.source("some/path").input_url for _ in range(4)]
+        self.assertEqual(["http://a/some/path", "http://b/some/path",
+                          "http://c/some/path", "http://a/some/path"], firsts)
+        cs = reader.source("some/path")
+        self.assertTrue(cs.stripe)
+        self.assertEqual(["http://c/some/path", "http://a/some/path"],
+                         cs.mirrors)
+
+    def test_unhealthy_mirrors_go_last(self):
+        reader = self.getreader()
+        for _ in range(reader.selector.failure_threshold):
+            reader.selector.record_failure("http://b/x")
+        firsts = [reader.source("p").input_url for _ in range(2)]
+        self.assertEqual(["http://a/p", "http://c/p"], firsts)
+        self.assertEqual("http://b/p", reader.source("p").mirrors[-1])
+
+    def test_read_json_starts_at_prefix(self):
+        reader = self.getreader()
+        opened = []
+
+        def fake_cs(url, **kwargs):
+            opened.append(url)
+            return simplestreams.contentsource.MemoryContentSource(
+                url=url, content='{}')
+
+        reader._cs = fake_cs
+        reader.source("x")
+        reader.read_json("streams/v1/index.json")
+        self.assertEqual("http://a/streams/v1/index.json", opened[-1])
+
+
+class TestCompressedUrlMirrorReader(TestCase):
+    content = '{"format": "index:1.0"}\n'
+
+    def setUp(self):
+        self.tmpd = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpd)
+        self.path = "streams/v1/index.json"
+        os.makedirs(os.path.join(self.tmpd, "streams/v1"))
+        self.fpath = os.path.join(self.tmpd, self.path)
+
+    def getreader(self, prefix=None, compressed=True):
+        if prefix is None:
+            prefix = "file://" + self.tmpd + "/"
+        return UrlMirrorReader(prefix, user_agent=None, compressed=compressed,
+                               policy=lambda content, path: content)
+
+    def test_reads_compressed_variant(self):
+        util.write_compressed(self.fpath, self.content.encode('utf-8'),
+                              ['.gz'])
+        raw, payload = self.getreader().read_json(self.path)
+        self.assertEqual(self.content, raw)
+
+    def test_falls_back_to_uncompressed(self):
+        with open(self.fpath, "w") as fp:
+            fp.write(self.content)
+        raw, payload = self.getreader().read_json(self.path)
+        self.assertEqual(self.content, raw)
+
+    def test_prefers_compressed(self):
+        with open(self.fpath, "w") as fp:
+            fp.write('{"stale": true}\n')
+        util.write_compressed(self.fpath, self.content.encode('utf-8'),
+                              ['.gz'])
+        self.assertEqual(self.content,
+                         self.getreader().read_json(self.path)[0])
+        self.assertEqual('{"stale": true}\n',
+                         self.getreader(compressed=False).read_json(
+                             self.path)[0])
+
+    def test_trailing_slash_checked_on_uncompressed(self):
+        # a missing compressed variant must not look like a missing /.
+        with open(self.fpath, "w") as fp:
+            fp.write(self.content)
+        prefix = self.tmpd + "/streams"
+        reader = self.getreader(prefix=prefix)
+        self.assertEqual(self.content,
+                         reader.read_json("/v1/index.json")[0])
+        self.assertEqual(prefix, reader.prefix)
@@ -0,0 +1,300 @@
+import errno
+import mock
+import socket
+import threading
+import time
+from unittest import TestCase
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from simplestreams import contentsource
+from simplestreams import mirrors
+from simplestreams import mirrorselect
+
+CONTENT = b"0123456789" * 10
+
+
+class FakeReader(object):
+    # serves CONTENT for any url, honoring offset.  behavior maps a url
+    # prefix to a callable run on open or an offset to stall at.
+    def __init__(self, url, offset=None, timeout=None, behavior=None):
+        self.url = url
+        self.pos = offset or 0
+        self.stall_at = None
+        for prefix, action in (behavior or {}).items():
+            if url.startswith(prefix):
+                if callable(action):
+                    action()
+                else:
+                    self.stall_at = action
+        self.closed = False
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            end = len(CONTENT)
+        else:
+            end = min(self.pos + size, len(CONTENT))
+        if self.stall_at is not None and end > self.stall_at:
+            # like a socket read, data received before the timeout is lost
+            raise socket.timeout("timed out")
+        ret = CONTENT[self.pos:end]
+        self.pos += len(ret)
+        return ret
+
+    def close(self):
+        self.closed = True
+
+
+def reader_factory(behavior):
+    def factory(url, offset=None, timeout=None):
+        return FakeReader(url, offset=offset, timeout=timeout,
+                          behavior=behavior)
+    return factory
+
+
+def enoent():
+    err = IOError("not found")
+    err.errno = errno.ENOENT
+    raise err
+
+
+def server_error():
+    raise IOError("503 Service Unavailable")
+
+
+class TestMirrorSelector(TestCase):
+    bases = ["http://a/", "http://b/", "http://c/"]
+
+    def test_unmeasured_keep_order(self):
+        sel = mirrorselect.MirrorSelector(self.bases)
+        urls = [b + "x" for b in self.bases]
+        self.assertEqual(urls, sel.rank(urls))
+
+    def test_rank_by_latency_and_throughput(self):
+        sel = mirrorselect.MirrorSelector(self.bases)
+        sel.record_latency("http://a/x", 1.0)
+        sel.record_latency("http://b/x", 0.1)
+        sel.record_latency("http://c/x", 0.1)
+        sel.record_transfer("http://b/x", 1024, 1.0)
+        sel.record_transfer("http://c/x", 1024 * 1024 * 100, 1.0)
+        urls = [b + "y" for b in self.bases]
+        self.assertEqual(["http://c/y", "http://a/y", "http://b/y"],
+                         sel.rank(urls))
+
+    def test_circuit_breaker(self):
+        sel = mirrorselect.MirrorSelector(self.bases, failure_threshold=2,
+                                          reset_time=60)
+        sel.record_failure("http://a/x")
+        self.assertTrue(sel.is_healthy("http://a/x"))
+        sel.record_failure("http://a/x")
+        self.assertFalse(sel.is_healthy("http://a/y"))
+        urls = [b + "y" for b in self.bases]
+        self.assertEqual("http://a/y", sel.rank(urls)[-1])
+
+        sel.stats["http://a/"].tripped_at = time.time() - 61
+        self.assertTrue(sel.is_healthy("http://a/y"))
+
+    def test_success_resets_failures(self):
+        sel = mirrorselect.MirrorSelector(self.bases, failure_threshold=2)
+        sel.record_failure("http://a/x")
+        sel.record_latency("http://a/x", 0.1)
+        sel.record_failure("http://a/x")
+        self.assertTrue(sel.is_healthy("http://a/x"))
+
+    def test_is_mirror_failure(self):
+        self.assertTrue(mirrorselect.is_mirror_failure(socket.timeout()))
+        err = IOError("nope")
+        err.errno = errno.ENOENT
+        self.assertFalse(mirrorselect.is_mirror_failure(err))
+        err = IOError("forbidden")
+        err.code = 403
+        self.assertFalse(mirrorselect.is_mirror_failure(err))
+        err.code = 502
+        self.assertTrue(mirrorselect.is_mirror_failure(err))
+        self.assertFalse(mirrorselect.is_mirror_failure(ValueError()))
+
+    def test_open_skips_enoent_and_failures(self):
+        sel = mirrorselect.MirrorSelector(self.bases, failure_threshold=1)
+
+        def opener(url):
+            if url.startswith("http://a/"):
+                enoent()
+            if url.startswith("http://b/"):
+                server_error()
+            return FakeReader(url)
+
+        (url, _) = sel.open([b + "x" for b in self.bases], opener)
+        self.assertEqual("http://c/x", url)
+        self.assertTrue(sel.is_healthy("http://a/x"))
+        self.assertFalse(sel.is_healthy("http://b/x"))
+
+    def test_open_all_enoent(self):
+        sel = mirrorselect.MirrorSelector(self.bases)
+
+        def opener(url):
+            enoent()
+
+        with self.assertRaises(IOError) as ctx:
+            sel.open([b + "x" for b in self.bases], opener)
+        self.assertEqual(errno.ENOENT, ctx.exception.errno)
+
+    def test_open_hedges_slow_mirror(self):
+        sel = mirrorselect.MirrorSelector(self.bases, hedge_delay=0.05)
+        release = threading.Event()
+        opened = []
+
+        def opener(url):
+            if url.startswith("http://a/"):
+                release.wait(5)
+            reader = FakeReader(url)
+            opened.append(reader)
+            return reader
+
+        (url, _) = sel.open([b + "x" for b in self.bases], opener)
+        self.assertEqual("http://b/x", url)
+        release.set()
+        for _ in range(100):
+            if len(opened) == 2:
+                break
+            time.sleep(0.01)
+        # the slow response is closed once it arrives.
+        self.assertTrue(opened[1].closed)
+
+    def test_open_shares_one_executor(self):
+        sel = mirrorselect.MirrorSelector(self.bases)
+        threads = set()
+
+        def opener(url):
+            threads.add(threading.current_thread())
+            return FakeReader(url)
+
+        urls = [b + "x" for b in self.bases]
+        sel.open(urls, opener)
+        executor = sel._executor
+        sel.open(urls, opener)
+        self.assertIs(executor, sel._executor)
+        self.assertNotIn(threading.current_thread(), threads)
+        sel.close()
+        self.assertIsNone(sel._executor)
+
+    def test_open_one_url_in_caller_thread(self):
+        sel = mirrorselect.MirrorSelector(self.bases)
+        threads = []
+
+        def opener(url):
+            threads.append(threading.current_thread())
+            return FakeReader(url)
+
+        (url, _) = sel.open(["http://a/x"], opener)
+        self.assertEqual("http://a/x", url)
+        self.assertEqual([threading.current_thread()], threads)
+        self.assertIsNone(sel._executor)
+
+
+class TestSelectedContentSource(TestCase):
+    bases = ["http://a/", "http://b/"]
+
+    def getcs(self, behavior, **kwargs):
+        sel = mirrorselect.MirrorSelector(self.bases, **kwargs)
+        return contentsource.UrlContentSource(
+            "http://a/f", mirrors=["http://b/f"],
+            url_reader=reader_factory(behavior), selector=sel)
+
+    def test_resumes_from_next_mirror_on_stall(self):
+        src = self.getcs({"http://a/": 25})
+        data = b""
+        while True:
+            buf = src.read(10)
+            data += buf
+            if len(buf) != 10:
+                break
+        self.assertEqual(CONTENT, data)
+        self.assertEqual("http://b/f", src.url)
+        src.close()
+        self.assertEqual(1, src.selector.stats["http://a/"].failures)
+
+    def test_readinto_resumes(self):
+        src = self.getcs({"http://a/": 42})
+        buf = bytearray(len(CONTENT))
+        count = src.readinto(buf)
+        self.assertEqual(len(CONTENT), count)
+        self.assertEqual(CONTENT, bytes(buf))
+
+    def test_raises_when_all_mirrors_stall(self):
+        src = self.getcs({"http://a/": 20, "http://b/": 30})
+        with self.assertRaises(socket.timeout):
+            while src.read(10):
+                pass
+
+    def test_uses_faster_mirror(self):
+        src = self.getcs({})
+        src.selector.record_latency("http://a/x", 2.0)
+        src.selector.record_latency("http://b/x", 0.1)
+        self.assertEqual(CONTENT, src.read())
+        self.assertEqual("http://b/f", src.url)
+
+
+class StallingHandler(BaseHTTPRequestHandler):
+    # serves CONTENT under /good/, honoring Range, and the first 30 bytes
+    # of it under /stall/ before going quiet until the server is done.
+    def do_GET(self):
+        start = 0
+        if self.headers.get('Range'):
+            start = int(self.headers['Range'].split('=')[1].rstrip('-'))
+        self.send_response(206 if start else 200)
+        self.send_header('Content-Length', str(len(CONTENT) - start))
+        self.end_headers()
+        if self.path.startswith("/stall/"):
+            self.wfile.write(CONTENT[:30])
+            self.wfile.flush()
+            self.server.done.wait(10)
+        else:
+            self.wfile.write(CONTENT[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class TestStalledTransfer(TestCase):
+    def setUp(self):
+        server = ThreadingServer(("127.0.0.1", 0), StallingHandler)
+        server.done = threading.Event()
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.addCleanup(server.done.set)
+        self.base = "http://127.0.0.1:%d/" % server.server_address[1]
+
+    def test_default_timeout_with_selector(self):
+        sel = mirrorselect.MirrorSelector(["http://a/"], timeout=None)
+        self.assertEqual(mirrorselect.DEFAULT_TIMEOUT, sel.timeout)
+        reader = mirrors.UrlMirrorReader("http://a/", select_mirrors=True)
+        self.assertEqual(mirrorselect.DEFAULT_TIMEOUT, reader.timeout)
+        reader.close()
+
+    def test_stall_resumes_on_next_mirror_by_default(self):
+        with mock.patch.object(mirrorselect, 'DEFAULT_TIMEOUT', 0.5):
+            reader = mirrors.UrlMirrorReader(
+                self.base + "stall/", mirrors=[self.base + "good/"],
+                select_mirrors=True)
+        self.addCleanup(reader.close)
+        data = b""
+        with reader.source("item") as src:
+            while True:
+                buf = src.read(10)
+                data += buf
+                if len(buf) != 10:
+                    break
+            self.assertEqual(self.base + "good/item", src.url)
+        self.assertEqual(CONTENT, data)
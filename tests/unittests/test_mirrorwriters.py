@@ -1,10 +1,22 @@
 from tests.testutil import get_mirror_reader
 from simplestreams.filters import get_filters
 from simplestreams.mirrors import DryRunMirrorWriter, ObjectFilterMirror
-from simplestreams.objectstores import MemoryObjectStore
+from simplestreams import mirrors
+from simplestreams.objectstores import MemoryObjectStore, ObjectStore
+from simplestreams.objectstores import StoredObject, inventory_matches
+from simplestreams.util import load_content
 
 from unittest import TestCase
 
+import hashlib
+import json
+import mock
+import threading
+
+# json lines rather than json.
+JOURNAL = ".data/references.journal"
+REFERENCES = ".data/references.json"
+
 
 class TestMirrorWriters(TestCase):
     def test_DryRunMirrorWriter_foocloud_no_filters(self):
@@ -26,3 +38,276 @@ class TestMirrorWriters(TestCase):
         unexpected = [f for f in objectstore.data if 'disk' in f]
         assert len(unexpected) == 0
         assert len(objectstore.data) != 0
+
+
+class TestParallelItemDownloads(TestCase):
+    def sync(self, config, objectstore=None):
+        if objectstore is None:
+            objectstore = MemoryObjectStore(None)
+        target = ObjectFilterMirror(config, objectstore)
+        target.concurrent_items = True
+        target.sync(get_mirror_reader("foocloud"), "streams/v1/index.json")
+        return objectstore
+
+    def test_parallel_matches_serial(self):
+        serial = self.sync({})
+        parallel = self.sync({'max_parallel_downloads': 4})
+        self.assertEqual(sorted(serial.data.keys()),
+                         sorted(parallel.data.keys()))
+        for path in serial.data:
+            expected, found = serial.data[path], parallel.data[path]
+            if path.startswith(".data/") and path != JOURNAL:
+                # json content may be rendered in a different order
+                expected, found = load_content(expected), load_content(found)
+            self.assertEqual(expected, found, "content differs for %s" % path)
+
+    def test_parallel_is_opt_in(self):
+        threads = set()
+
+        class RecordingMirror(ObjectFilterMirror):
+            def insert_item(self, *args):
+                threads.add(threading.current_thread())
+                return super(RecordingMirror, self).insert_item(*args)
+
+        target = RecordingMirror({'max_parallel_downloads': 4},
+                                 MemoryObjectStore(None))
+        target.sync(get_mirror_reader("foocloud"), "streams/v1/index.json")
+        self.assertEqual(set([threading.current_thread()]), threads)
+
+    def test_item_error_aborts_product(self):
+        class FailingStore(MemoryObjectStore):
+            def insert(self, path, reader, checksums=None, mutable=True,
+                       size=None):
+                if path.endswith("i386-disk1.img"):
+                    raise IOError("fail %s" % path)
+                return super(FailingStore, self).insert(
+                    path, reader, checksums=checksums, mutable=mutable,
+                    size=size)
+
+        store = FailingStore(None)
+        self.assertRaises(IOError, self.sync,
+                          {'max_parallel_downloads': 4}, store)
+        self.assertNotIn(".data/com.example.foovendor:released:download",
+                         store.data)
+
+
+class TestStreamProducts(TestCase):
+    def sync(self, config):
+        objectstore = MemoryObjectStore(None)
+        target = ObjectFilterMirror(config, objectstore)
+        target.sync(get_mirror_reader("foocloud"), "streams/v1/index.json")
+        return objectstore
+
+    def assertSameMirror(self, config):
+        expected = self.sync(config)
+        config = dict(config, stream_products=True)
+        found = self.sync(config)
+        self.assertEqual(sorted(expected.data.keys()),
+                         sorted(found.data.keys()))
+        for path in expected.data:
+            old, new = expected.data[path], found.data[path]
+            if path.startswith(".data/") and path != JOURNAL:
+                old, new = load_content(old), load_content(new)
+            self.assertEqual(old, new, "content differs for %s" % path)
+
+    def test_matches_tree_sync(self):
+        self.assertSameMirror({})
+
+    def test_matches_tree_sync_filtered(self):
+        self.assertSameMirror({'filters': get_filters(['arch=amd64']),
+                               'max_items': 1})
+
+    def test_dry_run_size(self):
+        target = DryRunMirrorWriter({'stream_products': True},
+                                    MemoryObjectStore(None))
+        target.sync(get_mirror_reader("foocloud"), "streams/v1/index.json")
+        self.assertEqual(1277, target.size)
+
+
+class CountingStore(MemoryObjectStore):
+    def __init__(self, data=None):
+        super(CountingStore, self).__init__(data)
+        self.inserted = []
+
+    def insert(self, path, reader, checksums=None, mutable=True, size=None):
+        self.inserted.append(path)
+        super(CountingStore, self).insert(path, reader, checksums=checksums,
+                                          mutable=mutable, size=size)
+
+
+class RewritingStore(MemoryObjectStore):
+    # a store like S3 or swift, which can only append by rewriting.
+    appends_in_place = False
+
+    def __init__(self, data=None):
+        super(RewritingStore, self).__init__(data)
+        self.written = []
+
+    def insert(self, path, reader, checksums=None, mutable=True, size=None):
+        self.written.append(path)
+        super(RewritingStore, self).insert(path, reader, checksums=checksums,
+                                           mutable=mutable, size=size)
+
+    append_content = ObjectStore.append_content
+
+
+class TestReferenceJournal(TestCase):
+    def sync(self, store):
+        target = ObjectFilterMirror({}, store)
+        target.sync(get_mirror_reader("foocloud"), "streams/v1/index.json")
+        return target
+
+    def test_rewriting_store_not_written_per_item(self):
+        store = RewritingStore()
+        self.sync(store)
+        items = json.loads(store.data[REFERENCES].decode('utf-8'))
+        products = [p for p in store.written
+                    if p.startswith(".data/") and
+                    p not in (REFERENCES, JOURNAL)]
+        # the journal is never written, only emptied if it was.
+        self.assertEqual([], [p for p in store.written if p == JOURNAL])
+        self.assertTrue(store.written.count(REFERENCES) <= len(products))
+        self.assertTrue(len(items) > len(products))
+
+    def test_rewriting_store_journals_in_batches(self):
+        store = RewritingStore()
+        with mock.patch.object(mirrors, 'JOURNAL_BATCH', 2):
+            target = self.sync(store)
+        items = json.loads(store.data[REFERENCES].decode('utf-8'))
+        journal_writes = store.written.count(JOURNAL)
+        # about one append per two changes, and one emptying per flush.
+        self.assertTrue(journal_writes > 0)
+        self.assertTrue(journal_writes < len(items))
+        self.assertEqual(b"", store.data[JOURNAL])
+        self.assertEqual([], target._journal)
+
+    def test_appending_store_journals_each_change(self):
+        store = MemoryObjectStore()
+        target = ObjectFilterMirror({}, store)
+        src = {'content_id': 'com.example:test'}
+        target._inc_rc("new/item", src, ("p1", "v1", "i1"))
+        self.assertEqual(1, len(store.data[JOURNAL].splitlines()))
+
+    def test_references_written_once_per_products_file(self):
+        store = CountingStore()
+        self.sync(store)
+        products = [p for p in store.inserted
+                    if p.startswith(".data/") and
+                    p not in (REFERENCES, JOURNAL)]
+        items = json.loads(store.data[REFERENCES].decode('utf-8'))
+        self.assertTrue(len(items) > len(products))
+        self.assertTrue(store.inserted.count(REFERENCES) <= len(products))
+        self.assertEqual(b"", store.data[JOURNAL])
+
+    def test_journal_replayed(self):
+        store = MemoryObjectStore()
+        self.sync(store)
+        expected = json.loads(store.data[REFERENCES].decode('utf-8'))
+
+        # an interrupted sync leaves its changes only in the journal.
+        target = ObjectFilterMirror({}, store)
+        src = {'content_id': 'com.example:test'}
+        target._inc_rc("new/item", src, ("p1", "v1", "i1"))
+        target._dec_rc("new/item", src, ("p1", "v1", "i1"))
+        target._inc_rc("new/item", src, ("p1", "v2", "i1"))
+        store.data[JOURNAL] += b'["inc", "torn'
+        self.assertEqual(expected,
+                         json.loads(store.data[REFERENCES].decode('utf-8')))
+
+        expected["new/item"] = ["com.example:test/p1/v2/i1"]
+        self.assertEqual(expected, ObjectFilterMirror(
+            {}, store)._load_rc_dict())
+
+        # replaying it over a table it was already applied to changes
+        # nothing.
+        journal = store.data[JOURNAL]
+        target = ObjectFilterMirror({}, store)
+        target._load_rc_dict()
+        target._flush_rc()
+        self.assertEqual(b"", store.data[JOURNAL])
+        store.data[JOURNAL] = journal
+        self.assertEqual(expected, ObjectFilterMirror(
+            {}, store)._load_rc_dict())
+
+    def test_shared_path_removed_with_last_reference(self):
+        store = MemoryObjectStore()
+        target = ObjectFilterMirror({}, store)
+        src = {'content_id': 'com.example:test'}
+        target._inc_rc("shared", src, ("p1", "v1", "i1"))
+        target._inc_rc("shared", src, ("p1", "v2", "i1"))
+        target._inc_rc("shared", src, ("p1", "v2", "i1"))
+        self.assertFalse(target._dec_rc("shared", src, ("p1", "v1", "i1")))
+        self.assertTrue(target._dec_rc("shared", src, ("p1", "v2", "i1")))
+        self.assertFalse(target._dec_rc("shared", src, ("p1", "v2", "i1")))
+
+
+class TestInventory(TestCase):
+    def resync(self, store):
+        # sync, then sync again having lost the target trees, so every
+        # item looks new to the writer but is already in the store.
+        ObjectFilterMirror({}, store).sync(get_mirror_reader("foocloud"),
+                                           "streams/v1/index.json")
+        items = [p for p in store.inserted if not p.startswith(".data/")
+                 and not p.startswith("streams/")]
+        for path in list(store.data):
+            if path.startswith(".data/"):
+                del store.data[path]
+        store.inserted = []
+        ObjectFilterMirror({}, store).sync(get_mirror_reader("foocloud"),
+                                           "streams/v1/index.json")
+        return (items, [p for p in store.inserted if p in items])
+
+    def test_stored_items_skipped_from_inventory(self):
+        store = CountingStore()
+        store.exists_with_checksum = None
+        (items, reinserted) = self.resync(store)
+        self.assertTrue(items)
+        self.assertEqual([], reinserted)
+
+    def test_store_without_listing(self):
+        class UnlistedStore(CountingStore):
+            def list_objects(self, prefix=""):
+                raise NotImplementedError()
+
+        store = UnlistedStore()
+        self.assertIsNone(store.inventory())
+        (items, reinserted) = self.resync(store)
+        self.assertEqual(sorted(items), sorted(reinserted))
+
+    def test_stores_listed_independently(self):
+        # a slow listing of one store does not hold up another's.
+        listing = threading.Event()
+        release = threading.Event()
+
+        class SlowStore(MemoryObjectStore):
+            def list_objects(self, prefix=""):
+                listing.set()
+                release.wait(10)
+                return []
+
+        thread = threading.Thread(target=SlowStore().inventory)
+        thread.start()
+        try:
+            self.assertTrue(listing.wait(10))
+            store = MemoryObjectStore()
+            store.insert_content("a", b"abc")
+            found = []
+            other = threading.Thread(
+                target=lambda: found.append(store.inventory()))
+            other.start()
+            other.join(5)
+            self.assertEqual([["a"]], [list(f) for f in found])
+        finally:
+            release.set()
+            thread.join()
+
+    def test_inventory_matches(self):
+        stored = StoredObject(3, hashlib.md5(b"abc").hexdigest(), None)
+        md5 = {'md5': stored.etag}
+        self.assertTrue(inventory_matches(stored, md5, size=3))
+        self.assertFalse(inventory_matches(stored, md5, size=4))
+        self.assertFalse(inventory_matches(None, md5))
+        self.assertFalse(inventory_matches(stored, {'md5': "0" * 32}))
+        self.assertTrue(inventory_matches(stored, {'md5': "0" * 32},
+                                          mutable=False))
+        self.assertFalse(inventory_matches(stored, {'sha256': "0" * 64}))
@@ -0,0 +1,145 @@
+import hashlib
+import threading
+import time
+from unittest import TestCase
+
+import mock
+
+from simplestreams import checksum_util
+from simplestreams import contentsource
+from simplestreams.objectstores import multipart
+
+MIN_PART_SIZE = 1024
+
+
+class FakeS3Upload(multipart.Upload):
+    # a local stand in for an S3 bucket key: parts but the last must be
+    # at least MIN_PART_SIZE, and the object exists once completed.
+    def __init__(self, fail_part=None, delay=0):
+        self.fail_part = fail_part
+        self.delay = delay
+        self.parts = {}
+        self.obj = None
+        self.began = self.aborted = False
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+
+    def put(self, data):
+        self.obj = bytes(data)
+
+    def begin(self):
+        self.began = True
+
+    def upload_part(self, part_num, data):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            time.sleep(self.delay)
+            if part_num == self.fail_part:
+                raise IOError("part %d failed" % part_num)
+            self.parts[part_num] = bytes(data)
+            return ("etag", part_num)
+        finally:
+            with self.lock:
+                self.running -= 1
+
+    def complete(self, parts):
+        nums = sorted(self.parts)
+        assert parts == [("etag", n) for n in nums]
+        for num in nums[:-1]:
+            assert len(self.parts[num]) >= MIN_PART_SIZE
+        self.obj = b"".join(self.parts[n] for n in nums)
+
+    def abort(self):
+        self.aborted = True
+        self.parts = {}
+
+
+def content(size):
+    return (b"0123456789abcdef" * (size // 16 + 1))[:size]
+
+
+class TestMultipartUpload(TestCase):
+    def upload(self, data, target=None, checksums=None, size=None,
+               reader=None, **kwargs):
+        if target is None:
+            target = FakeS3Upload()
+        if checksums is None:
+            checksums = {'sha256': hashlib.sha256(data).hexdigest()}
+        if reader is None:
+            reader = contentsource.MemoryContentSource(content=data)
+        kwargs.setdefault('part_size', MIN_PART_SIZE)
+        multipart.upload(reader, target, checksums=checksums,
+                         size=len(data) if size is None else size, **kwargs)
+        return target
+
+    def test_small_object_single_put(self):
+        data = content(100)
+        target = self.upload(data)
+        self.assertFalse(target.began)
+        self.assertEqual(data, target.obj)
+
+    def test_small_object_small_buffer(self):
+        with mock.patch.object(multipart, 'bytearray', create=True,
+                               side_effect=bytearray) as alloc:
+            self.upload(content(100), part_size=MIN_PART_SIZE * 64)
+        self.assertEqual([mock.call(101)], alloc.call_args_list)
+
+    def test_buffers_allocated_when_needed(self):
+        data = content(MIN_PART_SIZE * 2)
+        with mock.patch.object(multipart, 'bytearray', create=True,
+                               side_effect=bytearray) as alloc:
+            target = self.upload(data, workers=8)
+        self.assertEqual(data, target.obj)
+        self.assertTrue(alloc.call_count <= 3)
+
+    def test_empty_object(self):
+        target = self.upload(b"")
+        self.assertEqual(b"", target.obj)
+
+    def test_parts_in_order(self):
+        for size in (MIN_PART_SIZE * 5, MIN_PART_SIZE * 5 + 17):
+            data = content(size)
+            target = self.upload(data, workers=3)
+            self.assertTrue(target.began)
+            self.assertEqual(data, target.obj)
+
+    def test_parts_uploaded_concurrently(self):
+        data = content(MIN_PART_SIZE * 8)
+        target = self.upload(data, target=FakeS3Upload(delay=0.02),
+                             workers=3)
+        self.assertEqual(data, target.obj)
+        self.assertTrue(1 < target.max_running <= 3)
+
+    def test_bad_checksum_aborts(self):
+        data = content(MIN_PART_SIZE * 3)
+        target = FakeS3Upload()
+        self.assertRaises(checksum_util.InvalidChecksum, self.upload, data,
+                          target=target, checksums={'sha256': "0" * 64})
+        self.assertTrue(target.aborted)
+        self.assertIsNone(target.obj)
+
+    def test_bad_size_not_put(self):
+        target = FakeS3Upload()
+        self.assertRaises(checksum_util.InvalidChecksum, self.upload,
+                          content(100), target=target, size=99)
+        self.assertIsNone(target.obj)
+
+    def test_checksumming_reader(self):
+        data = content(MIN_PART_SIZE * 3)
+        reader = contentsource.ChecksummingContentSource(
+            contentsource.MemoryContentSource(content=data),
+            checksums={'md5': "0" * 32}, size=len(data))
+        target = FakeS3Upload()
+        self.assertRaises(checksum_util.InvalidChecksum, self.upload, data,
+                          target=target, reader=reader)
+        self.assertTrue(target.aborted)
+
+    def test_failed_part_aborts(self):
+        target = FakeS3Upload(fail_part=2)
+        self.assertRaises(IOError, self.upload, content(MIN_PART_SIZE * 6),
+                          target=target, workers=2)
+        self.assertTrue(target.aborted)
+        self.assertIsNone(target.obj)
@@ -0,0 +1,101 @@
+import threading
+import time
+from unittest import TestCase
+
+import mock
+
+from simplestreams import contentsource
+from simplestreams import ratelimit
+
+
+class TestParse(TestCase):
+    def test_parse_rate(self):
+        self.assertEqual(512 * 1024, ratelimit.parse_rate("512k"))
+        self.assertEqual(10 * 1024 * 1024, ratelimit.parse_rate("10M"))
+        self.assertEqual(1000, ratelimit.parse_rate("1000"))
+        self.assertEqual(2 * 1024 ** 3, ratelimit.parse_rate("2GiB"))
+        self.assertIsNone(ratelimit.parse_rate("unlimited"))
+        self.assertIsNone(ratelimit.parse_rate("0"))
+        self.assertRaises(ValueError, ratelimit.parse_rate, "fast")
+
+    def test_parse_schedule(self):
+        self.assertEqual((1024, []), ratelimit.parse_schedule("1k"))
+        self.assertEqual(
+            (None, [(8 * 60, 20 * 60, 1024), (22 * 60, 6 * 60, None)]),
+            ratelimit.parse_schedule("08:00-20:00=1k,22:00-06:00=0"))
+        self.assertRaises(ValueError, ratelimit.parse_schedule, "8-20=1k")
+
+
+class TestBandwidthLimiter(TestCase):
+    def test_from_spec_empty(self):
+        self.assertIsNone(ratelimit.BandwidthLimiter.from_spec(None))
+        self.assertIsNone(ratelimit.BandwidthLimiter.from_spec(""))
+
+    def test_windows(self):
+        limiter = ratelimit.BandwidthLimiter(
+            windows=[(8 * 60, 20 * 60, 100), (22 * 60, 6 * 60, 50)])
+
+        def at(hour):
+            return time.mktime((2020, 1, 1, hour, 30, 0, 0, 0, -1))
+
+        self.assertEqual(100, limiter.current_rate(at(12)))
+        self.assertEqual(50, limiter.current_rate(at(23)))
+        self.assertEqual(50, limiter.current_rate(at(2)))
+        self.assertIsNone(limiter.current_rate(at(21)))
+
+    def test_unlimited_does_not_wait(self):
+        limiter = ratelimit.BandwidthLimiter()
+        start = time.time()
+        limiter.consume(1024 ** 3)
+        self.assertLess(time.time() - start, 0.5)
+
+    def test_rate_is_enforced(self):
+        limiter = ratelimit.BandwidthLimiter(rate=100 * 1024, quantum=1024)
+        start = time.time()
+        # the first 100k is the burst, the next 20k takes about 0.2s.
+        limiter.consume(120 * 1024)
+        self.assertGreater(time.time() - start, 0.15)
+
+    def test_fair_share(self):
+        limiter = ratelimit.BandwidthLimiter(rate=200 * 1024, quantum=1024,
+                                             burst=1024)
+        done = {}
+
+        def transfer(name, size, chunk):
+            moved = 0
+            while moved < size:
+                limiter.consume(chunk)
+                moved += chunk
+            done[name] = time.time()
+
+        # a transfer in big reads does not starve one in small reads.
+        big = threading.Thread(target=transfer, args=("big", 40960, 8192))
+        small = threading.Thread(target=transfer, args=("small", 10240, 512))
+        big.start()
+        small.start()
+        big.join()
+        small.join()
+        self.assertLess(done["small"], done["big"])
+
+
+class TestLimitedContentSource(TestCase):
+    def test_reads_are_charged(self):
+        limiter = mock.Mock()
+
+        class Reader(contentsource.UrlReader):
+            def __init__(self, url, offset=None):
+                self.data = b"x" * 100
+
+            def read(self, size=-1):
+                ret, self.data = self.data[:size], self.data[size:]
+                return ret
+
+            def close(self):
+                pass
+
+        src = contentsource.UrlContentSource(
+            "http://example.com/f", url_reader=Reader, limiter=limiter)
+        src.read(60)
+        src.readinto(bytearray(60))
+        self.assertEqual([mock.call(60), mock.call(40)],
+                         limiter.consume.call_args_list)
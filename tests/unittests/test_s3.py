@@ -0,0 +1,167 @@
+import hashlib
+import threading
+from unittest import TestCase, skipIf
+
+import mock
+
+from simplestreams import checksum_util
+from simplestreams.contentsource import MemoryContentSource
+
+try:
+    from simplestreams.objectstores import s3
+except ImportError:
+    s3 = None
+
+PART_SIZE = 1024
+
+
+class FakeS3(object):
+    # just enough of a bucket with multipart uploads: objects by name,
+    # and the parts of the uploads in progress.
+    def __init__(self, fail_parts=0):
+        self.objects = {}
+        self.uploads = {}
+        self.fail_parts = fail_parts
+        self.connections = []
+        self.lock = threading.Lock()
+
+
+class FakeKey(object):
+    def __init__(self, s3, name):
+        self.s3 = s3
+        self.name = name
+        self.metadata = {}
+
+    def set_metadata(self, name, value):
+        self.metadata[name] = value
+
+    def set_contents_from_string(self, content):
+        self.s3.objects[self.name] = (content, self.metadata)
+
+    def close(self):
+        pass
+
+
+class FakeMultiPartUpload(object):
+    def __init__(self, bucket):
+        self.s3 = bucket.s3
+        self.key_name = None
+        self.id = None
+
+    def upload_part_from_file(self, fp, part_num, size=None):
+        with self.s3.lock:
+            if self.s3.fail_parts:
+                self.s3.fail_parts -= 1
+                raise IOError("connection reset")
+        data = fp.read()
+        assert len(data) == size
+        self.s3.uploads[self.id][1][part_num] = data
+
+    def complete_upload(self):
+        (metadata, parts) = self.s3.uploads.pop(self.id)
+        self.s3.objects[self.key_name] = (
+            b"".join(parts[n] for n in sorted(parts)), metadata)
+
+    def cancel_upload(self):
+        self.s3.uploads.pop(self.id)
+
+
+class FakeBucket(object):
+    def __init__(self, s3, connection):
+        self.s3 = s3
+        self.connection = connection
+
+    def new_key(self, name):
+        return FakeKey(self.s3, name)
+
+    def initiate_multipart_upload(self, key_name, metadata=None):
+        mp = FakeMultiPartUpload(self)
+        mp.key_name = key_name
+        with self.s3.lock:
+            mp.id = str(len(self.s3.uploads) + len(self.s3.objects))
+            self.s3.uploads[mp.id] = (metadata, {})
+        return mp
+
+    def get_key(self, name):
+        return None
+
+
+def fake_connection(s3):
+    class FakeConnection(object):
+        def __init__(self):
+            self.closed = False
+            with s3.lock:
+                s3.connections.append(self)
+
+        def get_bucket(self, name, validate=True):
+            return FakeBucket(s3, self)
+
+        def close(self):
+            self.closed = True
+
+    return FakeConnection
+
+
+@skipIf(s3 is None, "boto is not available")
+class TestS3ObjectStore(TestCase):
+    def setUp(self):
+        self.s3 = FakeS3()
+        patches = [
+            mock.patch.object(s3.boto.s3.connection, 'S3Connection',
+                              fake_connection(self.s3)),
+            mock.patch.object(s3.boto.s3.multipart, 'MultiPartUpload',
+                              FakeMultiPartUpload)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.store = s3.S3ObjectStore("s3://bucket/prefix/",
+                                      part_size=PART_SIZE, upload_workers=2)
+        self.addCleanup(self.store.close)
+
+    def insert(self, path, data, checksums=None):
+        if checksums is None:
+            checksums = {'sha256': hashlib.sha256(data).hexdigest()}
+        self.store.insert(path, MemoryContentSource(content=data),
+                          checksums=checksums, size=len(data))
+
+    def test_small_item_put(self):
+        self.insert("a.img", b"small item")
+        (content, metadata) = self.s3.objects["prefix/a.img"]
+        self.assertEqual(b"small item", content)
+        self.assertEqual(
+            "sha256:" + hashlib.sha256(b"small item").hexdigest(),
+            metadata[s3.CHECKSUM_META])
+        self.assertEqual({}, self.s3.uploads)
+
+    def test_large_item_in_parts(self):
+        data = b"0123456789abcdef" * (PART_SIZE * 5 // 16) + b"tail"
+        self.insert("a.img", data)
+        self.assertEqual(data, self.s3.objects["prefix/a.img"][0])
+        self.assertEqual({}, self.s3.uploads)
+
+    def test_connections_shared_by_items(self):
+        data = b"x" * (PART_SIZE * 6)
+        for num in range(5):
+            self.insert("%d.img" % num, data)
+        self.assertEqual(5, len(self.s3.objects))
+        # the pool keeps 3, and the store has one of its own.
+        self.assertTrue(len(self.s3.connections) <= 4)
+
+    def test_bad_checksum_cancels(self):
+        self.assertRaises(checksum_util.InvalidChecksum, self.insert,
+                          "a.img", b"x" * (PART_SIZE * 3),
+                          checksums={'sha256': "0" * 64})
+        self.assertEqual({}, self.s3.objects)
+        self.assertEqual({}, self.s3.uploads)
+
+    def test_failed_part_connection_closed(self):
+        self.s3.fail_parts = 1
+        self.assertRaises(IOError, self.insert, "a.img", b"x" * PART_SIZE * 3)
+        self.assertEqual({}, self.s3.uploads)
+        self.assertEqual(1, len([conn for conn in self.s3.connections
+                                 if conn.closed]))
+
+    def test_close_closes_idle_connections(self):
+        self.insert("a.img", b"x" * (PART_SIZE * 3))
+        self.store.close()
+        self.assertTrue(all(conn.closed for conn in self.s3.connections))
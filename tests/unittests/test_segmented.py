@@ -0,0 +1,197 @@
+import hashlib
+import mock
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+from simplestreams import checksum_util
+from simplestreams import contentsource
+from simplestreams import objectstores
+from simplestreams import segmented
+
+CONTENT = b''.join([b'%05d' % n for n in range(2000)])
+
+
+class FakeRangeReader(contentsource.UrlReader):
+    honor_range = True
+    content = CONTENT
+    offsets = []
+
+    def __init__(self, url, offset=None, user_agent=None):
+        self.offsets.append(offset)
+        self.pos = 0
+        if offset is not None and self.honor_range:
+            self.pos = offset
+        self.at_offset = offset is None or self.honor_range
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self.content)
+        buf = self.content[self.pos:self.pos + size]
+        self.pos += len(buf)
+        return buf
+
+    def close(self):
+        pass
+
+
+class TestSegmentRanges(TestCase):
+    def test_covers_size(self):
+        ranges = segmented.segment_ranges(10, 3)
+        self.assertEqual([(0, 3), (3, 3), (6, 4)], ranges)
+
+    def test_fewer_bytes_than_segments(self):
+        self.assertEqual([(0, 1), (1, 1)], segmented.segment_ranges(2, 4))
+
+
+class TestFileChecksummer(TestCase):
+    def setUp(self):
+        (fd, self.fname) = tempfile.mkstemp()
+        self.addCleanup(os.unlink, self.fname)
+        with os.fdopen(fd, "wb") as fp:
+            fp.write(CONTENT)
+
+    def checksum(self):
+        cksum = checksum_util.checksummer(
+            {'sha256': hashlib.sha256(CONTENT).hexdigest()})
+        size = segmented.file_checksummer(self.fname, cksum, read_size=999)
+        return (size, cksum.check())
+
+    def test_mmap(self):
+        self.assertEqual((len(CONTENT), True), self.checksum())
+
+    def test_reads_when_mmap_unusable(self):
+        # as on python2, where a mapping cannot be viewed.
+        with mock.patch.object(segmented, '_mmap_checksummer',
+                               side_effect=TypeError("no buffer")):
+            self.assertEqual((len(CONTENT), True), self.checksum())
+
+    def test_python2_reads(self):
+        with mock.patch.object(segmented, '_mmap_checksummer') as mmapped:
+            with mock.patch.object(segmented.sys, 'version_info', (2, 7)):
+                self.assertEqual((len(CONTENT), True), self.checksum())
+        self.assertFalse(mmapped.called)
+
+
+class TestSegmentedDownloader(TestCase):
+    def setUp(self):
+        self.target = tempfile.mkdtemp()
+        self.fname = os.path.join(self.target, 'foo')
+        FakeRangeReader.offsets = []
+
+    def tearDown(self):
+        shutil.rmtree(self.target)
+
+    def downloader(self, reader_cls, **kwargs):
+        src = contentsource.UrlContentSource("http://example.com/foo",
+                                             url_reader=reader_cls)
+        return segmented.SegmentedDownloader(src, len(CONTENT), segments=2,
+                                             **kwargs)
+
+    def test_failed_segment_resumes_where_it_stopped(self):
+        failed = []
+
+        class FlakyReader(FakeRangeReader):
+            def read(self, size=-1):
+                # only in the first segment, which ends at 5000.
+                if 1500 <= self.pos < 5000 and not failed:
+                    failed.append(self.pos)
+                    raise IOError("connection reset")
+                return super(FlakyReader, self).read(size)
+
+        self.downloader(FlakyReader, read_size=100).download(self.fname)
+        with open(self.fname, 'rb') as fp:
+            self.assertEqual(CONTENT, fp.read())
+        self.assertEqual([1500], failed)
+        self.assertEqual([0, 1500, 5000], sorted(FlakyReader.offsets))
+
+    def test_segment_gives_up_after_retries(self):
+        class BrokenReader(FakeRangeReader):
+            def read(self, size=-1):
+                if self.pos >= 5000:
+                    raise IOError("connection reset")
+                return super(BrokenReader, self).read(size)
+
+        downloader = self.downloader(BrokenReader, retries=2)
+        self.assertRaises(IOError, downloader.download, self.fname)
+        self.assertEqual(3, BrokenReader.offsets.count(5000))
+
+    def test_failure_stops_other_segments(self):
+        class SlowReader(FakeRangeReader):
+            def read(self, size=-1):
+                if self.pos >= 5000:
+                    raise RuntimeError("boom")
+                time.sleep(0.01)
+                return super(SlowReader, self).read(size)
+
+        downloader = self.downloader(SlowReader, read_size=10)
+        self.assertRaises(RuntimeError, downloader.download, self.fname)
+        # the first segment alone would take 500 reads.
+        self.assertLess(downloader.written, 2000)
+
+
+class TestSegmentedFileStore(TestCase):
+    def setUp(self):
+        self.target = tempfile.mkdtemp()
+        FakeRangeReader.offsets = []
+
+    def tearDown(self):
+        shutil.rmtree(self.target)
+
+    def insert(self, reader_cls, content=CONTENT, segments=4):
+        store = objectstores.FileStore(self.target, segments=segments,
+                                       segment_min_size=0)
+        src = contentsource.ChecksummingContentSource(
+            contentsource.UrlContentSource("http://example.com/foo",
+                                           url_reader=reader_cls),
+            checksums={'sha256': hashlib.sha256(content).hexdigest()},
+            size=len(content))
+        store.insert('foo', src, size=len(content))
+        with open(os.path.join(self.target, 'foo'), 'rb') as fp:
+            return fp.read()
+
+    def test_segmented_download(self):
+        self.assertEqual(CONTENT, self.insert(FakeRangeReader))
+        self.assertEqual(sorted(o for o, _ in
+                                segmented.segment_ranges(len(CONTENT), 4)),
+                         sorted(FakeRangeReader.offsets))
+
+    def test_range_not_honored_falls_back(self):
+        class NoRangeReader(FakeRangeReader):
+            honor_range = False
+
+        self.assertEqual(CONTENT, self.insert(NoRangeReader))
+        self.assertIn(None, NoRangeReader.offsets)
+        self.assertFalse(os.path.exists(os.path.join(self.target,
+                                                     'foo.part')))
+
+    def test_bad_checksum_raises(self):
+        self.assertRaises(checksum_util.InvalidChecksum, self.insert,
+                          FakeRangeReader, content=b'x' + CONTENT[1:])
+        self.assertEqual([], os.listdir(self.target))
+
+    def test_single_segment_not_used(self):
+        self.assertEqual(CONTENT, self.insert(FakeRangeReader, segments=1))
+        self.assertEqual([None], FakeRangeReader.offsets)
+
+    def test_striped_segments_use_each_mirror(self):
+        urls = []
+
+        class MirrorReader(FakeRangeReader):
+            def __init__(self, url, offset=None, user_agent=None):
+                urls.append(url)
+                super(MirrorReader, self).__init__(url, offset=offset)
+
+        store = objectstores.FileStore(self.target, segments=3,
+                                       segment_min_size=0)
+        src = contentsource.UrlContentSource(
+            "http://a/foo", mirrors=["http://b/foo", "http://c/foo"],
+            url_reader=MirrorReader, stripe=True)
+        store.insert('foo', src, size=len(CONTENT),
+                     checksums={'sha256': hashlib.sha256(CONTENT).hexdigest()})
+        with open(os.path.join(self.target, 'foo'), 'rb') as fp:
+            self.assertEqual(CONTENT, fp.read())
+        self.assertEqual(["http://a/foo", "http://b/foo", "http://c/foo"],
+                         sorted(urls))
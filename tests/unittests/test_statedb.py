@@ -0,0 +1,174 @@
+import json
+import mock
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from simplestreams import mirrors
+from simplestreams import objectstores
+from simplestreams import statedb
+from simplestreams import util
+from simplestreams import verify
+from tests.testutil import get_mirror_reader
+
+REFERENCES = ".data/references.json"
+
+
+def json_sync(store=None):
+    if store is None:
+        store = objectstores.MemoryObjectStore()
+    target = mirrors.ObjectFilterMirror({}, store)
+    target.sync(get_mirror_reader("foocloud"), "streams/v1/index.json")
+    return store
+
+
+def trees(store):
+    return dict((path[len(".data/"):], util.load_content(content))
+                for path, content in store.data.items()
+                if path.startswith(".data/") and
+                path != ".data/references.journal")
+
+
+class TestSqliteMirrorState(TestCase):
+    def setUp(self):
+        self.tmpd = tempfile.mkdtemp()
+        self.state = statedb.SqliteMirrorState(
+            os.path.join(self.tmpd, "state.db"))
+
+    def tearDown(self):
+        self.state.close()
+        shutil.rmtree(self.tmpd)
+
+    def sync(self, store=None):
+        if store is None:
+            store = objectstores.MemoryObjectStore()
+        target = mirrors.ObjectFilterMirror({}, store, state=self.state)
+        target.sync(get_mirror_reader("foocloud"), "streams/v1/index.json")
+        return (target, store)
+
+    def test_matches_json_state(self):
+        expected = json_sync()
+        (target, store) = self.sync()
+        self.assertNotIn(REFERENCES, store.data)
+        for content_id, tree in trees(expected).items():
+            if content_id == "references.json":
+                continue
+            self.assertEqual(tree, self.state.load_products(content_id))
+        self.assertEqual(
+            json.loads(expected.data[REFERENCES].decode('utf-8')),
+            self.state.references())
+
+    def test_export(self):
+        expected = json_sync()
+        (target, store) = self.sync()
+        target.export_state()
+        self.assertEqual(trees(expected), trees(store))
+
+    def test_imports_json_state(self):
+        store = json_sync()
+        expected = trees(store)
+        self.sync(store)
+        self.assertEqual(
+            json.loads(store.data[REFERENCES].decode('utf-8')),
+            self.state.references())
+        for content_id in self.state.content_ids():
+            self.assertEqual(expected[content_id],
+                             self.state.load_products(content_id))
+
+    def test_save_writes_changed_rows(self):
+        tree = {'content_id': 'c', 'format': 'products:1.0',
+                'products': {'p': {'arch': 'amd64', 'versions': {
+                    'v1': {'items': {'a': {'path': 'x/a', 'md5': '1'},
+                                     'b': {'path': 'x/b', 'md5': '2'}}},
+                    'v2': {'items': {}}}}}}
+        self.state.save_products(tree)
+        self.assertEqual(tree, self.state.load_products('c'))
+
+        before = self.state._db.total_changes
+        tree['products']['p']['versions']['v1']['items']['a']['md5'] = '3'
+        del tree['products']['p']['versions']['v2']
+        self.state.save_products(tree)
+        self.assertEqual(2, self.state._db.total_changes - before)
+        self.assertEqual(tree, self.state.load_products('c'))
+
+        self.assertTrue(self.state.has_item('c', ('p', 'v1', 'b')))
+        self.assertFalse(self.state.has_item('c', ('p', 'v2', 'b')))
+        self.assertEqual([('c', ('p', 'v1', 'a'))],
+                         self.state.items_with_path('x/a'))
+        self.assertIsNone(self.state.load_products('other'))
+
+    def test_recorded_items_are_stored(self):
+        (target, store) = self.sync()
+        (content_id, pedigree) = next(
+            (content_id, pedigree) for path in self.state.references()
+            for content_id, pedigree in self.state.items_with_path(path))
+        item = self.state.get_item(content_id, pedigree)
+        checksums = {'md5': item['md5']}
+        self.assertTrue(target._recorded(item['path'], checksums,
+                                         size=item['size']))
+        self.assertFalse(target._recorded(item['path'], {'md5': 'x'},
+                                          size=item['size']))
+        self.state.set_references({})
+        self.assertFalse(target._recorded(item['path'], checksums,
+                                          size=item['size']))
+
+    def test_dry_run_does_not_write(self):
+        store = json_sync()
+        for content_id in trees(store):
+            if content_id != "references.json":
+                del store.data[".data/" + content_id]
+        before = self.state._db.total_changes
+        target = mirrors.DryRunMirrorWriter({}, store, state=self.state)
+        target.sync(get_mirror_reader("foocloud"), "streams/v1/index.json")
+        self.assertTrue(target.downloading)
+        self.assertEqual(before, self.state._db.total_changes)
+        self.assertFalse(self.state.has_references())
+
+    def test_readonly(self):
+        self.state.add_reference("x", "c/p/v1/a")
+        reader = statedb.SqliteMirrorState(self.state.path, readonly=True)
+        try:
+            self.assertEqual({"x": ["c/p/v1/a"]}, reader.references())
+            if statedb.quote is not None:
+                self.assertRaises(Exception, reader.add_reference,
+                                  "y", "c/p/v1/b")
+        finally:
+            reader.close()
+
+    def test_references(self):
+        self.state.add_reference("x", "c/p/v1/a")
+        self.state.add_reference("x", "c/p/v2/a")
+        self.state.add_reference("x", "c/p/v2/a")
+        self.assertEqual(2, self.state.reference_count("x"))
+        self.assertEqual(1, self.state.remove_reference("x", "c/p/v1/a"))
+        self.assertEqual({"x": ["c/p/v2/a"]}, self.state.references())
+        self.assertEqual(0, self.state.remove_reference("x", "c/p/v2/a"))
+        self.assertFalse(self.state.has_references())
+
+
+class TestVerifyWithState(TestCase):
+    def setUp(self):
+        self.target = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.target)
+
+    def test_verify_uses_state(self):
+        os.mkdir(os.path.join(self.target, ".data"))
+        state = statedb.SqliteMirrorState(
+            os.path.join(self.target, statedb.DEFAULT_PATH))
+        tmirror = mirrors.ObjectFilterMirror(
+            {}, objectstores.FileStore(self.target), state=state)
+        tmirror.sync(get_mirror_reader("foocloud"), "streams/v1/index.json")
+        state.close()
+
+        with mock.patch.object(statedb, 'SqliteMirrorState',
+                               wraps=statedb.SqliteMirrorState) as opened:
+            items = verify.load_items(self.target)
+        self.assertTrue(items)
+        opened.assert_called_once_with(
+            os.path.join(self.target, statedb.DEFAULT_PATH), readonly=True)
+        result = verify.verify_mirror(self.target, jobs=1)
+        self.assertTrue(result.ok())
+        self.assertEqual(sorted(items), sorted(result.verified))
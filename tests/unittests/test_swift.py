@@ -0,0 +1,262 @@
+import hashlib
+import json
+import threading
+from unittest import TestCase, skipIf
+
+import mock
+
+from simplestreams import checksum_util
+from simplestreams.contentsource import MemoryContentSource
+
+try:
+    from simplestreams.objectstores import swift
+except ImportError:
+    swift = None
+
+SEGMENT_SIZE = 1024
+
+
+class FakeSwift(object):
+    # just enough of a swift cluster with static large objects: a dict
+    # of container to {name: (content, headers)}.
+    def __init__(self, fail_puts=0, fail_status=None):
+        self.containers = {}
+        self.manifests = {}
+        self.fail_puts = fail_puts
+        self.fail_status = fail_status
+        self.lock = threading.Lock()
+
+    def close(self):
+        pass
+
+    def _missing(self):
+        return swift.ClientException("not found", http_status=404)
+
+    def put_container(self, container, headers=None):
+        self.containers.setdefault(container, {})
+
+    def put_object(self, container, obj, contents, content_length=None,
+                   etag=None, headers=None, query_string=None):
+        with self.lock:
+            if self.fail_puts:
+                self.fail_puts -= 1
+                raise swift.ClientException("failed",
+                                            http_status=self.fail_status)
+        headers = dict((k.lower(), v) for k, v in (headers or {}).items())
+        if query_string == "multipart-manifest=put":
+            content = b""
+            for seg in json.loads(contents):
+                (cont, name) = seg['path'][1:].split("/", 1)
+                (data, seg_headers) = self.containers[cont][name]
+                assert seg_headers['etag'] == seg['etag']
+                assert len(data) == seg['size_bytes']
+                content += data
+            headers['x-static-large-object'] = 'true'
+            headers['etag'] = '"%s"' % hashlib.md5(b"slo").hexdigest()
+            # as a manifest get returns it.
+            self.manifests[(container, obj)] = json.dumps(
+                [{'name': seg['path'], 'hash': seg['etag'],
+                  'bytes': seg['size_bytes']}
+                 for seg in json.loads(contents)]).encode('utf-8')
+        else:
+            content = contents
+            headers['etag'] = hashlib.md5(content).hexdigest()
+            if etag is not None and etag != headers['etag']:
+                raise swift.ClientException("bad etag", http_status=422)
+            self.manifests.pop((container, obj), None)
+        self.containers[container][obj] = (content, headers)
+
+    def get_object(self, container, obj, query_string=None):
+        if query_string == "multipart-manifest=get":
+            if (container, obj) in self.manifests:
+                return ({}, self.manifests[(container, obj)])
+        try:
+            (content, headers) = self.containers[container][obj]
+        except KeyError:
+            raise self._missing()
+        return (headers, content)
+
+    def head_object(self, container, obj):
+        try:
+            return self.containers[container][obj][1]
+        except KeyError:
+            raise self._missing()
+
+    def delete_object(self, container, obj, query_string=None):
+        try:
+            (_content, headers) = self.containers[container].pop(obj)
+        except KeyError:
+            raise self._missing()
+        if (query_string == "multipart-manifest=delete" and
+                headers.get('x-static-large-object')):
+            seg_d = self.containers[container + "_segments"]
+            for name in [n for n in seg_d if n.startswith(obj + "/")]:
+                del seg_d[name]
+
+    def get_container(self, container, prefix="", full_listing=False):
+        return ({}, [{'name': name, 'bytes': len(content),
+                      'hash': headers['etag']}
+                     for name, (content, headers)
+                     in sorted(self.containers[container].items())
+                     if name.startswith(prefix)])
+
+
+@skipIf(swift is None, "swiftclient not available")
+class TestSwiftLargeObjects(TestCase):
+    def store(self, conn, **kwargs):
+        patches = [
+            mock.patch.object(swift.openstack, 'load_keystone_creds',
+                              return_value={}),
+            mock.patch.object(swift.openstack, 'get_service_conn_info',
+                              return_value={}),
+            mock.patch.object(swift, 'get_swiftclient', return_value=conn)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        store = swift.SwiftObjectStore("swift://images/mirror/",
+                                       segment_size=SEGMENT_SIZE,
+                                       upload_workers=3, **kwargs)
+        self.addCleanup(store.close)
+        return store
+
+    def insert(self, store, path, data, checksums=None, mutable=False):
+        if checksums is None:
+            checksums = {'sha256': hashlib.sha256(data).hexdigest()}
+        store.insert(path, MemoryContentSource(content=data),
+                     checksums=checksums, mutable=mutable, size=len(data))
+
+    def test_small_object_single_put(self):
+        conn = FakeSwift()
+        store = self.store(conn)
+        self.insert(store, "a.img", b"small")
+        (content, headers) = conn.containers["images"]["mirror/a.img"]
+        self.assertEqual(b"small", content)
+        self.assertNotIn("images_segments", conn.containers)
+
+    def test_large_object_in_segments(self):
+        conn = FakeSwift()
+        store = self.store(conn)
+        data = b"0123456789" * 1000
+        self.insert(store, "big.img", data)
+        (content, headers) = conn.containers["images"]["mirror/big.img"]
+        self.assertEqual(data, content)
+        self.assertEqual(10, len(conn.containers["images_segments"]))
+        self.assertTrue(store.exists_with_checksum(
+            "big.img", {'sha256': hashlib.sha256(data).hexdigest()}))
+
+        store.remove("big.img")
+        self.assertEqual({}, conn.containers["images"])
+        self.assertEqual({}, conn.containers["images_segments"])
+
+    def test_failed_segment_retried(self):
+        conn = FakeSwift()
+        store = self.store(conn)
+        store.ensure_segment_container()
+        conn.fail_puts = swift.SEGMENT_RETRIES - 1
+        data = b"x" * (SEGMENT_SIZE * 3)
+        self.insert(store, "big.img", data)
+        self.assertEqual(data, conn.containers["images"]["mirror/big.img"][0])
+
+    def test_client_error_not_retried(self):
+        conn = FakeSwift()
+        store = self.store(conn)
+        store.ensure_segment_container()
+        (conn.fail_puts, conn.fail_status) = (1, 401)
+        self.assertRaises(swift.ClientException, self.insert, store,
+                          "big.img", b"x" * (SEGMENT_SIZE * 3))
+        self.assertEqual(0, conn.fail_puts)
+        self.assertEqual({}, conn.containers["images_segments"])
+
+    def test_server_error_retried(self):
+        conn = FakeSwift()
+        store = self.store(conn)
+        store.ensure_segment_container()
+        (conn.fail_puts, conn.fail_status) = (1, 503)
+        data = b"x" * (SEGMENT_SIZE * 3)
+        self.insert(store, "big.img", data)
+        self.assertEqual(data, conn.containers["images"]["mirror/big.img"][0])
+
+    def test_replaced_large_object_segments_removed(self):
+        conn = FakeSwift()
+        store = self.store(conn)
+        self.insert(store, "big.img", b"x" * (SEGMENT_SIZE * 3),
+                    mutable=True)
+        self.insert(store, "big.img", b"y" * (SEGMENT_SIZE * 2),
+                    mutable=True)
+        self.assertEqual(2, len(conn.containers["images_segments"]))
+        self.insert(store, "big.img", b"small", mutable=True)
+        self.assertEqual(b"small",
+                         conn.containers["images"]["mirror/big.img"][0])
+        self.assertEqual({}, conn.containers["images_segments"])
+
+    def test_bad_checksum_leaves_nothing(self):
+        conn = FakeSwift()
+        store = self.store(conn)
+        self.assertRaises(checksum_util.InvalidChecksum, self.insert,
+                          store, "big.img", b"y" * (SEGMENT_SIZE * 3),
+                          {'sha256': "0" * 64})
+        self.assertEqual({}, conn.containers["images"])
+        self.assertEqual({}, conn.containers["images_segments"])
+
+    def test_listing_ignores_large_object_hash(self):
+        conn = FakeSwift()
+        conn.containers["images"] = {}
+        conn.get_container = lambda *a, **kw: ({}, [
+            {'name': "mirror/a", 'bytes': 1, 'hash': "abc"},
+            {'name': "mirror/b", 'bytes': 2, 'hash': "def", 'slo_etag': "x",
+             'last_modified': "2024-01-02T03:04:05.000000"}])
+        found = self.store(conn, ksclient="client").inventory()
+        self.assertEqual("client", swift.openstack.get_service_conn_info.
+                         call_args[1]['client'])
+        self.assertEqual("abc", found["a"].etag)
+        self.assertEqual(None, found["b"].etag)
+        self.assertEqual(1704164645, found["b"].mtime)
+
+
+@skipIf(swift is None, "swiftclient not available")
+class TestSwiftConnectionPool(TestCase):
+    def setUp(self):
+        patch = mock.patch.object(swift, 'get_swiftclient',
+                                  side_effect=lambda **kw: mock.Mock())
+        self.get_swiftclient = patch.start()
+        self.addCleanup(patch.stop)
+        self.pool = swift.SwiftConnectionPool({'token': "t"}, maxsize=1)
+
+    def test_connections_reused(self):
+        with self.pool.connection() as first:
+            with self.pool.connection() as second:
+                self.assertIsNot(first, second)
+        self.assertEqual(2, self.get_swiftclient.call_count)
+        self.get_swiftclient.assert_called_with(token="t")
+        # only maxsize are kept.
+        first.close.assert_called_once_with()
+        with self.pool.connection() as third:
+            self.assertIs(second, third)
+
+    def test_broken_connection_dropped(self):
+        def request(exc):
+            try:
+                with self.pool.connection() as conn:
+                    raise exc
+            except Exception:
+                pass
+            return conn
+
+        conn = request(swift.ClientException("gone", http_status=404))
+        self.assertFalse(conn.close.called)
+        self.assertIs(conn, request(IOError("connection reset")))
+        conn.close.assert_called_once_with()
+        self.assertIsNot(conn, self.pool.get_connection())
+
+    def test_unread_response_not_reused(self):
+        conn = self.pool.get_connection()
+        body = swift._pooled_iter(self.pool, conn, iter([b"a", b"b"]))
+        self.assertEqual(b"a", next(body))
+        body.close()
+        conn.close.assert_called_once_with()
+        self.assertIsNot(conn, self.pool.get_connection())
+
+        conn = self.pool.get_connection()
+        self.assertEqual([b"a"], list(
+            swift._pooled_iter(self.pool, conn, iter([b"a"]))))
+        self.assertIs(conn, self.pool.get_connection())
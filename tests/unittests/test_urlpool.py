@@ -0,0 +1,201 @@
+import mock
+from unittest import TestCase
+
+from simplestreams import urlpool
+
+
+class FakeResponse(object):
+    def __init__(self, status=200, data=b'', will_close=False, headers=None):
+        self.status = status
+        self.reason = "OK"
+        self.msg = {}
+        self.data = data
+        self.will_close = will_close
+        self.headers = headers or {}
+        self.closed = False
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self.data)
+        ret, self.data = self.data[:size], self.data[size:]
+        return ret
+
+    def isclosed(self):
+        return not self.data
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+    def close(self):
+        self.closed = True
+
+
+class TestUrlSessionPool(TestCase):
+    key = ("http", "example.com", None)
+
+    def setUp(self):
+        patch = mock.patch.object(urlpool, 'getproxies', return_value={})
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_put_connection_keeps_up_to_maxsize(self):
+        pool = urlpool.UrlSessionPool(maxsize=1)
+        c1, c2 = mock.Mock(), mock.Mock()
+        pool.put_connection(self.key, c1)
+        pool.put_connection(self.key, c2)
+        self.assertFalse(c1.close.called)
+        self.assertTrue(c2.close.called)
+        self.assertIs(c1, pool.get_connection(self.key))
+
+    def test_consumed_response_returns_connection(self):
+        pool = urlpool.UrlSessionPool()
+        conn = mock.Mock()
+        resp = urlpool.PooledResponse(pool, self.key, conn,
+                                      FakeResponse(data=b'hi'))
+        self.assertEqual(b'hi', resp.read())
+        resp.close()
+        self.assertFalse(conn.close.called)
+        self.assertIs(conn, pool.get_connection(self.key))
+
+    def test_partial_response_closes_connection(self):
+        pool = urlpool.UrlSessionPool()
+        conn = mock.Mock()
+        resp = urlpool.PooledResponse(pool, self.key, conn,
+                                      FakeResponse(data=b'hello'))
+        resp.read(2)
+        resp.close()
+        self.assertTrue(conn.close.called)
+        self.assertEqual({}, dict((k, v) for k, v in pool._idle.items() if v))
+
+    def test_urlopen_reuses_connection(self):
+        pool = urlpool.UrlSessionPool()
+        conn = mock.Mock()
+        conn.getresponse.side_effect = [FakeResponse(data=b'one'),
+                                        FakeResponse(data=b'two')]
+        with mock.patch.object(pool, '_new_connection', return_value=conn):
+            for expected in (b'one', b'two'):
+                resp = pool.urlopen("http://example.com/foo")
+                self.assertEqual(expected, resp.read())
+                resp.close()
+            self.assertEqual(1, pool._new_connection.call_count)
+        self.assertEqual(2, conn.request.call_count)
+
+    def test_urlopen_follows_redirect(self):
+        pool = urlpool.UrlSessionPool()
+        conn = mock.Mock()
+        conn.getresponse.side_effect = [
+            FakeResponse(status=302, headers={'location': '/bar'}),
+            FakeResponse(data=b'bar')]
+        with mock.patch.object(pool, '_new_connection', return_value=conn):
+            resp = pool.urlopen("http://example.com/foo")
+            self.assertEqual(b'bar', resp.read())
+        self.assertEqual("/bar", conn.request.call_args[0][1])
+
+    def test_urlopen_sends_basic_auth(self):
+        pool = urlpool.UrlSessionPool()
+        conn = mock.Mock()
+        conn.getresponse.return_value = FakeResponse(data=b'x')
+        with mock.patch.object(pool, '_new_connection', return_value=conn):
+            pool.urlopen("http://example.com/", username="u", password="p")
+        headers = conn.request.call_args[1]['headers']
+        self.assertEqual("Basic dTpw", headers['Authorization'])
+
+    def test_redirect_keeps_auth_on_same_host(self):
+        pool = urlpool.UrlSessionPool()
+        conn = mock.Mock()
+        conn.getresponse.side_effect = [
+            FakeResponse(status=302, headers={'location': '/bar'}),
+            FakeResponse(data=b'bar')]
+        with mock.patch.object(pool, '_new_connection', return_value=conn):
+            pool.urlopen("http://example.com/foo", username="u",
+                         password="p")
+        headers = conn.request.call_args[1]['headers']
+        self.assertEqual("Basic dTpw", headers['Authorization'])
+
+    def test_redirect_drops_auth_to_other_host(self):
+        pool = urlpool.UrlSessionPool()
+        conns = {}
+
+        def new_connection(key):
+            conn = mock.Mock()
+            if key == ("http", "example.com", None):
+                conn.getresponse.return_value = FakeResponse(
+                    status=302,
+                    headers={'location': 'https://other.example.com/x'})
+            else:
+                conn.getresponse.return_value = FakeResponse(data=b'x')
+            conns[key] = conn
+            return conn
+
+        with mock.patch.object(pool, '_new_connection',
+                               side_effect=new_connection):
+            resp = pool.urlopen("http://example.com/foo", username="u",
+                                password="p")
+            self.assertEqual(b'x', resp.read())
+        first = conns[("http", "example.com", None)].request.call_args[1]
+        self.assertIn('Authorization', first['headers'])
+        other = conns[("https", "other.example.com", None)]
+        other = other.request.call_args[1]
+        self.assertNotIn('Authorization', other['headers'])
+
+    def test_timeout_reset_before_reuse(self):
+        pool = urlpool.UrlSessionPool()
+        conn = mock.Mock()
+        conn.getresponse.return_value = FakeResponse(data=b'x')
+        with mock.patch.object(pool, '_new_connection', return_value=conn):
+            resp = pool.urlopen("http://example.com/", timeout=5)
+            self.assertEqual(5, conn.timeout)
+            resp.read()
+            resp.close()
+        self.assertIsNone(conn.timeout)
+        conn.sock.settimeout.assert_called_with(None)
+
+    def test_http_proxy_gets_full_url(self):
+        urlpool.getproxies.return_value = {
+            'http': "http://u:p@proxy.example.com:3128"}
+        pool = urlpool.UrlSessionPool()
+        conn = mock.Mock()
+        conn.getresponse.return_value = FakeResponse(data=b'x')
+        with mock.patch.object(pool, '_new_connection',
+                               return_value=conn) as new_connection:
+            pool.urlopen("http://example.com/foo?a=b")
+        key = new_connection.call_args[0][0]
+        self.assertEqual(("http", "example.com",
+                          "http://u:p@proxy.example.com:3128"), key)
+        (method, path) = conn.request.call_args[0]
+        self.assertEqual("http://example.com/foo?a=b", path)
+        headers = conn.request.call_args[1]['headers']
+        self.assertEqual("Basic dTpw", headers['Proxy-Authorization'])
+
+    def test_http_proxy_connection(self):
+        pool = urlpool.UrlSessionPool()
+        conn = pool._new_connection(
+            ("http", "example.com", "http://proxy.example.com:3128"))
+        self.assertEqual("proxy.example.com", conn.host)
+        self.assertEqual(3128, conn.port)
+
+    def test_https_proxy_tunnels(self):
+        pool = urlpool.UrlSessionPool()
+        conn = pool._new_connection(
+            ("https", "example.com", "http://u:p@proxy.example.com:3128"))
+        self.assertEqual("proxy.example.com", conn.host)
+        self.assertEqual("example.com", conn._tunnel_host)
+        self.assertEqual({'Proxy-Authorization': "Basic dTpw"},
+                         conn._tunnel_headers)
+
+    def test_no_proxy_bypasses(self):
+        urlpool.getproxies.return_value = {
+            'http': "http://proxy.example.com:3128"}
+        pool = urlpool.UrlSessionPool()
+        conn = mock.Mock()
+        conn.getresponse.return_value = FakeResponse(data=b'x')
+        with mock.patch.object(pool, '_new_connection',
+                               return_value=conn) as new_connection:
+            with mock.patch.object(urlpool, 'proxy_bypass',
+                                   return_value=True):
+                pool.urlopen("http://example.com/foo")
+        key = new_connection.call_args[0][0]
+        self.assertEqual(("http", "example.com", None), key)
+        self.assertEqual("/foo", conn.request.call_args[0][1])
+
+# vi: ts=4 expandtab
@@ -1,5 +1,6 @@
 # pylint: disable=C0301
 from simplestreams import util
+from simplestreams.contentsource import MemoryContentSource
 
 from copy import deepcopy
 import os
@@ -142,6 +143,18 @@ class TestProductsPrune(TestCase):
         self.assertEqual(tree, otree)
 
 
+class TestGetLocalCopy(TestCase):
+    def test_progress_is_bytes_read(self):
+        progress = []
+        src = MemoryContentSource(content=b"x" * 25)
+        (path, _) = util.get_local_copy(src, read_size=10,
+                                        progress_callback=progress.append)
+        self.addCleanup(os.unlink, path)
+        self.assertEqual([10, 10, 5], progress)
+        with open(path, "rb") as fp:
+            self.assertEqual(b"x" * 25, fp.read())
+
+
 class TestReadSigned(TestCase):
 
     def test_read_signed(self):
@@ -0,0 +1,58 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from simplestreams import mirrors
+from simplestreams import objectstores
+from simplestreams import verify
+from tests.testutil import get_mirror_reader
+
+
+class TestVerifyMirror(TestCase):
+    def setUp(self):
+        self.target = tempfile.mkdtemp()
+        tmirror = mirrors.ObjectStoreMirrorWriter(
+            config=None, objectstore=objectstores.FileStore(self.target))
+        tmirror.sync(get_mirror_reader("foocloud"), "streams/v1/index.json")
+        self.items = verify.load_items(self.target)
+
+    def tearDown(self):
+        shutil.rmtree(self.target)
+
+    def test_load_items(self):
+        self.assertTrue(self.items)
+        for info in self.items.values():
+            self.assertTrue(info.checksums)
+            self.assertTrue(info.owners)
+
+    def test_clean_mirror(self):
+        result = verify.verify_mirror(self.target, jobs=2)
+        self.assertTrue(result.ok())
+        self.assertEqual(sorted(self.items), sorted(result.verified))
+        self.assertTrue(result.bytes_read > 0)
+
+    def test_reports_problems(self):
+        (missing, corrupt) = sorted(self.items)[:2]
+        os.unlink(os.path.join(self.target, missing))
+        with open(os.path.join(self.target, corrupt), "r+b") as fp:
+            data = fp.read(1)
+            fp.seek(0)
+            fp.write(b"X" if data != b"X" else b"Y")
+        with open(os.path.join(self.target, "stray"), "w") as fp:
+            fp.write("not an item")
+
+        result = verify.verify_mirror(self.target, jobs=2)
+        self.assertFalse(result.ok())
+        self.assertEqual([missing], result.missing)
+        self.assertEqual([corrupt], result.corrupt)
+        self.assertEqual(["stray"], result.orphaned)
+
+    def test_size_mismatch(self):
+        info = sorted(self.items.values(), key=lambda i: i.path)[0]
+        with open(os.path.join(self.target, info.path), "ab") as fp:
+            fp.write(b"more")
+        (status, count, _) = verify.check_file(
+            os.path.join(self.target, info.path), info.checksums, info.size)
+        self.assertEqual(verify.CORRUPT, status)
+        self.assertEqual(0, count)
@@ -1,7 +1,10 @@
+import hashlib
 import shutil
 import tempfile
 
+import mock
 import os
+from simplestreams import contentsource
 from simplestreams import objectstores
 from simplestreams import mirrors
 from tests.testutil import get_mirror_reader
@@ -63,3 +66,140 @@ class TestResumePartDownload(TestCase):
         self.assertFalse(os.path.exists(tfile + ".part"))
         tmirror.sync(smirror, "streams/v1/index.json")
         self.assertFalse(os.path.exists(tfile + ".part"))
+
+
+class TestSparseInsert(TestCase):
+    def setUp(self):
+        self.target = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.target)
+
+    def test_sparse_insert_keeps_content(self):
+        store = objectstores.FileStore(self.target)
+        store.read_size = 1024
+        data = b"head" + b"\0" * 4096 + b"tail" + b"\0" * 10
+        store.insert("sparse", contentsource.MemoryContentSource(content=data),
+                     checksums={'md5': hashlib.md5(data).hexdigest()},
+                     sparse=True)
+        with open(os.path.join(self.target, "sparse"), "rb") as fp:
+            self.assertEqual(data, fp.read())
+
+
+class NoReadSource(contentsource.MemoryContentSource):
+    def read(self, size=-1):
+        raise AssertionError("content should not have been read")
+
+    readinto = read
+
+
+class TestContentAddressed(TestCase):
+    data = b"same bytes in two streams" * 100
+
+    def setUp(self):
+        self.target = tempfile.mkdtemp()
+        self.store = objectstores.FileStore(self.target,
+                                            content_addressed=True)
+        self.checksums = {'sha256': hashlib.sha256(self.data).hexdigest()}
+
+    def tearDown(self):
+        shutil.rmtree(self.target)
+
+    def insert(self, path, reader=None, checksums=None):
+        if reader is None:
+            reader = contentsource.MemoryContentSource(content=self.data)
+        self.store.insert(path, reader, mutable=False, size=len(self.data),
+                          checksums=checksums or self.checksums)
+        return os.stat(os.path.join(self.target, path))
+
+    def test_second_copy_not_read(self):
+        first = self.insert("released/a.img")
+        second = self.insert("daily/b.img", NoReadSource(content=self.data))
+        self.assertEqual((first.st_dev, first.st_ino),
+                         (second.st_dev, second.st_ino))
+        blob = os.path.join(self.target, objectstores.BLOB_DIR, "sha256",
+                            self.checksums['sha256'][:2],
+                            self.checksums['sha256'])
+        self.assertEqual(3, os.stat(blob).st_nlink)
+        with open(os.path.join(self.target, "daily/b.img"), "rb") as fp:
+            self.assertEqual(self.data, fp.read())
+
+    def test_unused_blobs_removed(self):
+        self.insert("released/a.img")
+        self.insert("daily/b.img")
+        self.store.remove("released/a.img")
+        self.assertEqual([], self.store.remove_unused_blobs())
+        self.store.remove("daily/b.img")
+        self.assertEqual(1, len(self.store.remove_unused_blobs()))
+        self.insert("daily/b.img")
+
+    def blob(self):
+        return os.path.join(self.target, objectstores.BLOB_DIR, "sha256",
+                            self.checksums['sha256'][:2],
+                            self.checksums['sha256'])
+
+    def test_bad_blob_not_used(self):
+        self.insert("released/a.img")
+        self.store.remove("released/a.img")
+        with open(self.blob(), "r+b") as fp:
+            fp.write(b"X")
+        self.insert("daily/b.img")
+        with open(os.path.join(self.target, "daily/b.img"), "rb") as fp:
+            self.assertEqual(self.data, fp.read())
+
+    def test_copied_items_keep_blob(self):
+        self.insert("released/a.img")
+        self.insert("daily/b.img")
+        # as if the item had been reflinked or copied rather than linked.
+        bpath = os.path.join(self.target, "daily/b.img")
+        shutil.copy(bpath, bpath + ".copy")
+        os.rename(bpath + ".copy", bpath)
+        self.store.remove("released/a.img")
+        self.assertEqual(1, os.stat(self.blob()).st_nlink)
+        self.assertEqual([], self.store.remove_unused_blobs())
+        self.store.remove("daily/b.img")
+        self.assertEqual([self.blob()], self.store.remove_unused_blobs())
+
+    def test_needs_sha256(self):
+        md5 = {'md5': hashlib.md5(self.data).hexdigest()}
+        self.insert("released/a.img", checksums=md5)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.target, objectstores.BLOB_DIR)))
+
+
+class TestInventory(TestCase):
+    def setUp(self):
+        self.target = tempfile.mkdtemp()
+        self.store = objectstores.FileStore(self.target)
+
+    def tearDown(self):
+        shutil.rmtree(self.target)
+
+    def test_lists_files_under_prefix(self):
+        self.check_listing()
+
+    def test_lists_files_without_scandir(self):
+        with mock.patch.object(objectstores, '_scandir', None):
+            self.check_listing()
+
+    def check_listing(self):
+        self.store.insert_content("a/b/one", b"1")
+        self.store.insert_content("a/two", b"22")
+        self.store.insert_content("other", b"333")
+        with open(os.path.join(self.target, "a", "three.part"), "wb") as fp:
+            fp.write(b"partial")
+        found = self.store.inventory("a/")
+        self.assertEqual(["a/b/one", "a/two"], sorted(found))
+        self.assertEqual(2, found["a/two"].size)
+        self.assertEqual(3, len(self.store.inventory()))
+        self.assertEqual({}, self.store.inventory("missing/"))
+
+    def test_cached_until_refresh(self):
+        self.store.insert_content("a/one", b"1")
+        self.assertEqual(["a/one"], list(self.store.inventory()))
+        self.store.insert_content("a/two", b"2")
+        self.assertEqual((True, None), self.store.inventoried("a/two"))
+        self.store.remove("a/one")
+        self.assertEqual({}, self.store.inventory())
+        self.assertEqual(["a/two"],
+                         list(self.store.inventory(refresh=True)))
@@ -3,15 +3,18 @@ import os
 from simplestreams import util
 
 
-def signjson_file(fname, status_cb=None, force=True):
+def signjson_file(fname, status_cb=None, force=True, compress=()):
     # input fname should be .json
-    # creates .json.gpg and .sjson
+    # creates .json.gpg and .sjson, and for each suffix in compress
+    # (such as '.xz') compressed copies of the .json and .sjson.
     content = ""
     with open(fname, "r") as fp:
         content = fp.read()
     if not force:
         octime = os.path.getctime(fname)
         output = [util.signed_fname(fname, inline=b) for b in (True, False)]
+        output += [f + suffix for f in (fname, output[0])
+                   for suffix in compress]
         update = [f for f in output
                   if not (os.path.isfile(f) and octime < os.path.getctime(f))]
         if len(update) == 0:
@@ -29,6 +32,11 @@ def signjson_file(fname, status_cb=None, force=True):
     else:
         util.sign_file(fname, inline=True)
 
+    sfname = util.signed_fname(fname, inline=True)
+    for path in (fname, sfname):
+        with open(path, "rb") as fp:
+            util.write_compressed(path, fp.read(), compress)
+
     return
 
 